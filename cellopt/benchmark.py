@@ -0,0 +1,492 @@
+"""
+Offline benchmarks of the cellopt.py hot paths on synthetic input files.
+
+Usage:
+    python benchmark.py parse --residues 5000 --repeat 3
+    python benchmark.py suite --sizes small medium --json baseline.json
+    python benchmark.py suite --compare baseline.json
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import json
+import platform
+from collections import OrderedDict
+from tempfile import mkdtemp
+from shutil import rmtree
+import numpy as np
+
+from cellopt import (ShelxlReader, ShelxlMolecule, LattParser, SymmetryElement, SYMMDENOMINATOR, CLASSPARAMETERS,
+                     run)
+
+
+RESIDUE = (('N', 4, (0.0, 0.0, 0.0)),
+           ('CA', 1, (1.458, 0.0, 0.0)),
+           ('C', 1, (2.009, 1.420, 0.0)),
+           ('O', 3, (1.251, 2.390, 0.0)),
+           ('CB', 1, (1.988, -0.773, -1.199)),
+           ('H', 2, (-0.5, -0.8, 0.0)),
+           ('HA', 2, (1.8, -0.5, 0.9)))
+RESIDUERESTRAINTS = (('DFIX', 1.458, (('N', 'CA'),)),
+                     ('DFIX', 1.525, (('CA', 'C'),)),
+                     ('DFIX', 1.231, (('C', 'O'),)),
+                     ('DFIX', 1.530, (('CA', 'CB'),)),
+                     ('DANG', 2.462, (('N', 'C'),)),
+                     ('DANG', 2.401, (('CA', 'O'),)))
+
+
+def writeProteinRes(fileName, residues=5000, cell=(60.0, 75.0, 90.0, 90.0, 90.0, 90.0), seed=0):
+    """
+    Writes a synthetic protein-like shelxl.res file. Each residue is a RESI record with the atoms of a small amino
+    acid fragment. Anisotropic atoms are written with continuation lines and restraints are given per residue class,
+    so every parser code path is exercised. The file has about ten lines per residue.
+    :param fileName: str
+    :param residues: int<number of residues>
+    :param cell: tuple of six floats
+    :param seed: int<seed of the random coordinate displacements>
+    :return: int<number of lines written>
+    """
+    random = np.random.RandomState(seed)
+    lengths = np.array(cell[:3])
+    lines = ['TITL synthetic protein with {} residues'.format(residues),
+             'CELL 0.71073 {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f}'.format(*cell),
+             'ZERR 4 0.0010 0.0010 0.0010 0.0000 0.0000 0.0000',
+             'LATT -1',
+             'SYMM -X, 1/2+Y, -Z',
+             'SFAC C H O N',
+             'UNIT {} {} {} {}'.format(2 * residues, 2 * residues, residues, residues),
+             'L.S. 10',
+             'PLAN 20',
+             'WGHT 0.1000',
+             'FVAR 1.00000']
+    for cmd, target, pairs in RESIDUERESTRAINTS:
+        lines.append('{}_GLY {:.3f} 0.02 '.format(cmd, target) + ' '.join('{} {}'.format(*pair) for pair in pairs))
+    for resi in range(1, residues + 1):
+        lines.append('RESI GLY {}'.format(resi))
+        origin = random.uniform(0, 1, 3) * lengths
+        for name, sfac, position in RESIDUE:
+            frac = (origin + np.array(position) + random.normal(0, 0.01, 3)) / lengths % 1
+            record = '{:4} {} {:.5f} {:.5f} {:.5f} 11.00000'.format(name, sfac, *frac)
+            if name.startswith('H'):
+                lines.append(record + ' -1.2')
+            else:
+                lines.append(record + ' 0.03000 0.03000 =')
+                lines.append('   0.03000 0.00100 0.00100 0.00100')
+    lines.append('HKLF 4')
+    lines.append('END')
+    with open(fileName, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return len(lines)
+
+
+def benchmarkParse(residues=5000, repeat=3, directory=None):
+    """
+    Times ShelxlReader.read() and ShelxlReader.write() on a synthetic protein-scale file.
+    :param residues: int<number of residues of the synthetic structure>
+    :param repeat: int<number of timed repetitions. The best time is reported.>
+    :param directory: str<directory the synthetic file is written to. Defaults to a temporary directory.>
+    :return: dict
+    """
+    temporary = directory is None
+    directory = mkdtemp(prefix='cellopt_bench_') if temporary else directory
+    try:
+        fileName = os.path.join(directory, 'protein.res')
+        numLines = writeProteinRes(fileName, residues=residues)
+        readTimes = []
+        writeTimes = []
+        for _ in range(repeat):
+            startTime = time.time()
+            reader = ShelxlReader()
+            molecule = reader.read(fileName)
+            readTimes.append(time.time() - startTime)
+            startTime = time.time()
+            reader.write(os.path.join(directory, 'out.res'))
+            writeTimes.append(time.time() - startTime)
+        return {'benchmark': 'parse',
+                'lines': numLines,
+                'atoms': len(molecule.atoms),
+                'read': min(readTimes),
+                'write': min(writeTimes),
+                'linesPerSecond': numLines / min(readTimes)}
+    finally:
+        if temporary:
+            rmtree(directory, ignore_errors=True)
+
+
+# Two space groups per crystal class: (symbol, LATT, SYMM instructions). The second one has a centred lattice
+# or a center of inversion where the class allows it.
+SPACEGROUPS = OrderedDict([('triclinic', (('P1', -1, ()),
+                                          ('P-1', 1, ()))),
+                           ('monoclinic', (('P21/c', 1, ('-X, 1/2+Y, 1/2-Z',)),
+                                           ('C2/c', 7, ('-X, Y, 1/2-Z',)))),
+                           ('orthorhombic', (('P212121', -1, ('1/2-X, -Y, 1/2+Z', '-X, 1/2+Y, 1/2-Z',
+                                                              '1/2+X, 1/2-Y, -Z')),
+                                             ('Fdd2', -4, ('-X, -Y, Z', '1/4-X, 1/4+Y, 1/4+Z')))),
+                           ('tetragonal', (('P41', -1, ('-X, -Y, 1/2+Z', '-Y, X, 1/4+Z', 'Y, -X, 3/4+Z')),
+                                           ('I-4', -2, ('-X, -Y, Z', 'Y, -X, -Z', '-Y, X, -Z')))),
+                           ('rhombohedral', (('R3', -1, ('Z, X, Y', 'Y, Z, X')),
+                                             ('R-3', 1, ('Z, X, Y', 'Y, Z, X')))),
+                           ('hexagonal', (('P63', -1, ('-Y, X-Y, Z', '-X+Y, -X, Z', '-X, -Y, 1/2+Z')),
+                                          ('P-3', 1, ('-Y, X-Y, Z', '-X+Y, -X, Z')))),
+                           ('cubic', (('P213', -1, ('1/2-X, -Y, 1/2+Z', '-X, 1/2+Y, 1/2-Z', 'Z, X, Y')),
+                                      ('F23', -4, ('-X, -Y, Z', '-X, Y, -Z', 'Z, X, Y'))))])
+# Cell shapes per crystal class. The lengths are scaled to the number of atoms of a structure.
+CELLSHAPES = {'triclinic': (1.0, 1.1, 1.25, 84.3, 78.9, 69.4),
+              'monoclinic': (1.0, 1.2, 0.9, 90.0, 103.5, 90.0),
+              'orthorhombic': (1.0, 1.15, 1.3, 90.0, 90.0, 90.0),
+              'tetragonal': (1.0, 1.0, 1.4, 90.0, 90.0, 90.0),
+              'rhombohedral': (1.0, 1.0, 1.0, 75.0, 75.0, 75.0),
+              'hexagonal': (1.0, 1.0, 1.3, 90.0, 90.0, 120.0),
+              'cubic': (1.0, 1.0, 1.0, 90.0, 90.0, 90.0)}
+SIZES = OrderedDict([('small', {'molecules': 4, 'fragment': 8, 'eqivs': 4}),
+                     ('medium', {'molecules': 60, 'fragment': 8, 'eqivs': 60}),
+                     ('large', {'molecules': 600, 'fragment': 8, 'eqivs': 600})])
+TIMINGS = ('read', 'checkDfix', 'asP1', 'write', 'fast')
+BOND = 1.54
+ANGLEDISTANCE = 2.516
+VOLUMEPERATOM = 18.
+# Range of the distances in Angstrom between an atom and a symmetry equivalent atom restrained through EQIV.
+CONTACTRANGE = (2.0, 4.0)
+
+
+def countOperators(latt, symms):
+    """
+    Returns the number of symmetry operators of a space group, see ShelxlMolecule.symms.
+    :param latt: int<LATT instruction>
+    :param symms: list of str<SYMM instructions>
+    :return: int
+    """
+    molecule = ShelxlMolecule()
+    molecule.setCentric(latt > 0)
+    molecule.setLattOps(LattParser.LATTDICT[abs(latt)])
+    for symm in symms:
+        molecule.addSymm(symm.split(','))
+    return len(molecule.symms) + 1
+
+
+def orthogonalizationMatrix(cell):
+    """
+    Returns the matrix converting fractional to Cartesian coordinates.
+    :param cell: list of six floats
+    :return: numpy.ndarray of shape (3, 3)
+    """
+    a, b, c = cell[:3]
+    alpha, beta, gamma = np.radians(cell[3:])
+    cy = (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+    return np.array([[a, b * np.cos(gamma), c * np.cos(beta)],
+                     [0, b * np.sin(gamma), c * cy],
+                     [0, 0, c * np.sqrt(1 - np.cos(beta) ** 2 - cy ** 2)]])
+
+
+def findContacts(fracs, cell, operator, number, random):
+    """
+    Finds pairs of atoms and symmetry equivalent atoms in contact, like those restrained through EQIV instructions in
+    real structures. Atoms are visited in random order and each atom takes part in at most one contact. The distance
+    of a pair is computed with the shortest lattice translation, as in ShelxlMolecule.checkDfix(), and the translation
+    is added to the operator, so SHELXL computes the same distance.
+    :param fracs: numpy.ndarray of shape (number of atoms, 3)<fractional coordinates>
+    :param cell: list of six floats
+    :param operator: str<symmetry operator in SHELXL syntax>
+    :param number: int<maximum number of contacts>
+    :param random: numpy.random.RandomState instance
+    :return: list of tuples<int<first atom>, int<second atom>, str<operator of the second atom>, float<distance>>
+    """
+    symmetry = SymmetryElement(operator.split(','))
+    images = fracs.dot(symmetry.affine[:, :3].T) + symmetry.affine[:, 3]
+    toCartesian = orthogonalizationMatrix(cell)
+    contacts = []
+    used = set()
+    for first in random.permutation(len(fracs)):
+        if len(contacts) >= number:
+            break
+        if first in used:
+            continue
+        differences = (images - fracs[first] + 99.5) % 1 - 0.5
+        distances = np.linalg.norm(differences.dot(toCartesian.T), axis=1)
+        candidates = [second for second in np.flatnonzero((distances >= CONTACTRANGE[0]) &
+                                                          (distances <= CONTACTRANGE[1])) if second not in used]
+        if not candidates:
+            continue
+        second = candidates[random.randint(len(candidates))]
+        shift = np.rint(fracs[first] + differences[second] - images[second]).astype(int)
+        translation = [t + n * SYMMDENOMINATOR for t, n in zip(symmetry.translation, shift)]
+        shifted = SymmetryElement.fromOperator(symmetry.rotation, translation).toShelxl()
+        contacts.append((int(first), int(second), shifted, float(distances[second])))
+        used.update((first, second))
+    return contacts
+
+
+def writeStructure(fileName, cls='monoclinic', spaceGroup=0, molecules=60, fragment=8, eqivs=60, residues=False,
+                   seed=0):
+    """
+    Writes a synthetic shelxl.res file and a matching shelxl.hkl file. The asymmetric unit holds randomly placed and
+    oriented zigzag chains of carbon atoms. Bonds are restrained with DFIX and 1,3 distances with DANG. Further DFIX
+    restraints reference symmetry equivalent atoms through EQIV instructions, see findContacts(). With residues, every
+    chain is a residue of class MOL and the restraints are given once for the class. The cell written to the file is 1 % larger than the
+    cell the coordinates were generated in, so the optimizer has something to do.
+    :param fileName: str<name of the files without extension>
+    :param cls: str<crystal class in CLASSPARAMETERS>
+    :param spaceGroup: int<index of the space group in SPACEGROUPS[cls]>
+    :param molecules: int<number of chains>
+    :param fragment: int<number of atoms per chain>
+    :param eqivs: int<maximum number of restraints referencing symmetry equivalent atoms>
+    :param residues: bool<use residue classes>
+    :param seed: int<seed of the random placement>
+    :return: dict<description of the structure>
+    """
+    random = np.random.RandomState(seed)
+    symbol, latt, symms = SPACEGROUPS[cls][spaceGroup]
+    operators = countOperators(latt, symms)
+    shape = CELLSHAPES[cls]
+    unitVolume = abs(np.linalg.det(orthogonalizationMatrix((1., shape[1], shape[2]) + shape[3:])))
+    length = (molecules * fragment * operators * VOLUMEPERATOM / unitVolume) ** (1 / 3.)
+    cell = [length * shape[0], length * shape[1], length * shape[2]] + list(shape[3:])
+    toFractional = np.linalg.inv(orthogonalizationMatrix(cell))
+    zigzag = np.array([[k * 1.258, (k % 2) * 0.888, 0.] for k in range(fragment)])
+    writtenCell = [x * 1.01 for x in cell[:3]] + cell[3:]
+    lines = ['TITL synthetic {} structure in {}'.format(cls, symbol),
+             'CELL 0.71073 {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f}'.format(*writtenCell),
+             'ZERR 4 0.0010 0.0010 0.0010 0.0000 0.0000 0.0000',
+             'LATT {}'.format(latt)]
+    lines += ['SYMM {}'.format(symm) for symm in symms]
+    lines += ['SFAC C',
+              'UNIT {}'.format(molecules * fragment * operators),
+              'L.S. 4']
+    names = []
+    atoms = []
+    allFracs = []
+    for molecule in range(molecules):
+        rotation, _ = np.linalg.qr(random.normal(size=(3, 3)))
+        origin = random.uniform(0, 1, 3)
+        fracs = origin + toFractional.dot(rotation.dot(zigzag.T)).T
+        if residues:
+            atoms.append('RESI MOL {}'.format(molecule + 1))
+        for k, frac in enumerate(fracs):
+            name = 'C{}'.format(k + 1 if residues else molecule * fragment + k + 1)
+            names.append('{}_{}'.format(name, molecule + 1) if residues else name)
+            allFracs.append(frac)
+            atoms.append('{:5} 1 {:.5f} {:.5f} {:.5f} 11.00000 0.05000'.format(name, *frac))
+    numDfix = numDang = 0
+    chains = [range(fragment)] if residues else [range(m * fragment, (m + 1) * fragment) for m in range(molecules)]
+    suffix = '_MOL' if residues else ''
+    for chain in chains:
+        chainNames = ['C{}'.format(k + 1) for k in chain]
+        lines.append('DFIX{} {:.3f} '.format(suffix, BOND) +
+                     ' '.join('{} {}'.format(*pair) for pair in zip(chainNames, chainNames[1:])))
+        lines.append('DANG{} {:.3f} '.format(suffix, ANGLEDISTANCE) +
+                     ' '.join('{} {}'.format(*pair) for pair in zip(chainNames, chainNames[2:])))
+        numDfix += fragment - 1
+        numDang += fragment - 2
+    contacts = findContacts(np.array(allFracs), cell, symms[0] if symms else '-X, -Y, -Z', eqivs, random)
+    eqivOperators = []
+    for first, second, operator, distance in contacts:
+        if operator not in eqivOperators:
+            eqivOperators.append(operator)
+            lines.append('EQIV ${} {}'.format(len(eqivOperators), operator))
+        lines.append('DFIX {:.3f} {} {}_${}'.format(distance, names[first], names[second],
+                                                    eqivOperators.index(operator) + 1))
+    lines += ['WGHT 0.1000', 'FVAR 1.00000'] + atoms + ['HKLF 4', 'END']
+    with open(fileName + '.res', 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    with open(fileName + '.hkl', 'w') as fp:
+        for h in range(1, 6):
+            fp.write('{:4d}{:4d}{:4d}{:8.2f}{:8.2f}\n'.format(h, 0, 0, 100. / h, 1.))
+        fp.write('{:4d}{:4d}{:4d}{:8.2f}{:8.2f}\n'.format(0, 0, 0, 0., 0.))
+    return OrderedDict([('class', cls),
+                        ('spaceGroup', symbol),
+                        ('latt', latt),
+                        ('symm', len(symms)),
+                        ('operators', operators),
+                        ('residues', residues),
+                        ('atoms', molecules * fragment),
+                        ('dfix', numDfix if not residues else numDfix * molecules),
+                        ('dang', numDang if not residues else numDang * molecules),
+                        ('eqiv', len(contacts))])
+
+
+def bestTime(function, repeat):
+    """
+    Calls function repeat times and returns the shortest run time and the last result.
+    :param function: callable without arguments
+    :param repeat: int
+    :return: float<seconds>, object
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        startTime = time.time()
+        result = function()
+        times.append(time.time() - startTime)
+    return min(times), result
+
+
+def benchmarkStructure(fileName, cls, repeat=3, fast=True):
+    """
+    Times ShelxlReader.read(), ShelxlMolecule.checkDfix() including the compilation of the restraints,
+    ShelxlMolecule.asP1(), ShelxlReader.write() and a complete run in mode 'fast' on a structure written by
+    writeStructure().
+    :param fileName: str<name of the files without extension>
+    :param cls: str<crystal class the fast run is constrained to>
+    :param repeat: int<number of timed repetitions. The best time is reported.>
+    :param fast: bool<include the fast run>
+    :return: dict
+    """
+    result = OrderedDict()
+    result['read'], (reader, molecule) = bestTime(lambda: (lambda r: (r, r.read(fileName + '.res')))(ShelxlReader()),
+                                                  repeat)
+
+    def checkDfix():
+        molecule._finalizeDfix()
+        return molecule.checkDfix()
+
+    result['checkDfix'], (startFit, _) = bestTime(checkDfix, repeat)
+    result['asP1'], _ = bestTime(molecule.asP1, repeat)
+    result['write'], _ = bestTime(lambda: reader.write(fileName + '_out.res'), repeat)
+    result['startFit'] = startFit
+    if fast:
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            result['fast'], summary = bestTime(lambda: run(fileName, overrideClass=cls, fast=True,
+                                                           scratch=os.path.dirname(fileName) or None), 1)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        result['fit'] = summary['fit']
+    return result
+
+
+def benchmarkSuite(sizes=None, classes=None, residues=(False, True), repeat=3, fast=True, directory=None,
+                   report=None):
+    """
+    Runs benchmarkStructure() on synthetic structures of all combinations of crystal class, space group, size and
+    residue setting.
+    :param sizes: list of str<keys of SIZES>. Defaults to all sizes.
+    :param classes: list of str<crystal classes>. Defaults to all classes of CLASSPARAMETERS.
+    :param residues: tuple of bool<residue settings>
+    :param repeat: int<number of timed repetitions. The best time is reported.>
+    :param fast: bool<include fast runs>
+    :param directory: str<directory the synthetic files are written to. Defaults to a temporary directory.>
+    :param report: callable(dict) called after each structure
+    :return: list of dict
+    """
+    sizes = sizes if sizes else list(SIZES.keys())
+    classes = classes if classes else [cls for cls in SPACEGROUPS if cls in CLASSPARAMETERS]
+    temporary = directory is None
+    directory = mkdtemp(prefix='cellopt_bench_') if temporary else directory
+    results = []
+    try:
+        for size in sizes:
+            for cls in classes:
+                for spaceGroup in range(len(SPACEGROUPS[cls])):
+                    for residue in residues:
+                        fileName = os.path.join(directory, 'bench')
+                        result = writeStructure(fileName, cls=cls, spaceGroup=spaceGroup, residues=residue,
+                                                **SIZES[size])
+                        result['size'] = size
+                        result.update(benchmarkStructure(fileName, cls, repeat=repeat, fast=fast))
+                        results.append(result)
+                        if report:
+                            report(result)
+    finally:
+        if temporary:
+            rmtree(directory, ignore_errors=True)
+    return results
+
+
+def caseName(result):
+    """
+    Returns the name identifying a benchmark case in a baseline.
+    :param result: dict
+    :return: str
+    """
+    return '{class}/{spaceGroup}/{size}'.format(**result) + ('/residues' if result['residues'] else '')
+
+
+def writeBaseline(results, fileName):
+    """
+    Writes benchmark results together with a description of the machine to a JSON file.
+    :param results: list of dict
+    :param fileName: str
+    :return: None
+    """
+    baseline = OrderedDict([('created', time.strftime('%Y-%m-%d %H:%M:%S')),
+                            ('python', platform.python_version()),
+                            ('numpy', np.__version__),
+                            ('platform', platform.platform()),
+                            ('processor', platform.processor()),
+                            ('results', results)])
+    with open(fileName, 'w') as fp:
+        json.dump(baseline, fp, indent=2)
+
+
+def compareBaseline(results, fileName):
+    """
+    Compares benchmark results with a baseline written by writeBaseline(). Ratios below 1 mean the current code is
+    faster.
+    :param results: list of dict
+    :param fileName: str
+    :return: list of dict<case name and ratio of each timing>
+    """
+    with open(fileName) as fp:
+        baseline = dict((caseName(result), result) for result in json.load(fp)['results'])
+    comparison = []
+    for result in results:
+        old = baseline.get(caseName(result))
+        if old is None:
+            continue
+        ratios = OrderedDict([('case', caseName(result))])
+        for key in TIMINGS:
+            if key in result and old.get(key):
+                ratios[key] = result[key] / old[key]
+        comparison.append(ratios)
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cellopt.py on synthetic structures.')
+    parser.add_argument('benchmark', type=str, choices=['parse', 'suite'],
+                        help='Name of the benchmark to run. {parse} times reading and writing a protein-scale file. '
+                             '{suite} times the main operations on structures of all crystal classes.')
+    parser.add_argument('--residues', type=int, default=5000,
+                        help='Number of residues of the synthetic structure of the parse benchmark.')
+    parser.add_argument('--sizes', type=str, nargs='+', default=None, choices=list(SIZES.keys()),
+                        help='Structure sizes of the suite. Defaults to all sizes.')
+    parser.add_argument('--classes', type=str, nargs='+', default=None, choices=list(SPACEGROUPS.keys()),
+                        help='Crystal classes of the suite. Defaults to all classes.')
+    parser.add_argument('--no-fast', action='store_true',
+                        help='Do not time complete fast mode runs in the suite.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repetitions. The best time is reported.')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Write the results to a JSON file. The suite writes a baseline that can be passed to '
+                             '--compare.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare the suite results with a baseline JSON file.')
+    args = parser.parse_args()
+    if args.benchmark == 'parse':
+        result = benchmarkParse(residues=args.residues, repeat=args.repeat)
+        print('{lines} lines, {atoms} atoms: read {read:.3f}s ({linesPerSecond:.0f} lines/s), '
+              'write {write:.3f}s'.format(**result))
+        if args.json:
+            with open(args.json, 'w') as fp:
+                json.dump(result, fp, indent=2)
+    else:
+        print('{:40} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('Case', 'Atoms', *TIMINGS))
+
+        def printResult(result):
+            print('{:40} {:6d} '.format(caseName(result), result['atoms']) +
+                  ' '.join(['{:8.4f}'.format(result[key]) if key in result else '{:>8}'.format('-')
+                            for key in TIMINGS]))
+
+        results = benchmarkSuite(sizes=args.sizes, classes=args.classes, repeat=args.repeat, fast=not args.no_fast,
+                                 report=printResult)
+        if args.json:
+            writeBaseline(results, args.json)
+        if args.compare:
+            print('\nTime relative to {}:'.format(args.compare))
+            for ratios in compareBaseline(results, args.compare):
+                print('{:40} '.format(ratios['case']) + ' '.join(['{:8.3f}'.format(ratios[key]) if key in ratios
+                                                                  else '{:>8}'.format('-') for key in TIMINGS]))
@@ -1,19 +1,30 @@
 from __future__ import print_function
 from copy import deepcopy
-from math import cos, pi
-from subprocess import call, STDOUT
-from shutil import copyfile
+from subprocess import Popen, PIPE, STDOUT
+from multiprocessing import Pool, cpu_count
+from shutil import copyfile, rmtree, which
+from tempfile import mkdtemp
+from hashlib import sha1
+from glob import glob
 import os
 import sys
+import time
 import argparse
-from os.path import dirname, join
+import json
+import csv
+from os.path import join
 from collections import OrderedDict
+from fractions import Fraction
+import re
+import shlex
+import numpy as np
 try:
-    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
     PLOTAVAILABLE = True
 except ImportError:
     PLOTAVAILABLE = False
-    plt = None
+    Figure = FigureCanvas = None
 
 
 CLASSPARAMETERS = {'triclinic': ((0, 1, 2, 3, 4, 5), {}),
@@ -24,76 +35,1077 @@ CLASSPARAMETERS = {'triclinic': ((0, 1, 2, 3, 4, 5), {}),
                    'hexagonal': ((0, 2), {0: (1,)}),
                    'cubic': ((0,), {0: (1, 2)})}
 
+# Basis vectors spanning the metric coefficients (G11, G22, G33, 2*G23, 2*G13, 2*G12) allowed by each crystal class.
+METRICCONSTRAINTS = {'triclinic': ((1, 0, 0, 0, 0, 0), (0, 1, 0, 0, 0, 0), (0, 0, 1, 0, 0, 0),
+                                   (0, 0, 0, 1, 0, 0), (0, 0, 0, 0, 1, 0), (0, 0, 0, 0, 0, 1)),
+                     'monoclinic': ((1, 0, 0, 0, 0, 0), (0, 1, 0, 0, 0, 0), (0, 0, 1, 0, 0, 0), (0, 0, 0, 0, 1, 0)),
+                     'orthorhombic': ((1, 0, 0, 0, 0, 0), (0, 1, 0, 0, 0, 0), (0, 0, 1, 0, 0, 0)),
+                     'tetragonal': ((1, 1, 0, 0, 0, 0), (0, 0, 1, 0, 0, 0)),
+                     'rhombohedral': ((1, 1, 1, 0, 0, 0), (0, 0, 0, 1, 1, 1)),
+                     'hexagonal': ((1, 1, 0, 0, 0, -1), (0, 0, 1, 0, 0, 0)),
+                     'cubic': ((1, 1, 1, 0, 0, 0),)}
+
+
+class ListingResult(object):
+    """
+    Figures of merit of a SHELXL refinement as reported in its listing output.
+    Values not found in the listing are None.
+    """
+
+    def __init__(self):
+        self.wR2 = None
+        self.R1 = None
+        self.R1all = None
+        self.goof = None
+        self.restrainedGoof = None
+        self.meanShift = None
+        self.maxShift = None
+        self.restraints = []
+        self.errors = []
+
+    def __str__(self):
+        return 'ListingResult(wR2={}, R1={}, GooF={}, max shift/esd={}, restraints={}, errors={})'.format(
+            self.wR2, self.R1, self.goof, self.maxShift, len(self.restraints), len(self.errors))
+
+    def complete(self):
+        """
+        Returns True if the final wR2 for all data was found.
+        :return: bool
+        """
+        return self.wR2 is not None
+
+
+class ListingParser(object):
+    """
+    Incremental parser for the console and .lst output of SHELXL.
+    Lines are fed one at a time, so the output can be parsed while SHELXL is still writing it. Each line is inspected
+    once and the extracted values are collected in a ListingResult instance. Values reported once per refinement
+    cycle are overwritten, so the result holds those of the last cycle.
+    """
+    RESTRAINTS = ('DFIX', 'DANG', 'SADI', 'SAME', 'FLAT', 'CHIV', 'DELU', 'SIMU', 'RIGU', 'ISOR', 'EXYZ', 'EADP',
+                  'NCSY', 'BUMP', 'SUMP')
+
+    def __init__(self):
+        self.result = ListingResult()
+        self.inRestraints = False
+
+    def __call__(self, line):
+        """
+        Parse a single line of output.
+        :param line: str
+        :return: None
+        """
+        if '**' in line:
+            self.result.errors.append(line.rstrip())
+            return
+        words = line.split()
+        if not words:
+            if self.result.restraints:
+                self.inRestraints = False
+            return
+        if self.inRestraints:
+            self.inRestraints = self.parseRestraint(words)
+            if self.inRestraints:
+                return
+        if words[0] == 'wR2' and 'for all data' in line:
+            self.result.wR2 = self._number(words[2])
+            for key, offset, attribute in (('S', 2, 'goof'), ('Restrained', 3, 'restrainedGoof')):
+                if key in words:
+                    setattr(self.result, attribute, self._number(words[words.index(key) + offset]))
+        elif words[0] == 'R1' and len(words) > 2:
+            self.result.R1 = self._number(words[2])
+            if 'and' in words:
+                self.result.R1all = self._number(words[words.index('and') + 1])
+        elif words[0] == 'Mean' and words[1] == 'shift/esd':
+            self.result.meanShift = self._number(words[3])
+            if 'Maximum' in words:
+                self.result.maxShift = self._number(words[words.index('Maximum') + 2])
+        elif words[0] == 'Observed' and 'Restraint' in words:
+            self.result.restraints = []
+            self.inRestraints = True
+
+    def parseRestraint(self, words):
+        """
+        Parses one row of a SHELXL restraint table.
+        :param words: list of str
+        :return: bool<True if the row was a restraint row>
+        """
+        if len(words) < 5 or words[4][:4] not in self.RESTRAINTS:
+            return False
+        try:
+            values = [float(word) for word in words[:4]]
+        except ValueError:
+            return False
+        self.result.restraints.append(tuple(values) + (' '.join(words[4:]),))
+        return True
+
+    def feed(self, lines):
+        """
+        Parse an iterable of lines, eg. an open file or pipe.
+        :param lines: iterable of str
+        :return: ListingResult instance
+        """
+        for line in lines:
+            self(line)
+        return self.result
+
+    def _number(self, word):
+        try:
+            return float(word.strip(',;'))
+        except ValueError:
+            return None
+
+
+def readListing(fileName):
+    """
+    Parses a SHELXL .lst file in a single pass.
+    :param fileName: str
+    :return: ListingResult instance
+    """
+    with PROFILER.phase('lst'), open(fileName, 'r') as fp:
+        return ListingParser().feed(fp)
+
+
+class CelloptError(Exception):
+    """
+    Raised if a structure can not be optimized. The command line interface prints the message and exits with the given
+    exit code. Batch runs record the message and continue with the next structure.
+    """
+
+    def __init__(self, message, exitCode=1):
+        super(CelloptError, self).__init__(message, exitCode)
+        self.message = message
+        self.exitCode = exitCode
+
+    def __str__(self):
+        return self.message
+
+
+def cpuTime():
+    """
+    Returns the CPU time used by this process and its terminated child processes, eg. SHELXL.
+    :return: float<seconds>
+    """
+    clock = time.process_time if hasattr(time, 'process_time') else time.clock
+    return clock() + sum(os.times()[2:4])
+
+
+class ProfilePhase(object):
+    """
+    Context manager adding the wall and CPU time of a block to a phase of a Profiler.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.wall = 0
+        self.cpu = 0
+
+    def __enter__(self):
+        if self.profiler:
+            self.wall = time.time()
+            self.cpu = cpuTime()
+        return self
+
+    def __exit__(self, *args):
+        if self.profiler:
+            self.profiler.add(self.name, time.time() - self.wall, cpuTime() - self.cpu)
+
+
+NULLPHASE = ProfilePhase(None, None)
+
+
+class Profiler(object):
+    """
+    Records wall and CPU time per phase of a run and counts calls of hot functions. The module level instance PROFILER
+    is disabled by default, in which case phase() returns a context manager that does nothing.
+    Phases may be nested, eg. 'parse' within 'reread', so their times are inclusive. Process pool workers send their
+    records to the parent process with collect() and merge().
+
+        with PROFILER.phase('parse'):
+            molecule = reader.read(fileName)
+        PROFILER.count('shelxl')
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.counters = {}
+        self.startTime = time.time()
+        self.startCpu = cpuTime()
+
+    def enable(self, enabled=True):
+        """
+        Enables or disables recording and discards all records.
+        :param enabled: bool
+        :return: None
+        """
+        self.enabled = enabled
+        self.collect()
+        self.startTime = time.time()
+        self.startCpu = cpuTime()
+
+    def phase(self, name):
+        """
+        Returns a context manager recording the time spent in its block.
+        :param name: str<name of the phase>
+        :return: ProfilePhase instance
+        """
+        return ProfilePhase(self, name) if self.enabled else NULLPHASE
+
+    def add(self, name, wall, cpu, calls=1):
+        """
+        Adds time to a phase.
+        :param name: str<name of the phase>
+        :param wall: float<seconds>
+        :param cpu: float<seconds>
+        :param calls: int
+        :return: None
+        """
+        record = self.phases.setdefault(name, [0, 0., 0.])
+        record[0] += calls
+        record[1] += wall
+        record[2] += cpu
+
+    def count(self, name, n=1):
+        """
+        Increments a counter.
+        :param name: str<name of the counter>
+        :param n: int
+        :return: None
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def collect(self):
+        """
+        Returns the records since the last call and discards them.
+        :return: tuple<dict<phases>, dict<counters>> or None if the profiler is disabled
+        """
+        records = (self.phases, self.counters) if self.enabled else None
+        self.phases = {}
+        self.counters = {}
+        return records
+
+    def merge(self, records):
+        """
+        Adds records returned by collect(), eg. in another process.
+        :param records: tuple<dict<phases>, dict<counters>> or None
+        :return: None
+        """
+        if not records:
+            return
+        phases, counters = records
+        for name, (calls, wall, cpu) in phases.items():
+            self.add(name, wall, cpu, calls)
+        for name, n in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        Returns all records together with the total wall and CPU time since the profiler was enabled.
+        :return: dict
+        """
+        phases = OrderedDict()
+        for name in sorted(self.phases, key=lambda name: -self.phases[name][1]):
+            calls, wall, cpu = self.phases[name]
+            phases[name] = OrderedDict([('calls', calls), ('wall', wall), ('cpu', cpu)])
+        return OrderedDict([('command', sys.argv),
+                            ('wall', time.time() - self.startTime),
+                            ('cpu', cpuTime() - self.startCpu),
+                            ('phases', phases),
+                            ('counters', OrderedDict(sorted(self.counters.items())))])
+
+    def write(self, fileName):
+        """
+        Writes the report to a JSON file.
+        :param fileName: str
+        :return: None
+        """
+        with open(fileName, 'w') as fp:
+            json.dump(self.report(), fp, indent=2)
+
+    def __str__(self):
+        report = self.report()
+        lines = ['Profile: {wall:.3f}s wall, {cpu:.3f}s CPU'.format(**report),
+                 '   {:16} {:>8} {:>10} {:>10}'.format('Phase', 'Calls', 'Wall/s', 'CPU/s')]
+        lines += ['   {:16} {calls:8d} {wall:10.3f} {cpu:10.3f}'.format(name, **phase)
+                  for name, phase in report['phases'].items()]
+        if report['counters']:
+            lines.append('   {:16} {:>8}'.format('Counter', 'Calls'))
+            lines += ['   {:16} {:8d}'.format(name, n) for name, n in report['counters'].items()]
+        return '\n'.join(lines)
+
+
+PROFILER = Profiler()
+
+
+def initProfiler(enabled):
+    """
+    Process pool initializer enabling the profiler of a worker process if it is enabled in the parent process.
+    :param enabled: bool
+    :return: None
+    """
+    PROFILER.enable(enabled)
+
+
+class ProgressBar(object):
+    """
+    Progress bar written to stdout that is redrawn at most once per refresh interval. The fit and cell shown next to
+    the bar are only formatted when the bar is redrawn.
+    """
+    INTERVAL = .1
+
+    def __init__(self, length=20, prefix='', interval=None):
+        """
+        :param length: int<number of characters of the bar>
+        :param prefix: str<text written in front of the bar>
+        :param interval: float<minimum number of seconds between two redraws>. Defaults to ProgressBar.INTERVAL.
+        """
+        self.length = length
+        self.prefix = prefix
+        self.interval = ProgressBar.INTERVAL if interval is None else interval
+        self.lastTime = 0
+
+    def __call__(self, fraction, fit=None, cell=None, force=False):
+        """
+        Redraws the bar unless it was redrawn less than self.interval seconds ago.
+        :param fraction: float<progress between 0 and 1>
+        :param fit: float
+        :param cell: list of six floats
+        :param force: bool<redraw regardless of the refresh interval>
+        :return: bool<True if the bar was redrawn>
+        """
+        now = time.time()
+        if not force and now - self.lastTime < self.interval:
+            return False
+        self.lastTime = now
+        progress = int(self.length * fraction)
+        line = '\r' + self.prefix + '[' + progress * '#' + (self.length - progress) * '-' + ']'
+        if fit is not None:
+            line += ' {:8.6f} {}'.format(fit, ' '.join(['{:9.4f}'.format(p) for p in cell]))
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        return True
+
+
+class EventStream(object):
+    """
+    Writes the progress of optimization runs as one JSON object per line, so it can be followed with 'tail -f'. Each
+    event holds its name, the time stamp, the seconds since the stream was opened, the process id and the values given
+    to emit(). The module level instance EVENTS is closed by default, in which case emit() does nothing.
+    Lines are appended and flushed one at a time, so worker processes of a batch run can share the file.
+    """
+
+    def __init__(self):
+        self.fp = None
+        self.fileName = None
+        self.startTime = time.time()
+        self.context = OrderedDict()
+
+    def open(self, fileName, startTime=None):
+        """
+        Opens the stream.
+        :param fileName: str<name of the file the events are appended to>
+        :param startTime: float<time stamp the elapsed times refer to>. Defaults to now.
+        :return: None
+        """
+        self.close()
+        self.fileName = fileName
+        self.fp = open(fileName, 'a')
+        self.startTime = time.time() if startTime is None else startTime
+
+    def close(self):
+        """
+        Closes the stream.
+        :return: None
+        """
+        if self.fp:
+            self.fp.close()
+        self.fp = None
+        self.fileName = None
+
+    def emit(self, event, **values):
+        """
+        Writes an event.
+        :param event: str<name of the event, eg. 'start', 'improved', 'step', 'evaluation', 'finish' or 'error'>
+        :param values: values of the event. Cells are given as lists of six floats.
+        :return: None
+        """
+        if not self.fp:
+            return
+        now = time.time()
+        record = OrderedDict([('event', event), ('time', now), ('elapsed', now - self.startTime), ('pid', os.getpid())])
+        record.update(self.context)
+        record.update(sorted(values.items()))
+        self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+
+
+EVENTS = EventStream()
+
+
+SHELXLEXECUTABLES = ('shelxl.exe', 'shelxl')
+
+
+def shelxlCommands():
+    """
+    Returns the commands callShelxl() tries in turn, see there.
+    :return: list of lists of str
+    """
+    if os.environ.get('CELLOPT_SHELXL'):
+        return [shlex.split(os.environ['CELLOPT_SHELXL'], posix=os.name != 'nt')]
+    return [[executable] for executable in SHELXLEXECUTABLES]
+
 
 def callShelxl(fileName):
     """
-    Call SHELXL in a subprocess.
-    :param fileName: str
-    :return: None
+    Call SHELXL in a subprocess. SHELXL runs in the directory of the given file.
+    The command is taken from the environment variable CELLOPT_SHELXL if it is set, eg. to run shelxlemu.py instead of
+    SHELXL. Otherwise 'shelxl.exe' and 'shelxl' are searched on the PATH.
+    The console output of SHELXL is parsed while SHELXL is running. If it does not report the final wR2, the .lst file
+    written by SHELXL is parsed instead.
+    :param fileName: str
+    :return: ListingResult instance
+    """
+    directory, name = os.path.split(fileName)
+    parser = ListingParser()
+    for command in shelxlCommands():
+        try:
+            process = Popen(command + [name], stdout=PIPE, stderr=STDOUT, cwd=directory or None,
+                            universal_newlines=True)
+        except OSError:
+            continue
+        PROFILER.count('shelxl')
+        with PROFILER.phase('shelxl'):
+            parser.feed(process.stdout)
+            process.stdout.close()
+            process.wait()
+        break
+    if not parser.result.complete() and os.path.isfile(fileName + '.lst'):
+        return readListing(fileName + '.lst')
+    return parser.result
+
+
+def shelxlIdentity():
+    """
+    Identifies the SHELXL program that callShelxl() runs, so results of different SHELXL versions, or of SHELXL and
+    the emulator set by CELLOPT_SHELXL, are not mixed up.
+    :return: str<command, resolved path, size and modification time of the executable>
+    """
+    for command in shelxlCommands():
+        path = which(command[0]) if command else None
+        if path:
+            stat = os.stat(path)
+            return '{} {} {} {}'.format(' '.join(command), os.path.realpath(path), stat.st_size, stat.st_mtime)
+    return ' '.join(' '.join(command) for command in shelxlCommands())
+
+
+def formatListingErrors(fileName, listing, first=False):
+    """
+    Returns a report of the error messages of a failed refinement.
+    :param fileName: str
+    :param listing: ListingResult instance
+    :param first: bool<report only the first error message>
+    :return: str
+    """
+    lines = ['\n\n\nSomething went wrong while re-refining the structure.',
+             '\n\nError Messages from {}.lst file:'.format(fileName)]
+    lines += listing.errors[:1] if first else listing.errors
+    lines.append('\nExiting')
+    return '\n'.join(lines)
+
+
+def formatOverlaps(overlaps, maxPairs=10):
+    """
+    Returns a warning listing atoms that overlap after expansion to P1, see ShelxlMolecule.asP1().
+    :param overlaps: list of tuples<name1, name2, distance>
+    :param maxPairs: int<maximum number of pairs listed>
+    :return: str
+    """
+    lines = ['Warning: {} pairs of atoms overlap after expansion:'.format(len(overlaps))]
+    lines += ['   {:<12} {:<12} {:.3f} A'.format(*overlap) for overlap in overlaps[:maxPairs]]
+    if len(overlaps) > maxPairs:
+        lines.append('   ...')
+    return '\n'.join(lines)
+
+
+def evaluate(fileName, cache=None, molecule=None):
+    """
+    Call SHELXL and subsequently evaluate the result.
+    If a RefinementCache is given and holds the result of an identical refinement, SHELXL is not called and the cached
+    .res file is restored instead.
+    If a ShelxlMolecule instance is given, it is updated to the refined structure by ShelxlMolecule.reload().
+    A .res file left by an earlier refinement is removed first, so a refinement that fails without writing one raises a
+    CelloptError instead of silently reusing the old structure.
+    :param fileName: str
+    :param cache: RefinementCache instance
+    :param molecule: ShelxlMolecule instance
+    :return: float<wR2>, float<meanDfixFit>, float<weightedDfixFit>
+    """
+    key = None
+    if cache:
+        key = cache.key(fileName)
+        result = cache.get(key, fileName + '.res')
+        if result:
+            if molecule is not None:
+                molecule.reload(fileName + '.res')
+            return result
+    if os.path.isfile(fileName + '.res'):
+        os.remove(fileName + '.res')
+    listing = callShelxl(fileName)
+    wR2 = listing.wR2 if listing.complete() else 999
+    if not os.path.isfile(fileName + '.res'):
+        raise CelloptError(formatListingErrors(fileName, listing, first=True), 1)
+    with PROFILER.phase('reread'):
+        if molecule is None:
+            molecule = ShelxlReader().read(fileName + '.res')
+        else:
+            molecule.reload(fileName + '.res')
+    mean, weighted = None, None
+    try:
+        mean, weighted = molecule.checkDfix()
+    except ZeroDivisionError:
+        raise CelloptError(formatListingErrors(fileName, listing), 1)
+    except ValueError:
+        raise CelloptError(formatListingErrors(fileName, listing, first=True), 1)
+        # print('\n\n\nNo DFIX or DANG restraints found in structure.\n\nExiting')
+        # exit(2)
+    if cache and wR2 != 999:
+        cache.put(key, fileName + '.res', (wR2, mean, weighted))
+    return wR2, mean, weighted
+
+
+def evaluateJob(job):
+    """
+    Process pool wrapper of evaluate().
+    :param job: tuple<str<fileName>, RefinementCache instance or None>
+    :return: float<wR2>, float<meanDfixFit>, float<weightedDfixFit>, records of the profiler, see Profiler.collect()
+    """
+    fileName, cache = job
+    return evaluate(fileName, cache=cache) + (PROFILER.collect(),)
+
+
+class RefinementCache(object):
+    """
+    Persistent cache of SHELXL refinement results.
+    Entries are addressed by a hash of the instruction file content, a fingerprint of the reflection data and the
+    identity of the SHELXL executable, see shelxlIdentity(). Each entry consists of the resulting .res file and a
+    .json file holding wR2 and the DFIX fit. If the cache grows beyond maxSize bytes, the least recently used entries
+    are removed.
+    """
+    DEFAULTDIRECTORY = join(os.path.expanduser('~'), '.cellopt', 'cache')
+    # Running totals of the cache size in bytes by directory. Kept at class level, because the pool workers of
+    # accurate mode receive a new copy of the instance with every job.
+    sizes = {}
+
+    def __init__(self, directory=None, maxSize=1024 ** 3):
+        """
+        :param directory: str<cache directory>. Defaults to ~/.cellopt/cache
+        :param maxSize: int<maximum size of the cache in bytes>
+        """
+        self.directory = directory if directory else RefinementCache.DEFAULTDIRECTORY
+        self.maxSize = maxSize
+        self.fingerprints = {}
+        self.program = shelxlIdentity()
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+    def fingerprint(self, hklFileName):
+        """
+        Returns the SHA-1 digest of a reflection file. Digests are memorized per file, so linked copies of a
+        reflection file are only read once.
+        :param hklFileName: str
+        :return: str
+        """
+        stat = os.stat(hklFileName)
+        fileId = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+        try:
+            return self.fingerprints[fileId]
+        except KeyError:
+            pass
+        digest = sha1()
+        with open(hklFileName, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 ** 2), b''):
+                digest.update(chunk)
+        self.fingerprints[fileId] = digest.hexdigest()
+        return self.fingerprints[fileId]
+
+    def key(self, fileName):
+        """
+        Computes the cache key of a refinement.
+        :param fileName: str<Name of the refinement without extension. '.ins' and '.hkl' files must exist.>
+        :return: str
+        """
+        digest = sha1(self.program.encode())
+        digest.update(self.fingerprint(fileName + '.hkl').encode())
+        with open(fileName + '.ins', 'rb') as fp:
+            digest.update(fp.read())
+        return digest.hexdigest()
+
+    def get(self, key, resFileName):
+        """
+        Looks up a refinement. On a hit the cached .res file is copied to resFileName.
+        :param key: str
+        :param resFileName: str
+        :return: float<wR2>, float<meanDfixFit>, float<weightedDfixFit> or None
+        """
+        entry = join(self.directory, key)
+        try:
+            with open(entry + '.json', 'r') as fp:
+                data = json.load(fp)
+            copyfile(entry + '.res', resFileName)
+            os.utime(entry + '.json', None)
+        except (IOError, OSError, ValueError):
+            return None
+        return data['wR2'], data['mean'], data['weighted']
+
+    def put(self, key, resFileName, result):
+        """
+        Stores a refinement result.
+        :param key: str
+        :param resFileName: str<Name of the .res file written by SHELXL>
+        :param result: tuple<float<wR2>, float<meanDfixFit>, float<weightedDfixFit>>
+        :return: None
+        """
+        entry = join(self.directory, key)
+        temp = '{}.{}.tmp'.format(entry, os.getpid())
+        wR2, mean, weighted = result
+        copyfile(resFileName, temp)
+        os.replace(temp, entry + '.res')
+        with open(temp, 'w') as fp:
+            json.dump({'wR2': wR2, 'mean': mean, 'weighted': weighted}, fp)
+        os.replace(temp, entry + '.json')
+        directory = os.path.abspath(self.directory)
+        if directory in RefinementCache.sizes:
+            RefinementCache.sizes[directory] += os.path.getsize(entry + '.res') + os.path.getsize(entry + '.json')
+        if RefinementCache.sizes.get(directory, self.maxSize + 1) > self.maxSize:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is not larger than self.maxSize.
+        The directory is only scanned here. In between, put() keeps a running total of the cache size per process in
+        RefinementCache.sizes and calls evict() when it exceeds self.maxSize.
+        :return: None
+        """
+        entries = {}
+        total = 0
+        for name in os.listdir(self.directory):
+            key, extension = os.path.splitext(name)
+            if extension not in ('.res', '.json'):
+                continue
+            try:
+                stat = os.stat(join(self.directory, name))
+            except OSError:
+                continue
+            size, lastUse = entries.get(key, (0, 0))
+            if extension == '.json':
+                lastUse = stat.st_mtime
+            entries[key] = (size + stat.st_size, lastUse)
+            total += stat.st_size
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total <= self.maxSize:
+                break
+            for extension in ('.json', '.res'):
+                try:
+                    os.remove(join(self.directory, key + extension))
+                except OSError:
+                    pass
+            total -= entries[key][0]
+        RefinementCache.sizes[os.path.abspath(self.directory)] = total
+
+
+def linkFile(source, target):
+    """
+    Makes the content of a file available under another name. A hard link is tried first, then a symbolic link. The
+    file is copied if neither is supported.
+    :param source: str
+    :param target: str
+    :return: None
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except (OSError, AttributeError):
+        try:
+            os.symlink(os.path.abspath(source), target)
+        except (OSError, AttributeError, NotImplementedError):
+            copyfile(source, target)
+
+
+class Workspace(object):
+    """
+    Private scratch directory for the files of one optimization run.
+    The directory is created on /dev/shm if available. The reflection file is linked into the directory as
+    'work.hkl' instead of being copied. The directory is removed when the context is left.
+
+        with Workspace('structure.hkl') as workspace:
+            reader.write(fileName=workspace.path('work.ins'))
+            evaluate(workspace.path('work'))
+    """
+    DEFAULTROOT = '/dev/shm'
+
+    def __init__(self, hklFileName, root=None, keep=False):
+        """
+        :param hklFileName: str<Name of the reflection file>
+        :param root: str<directory the workspace is created in>. Defaults to /dev/shm or the system's temporary
+         directory.
+        :param keep: bool<do not remove the workspace on exit>
+        """
+        self.hklFileName = hklFileName
+        if root is None and os.path.isdir(Workspace.DEFAULTROOT) and os.access(Workspace.DEFAULTROOT, os.W_OK):
+            root = Workspace.DEFAULTROOT
+        self.root = root
+        self.keep = keep
+        self.directory = None
+
+    def __enter__(self):
+        self.directory = mkdtemp(prefix='cellopt_', dir=self.root)
+        linkFile(self.hklFileName, self.path('work.hkl'))
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def path(self, fileName):
+        """
+        Returns the path of a file in the workspace.
+        :param fileName: str
+        :return: str
+        """
+        return join(self.directory, fileName)
+
+    def close(self):
+        """
+        Removes the workspace unless it is kept.
+        :return: None
+        """
+        if self.directory is None:
+            return
+        if self.keep:
+            print('\nWorkspace kept at {}'.format(self.directory))
+        else:
+            rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+
+def quickEvaluate(molecule, cell):
+    """
+    Evaluates the DFIX fit to a given cell
+    :param molecule: ShelxlMolecule instance
+    :param cell: list of six floats
+    :return: float<meanDfixFit>, float<weightedDfixFit>
+    """
+    molecule.cell = cell
+    PROFILER.count('cells')
+    try:
+        with PROFILER.phase('quickEvaluate'):
+            return molecule.checkDfix()
+    except ValueError:
+        raise CelloptError('\n\n\nNo DFIX or DANG restraints found in structure.\n\nExiting', 2)
+
+
+def quickEvaluateJobs(molecule, jobs):
+    """
+    Evaluates the DFIX fit to a list of cells in one vectorized step.
+    :param molecule: ShelxlMolecule instance
+    :param jobs: list of cells, each a list of six floats
+    :return: list of tuple<float<meanDfixFit>, float<weightedDfixFit>>
+    """
+    PROFILER.count('cells', len(jobs))
+    try:
+        with PROFILER.phase('quickEvaluate'):
+            means, weighteds = molecule.checkDfixCells(jobs)
+    except ValueError:
+        raise CelloptError('\n\n\nNo DFIX or DANG restraints found in structure.\n\nExiting', 2)
+    return [(float(mean), float(weighted)) for mean, weighted in zip(means, weighteds)]
+
+
+class ShelxlEvaluator(object):
+    """
+    Scores candidate cells by refining the structure with SHELXL.
+    Calling an instance with a list of cells returns a list of (meanDfixFit, weightedDfixFit) tuples. The wR2 values
+    of the last call are stored in self.wR2s, the fits of the very first cell in self.initial.
+    Each cell is refined in its own set of files 'work<n>.*' in the given directory that share the data of
+    'work.hkl'. With more than one process the refinements run in parallel in a process pool.
+    """
+
+    def __init__(self, reader, prefix, processes=None, directory='.', cache=None):
+        """
+        :param reader: ShelxlReader instance used to write the instruction files
+        :param prefix: list of str<leading words of the CELL instruction, eg. ['CELL', '0.71073']>
+        :param processes: int<number of parallel SHELXL processes>. Defaults to the number of CPUs.
+        :param directory: str<directory containing 'work.hkl'>
+        :param cache: RefinementCache instance
+        """
+        self.reader = reader
+        self.directory = directory
+        self.cache = cache
+        if cache:
+            cache.fingerprint(join(directory, 'work.hkl'))
+        self.prefix = prefix
+        self.calls = 0
+        self.step = 0
+        self.wR2s = []
+        self.initial = None
+        self.processes = processes if processes else cpu_count()
+        self.pool = Pool(self.processes, initializer=initProfiler,
+                         initargs=(PROFILER.enabled,)) if self.processes > 1 else None
+        self.jobNames = []
+
+    def __call__(self, cells):
+        numJobs = len(cells)
+        names = [join(self.directory, 'work{}'.format(j)) for j in range(numJobs)]
+        for name, job in zip(names, cells):
+            newCell = self.prefix + ['{:7.4f}'.format(p) for p in job]
+            self.reader['cell'] = ' '.join(newCell) + '\n'
+            self.reader.write(fileName=name + '.ins')
+            if name not in self.jobNames:
+                linkFile(join(self.directory, 'work.hkl'), name + '.hkl')
+                self.jobNames.append(name)
+        jobs = [(name, self.cache) for name in names]
+        if self.pool:
+            evaluations = self.pool.imap(evaluateJob, jobs)
+        else:
+            evaluations = (evaluateJob(job) for job in jobs)
+        results = []
+        self.wR2s = []
+        bar = ProgressBar(60, prefix=' Step {:3} '.format(self.step + 1))
+        for j, evaluation in enumerate(evaluations):
+            bar((j + 1) / numJobs, force=j + 1 == numJobs)
+            wR2, mean, weighted, records = evaluation
+            PROFILER.merge(records)
+            EVENTS.emit('evaluation', step=self.step + 1, job=j, cell=[float(p) for p in cells[j]], wR2=wR2,
+                        fit=weighted)
+            self.calls += 1
+            self.wR2s.append(wR2)
+            results.append((mean, weighted))
+        if self.initial is None:
+            self.initial = results[0]
+        self.step += 1
+        return results
+
+    def close(self):
+        """
+        Shuts down the process pool and removes the files of the individual refinements.
+        :return: None
+        """
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+        for name in self.jobNames:
+            for extension in ('.ins', '.hkl', '.res', '.lst', '.fcf', '.cif'):
+                if os.path.lexists(name + extension):
+                    os.remove(name + extension)
+        self.jobNames = []
+
+
+def metricCoefficients(cells):
+    """
+    Computes the cell dependent coefficients of the squared distance expression for a number of cells. Multiplying
+    the coefficients with the restraint moments of ShelxlMolecule.getDfixMoments() yields the squared distances.
+    :param cells: list of cells, each a list of six floats
+    :return: numpy.ndarray of shape (len(cells), 6)
+    """
+    cells = np.atleast_2d(np.asarray(cells, dtype=float))
+    a, b, c = cells[:, 0], cells[:, 1], cells[:, 2]
+    alpha, beta, gamma = np.radians(cells[:, 3:6]).T
+    return np.column_stack((a * a, b * b, c * c,
+                            2 * b * c * np.cos(alpha),
+                            2 * a * c * np.cos(beta),
+                            2 * a * b * np.cos(gamma)))
+
+
+def findCloseContacts(fracs, cell, cutoff):
+    """
+    Finds all pairs of positions that are closer than cutoff with a cell list. The unit cell is divided into bins that
+    are at least cutoff wide perpendicular to each pair of cell axes, so only positions in neighbouring bins need to
+    be compared. Bins are made wider if there would be more than eight bins per position. Periodic boundaries are
+    taken into account and the shortest lattice translation is used for each pair. The cost grows linearly with the
+    number of positions.
+    :param fracs: numpy.ndarray of shape (n, 3)<fractional coordinates>
+    :param cell: list of six floats
+    :param cutoff: float<distance in Angstrom>
+    :return: (numpy.ndarray<i>, numpy.ndarray<j>, numpy.ndarray<distances>). Each pair is reported once with i < j.
+    """
+    fracs = np.asarray(fracs, dtype=float).reshape(-1, 3) % 1
+    if not len(fracs):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    g = metricCoefficients(cell)[0]
+    metric = np.array([[g[0], g[5] / 2, g[4] / 2],
+                       [g[5] / 2, g[1], g[3] / 2],
+                       [g[4] / 2, g[3] / 2, g[2]]])
+    widths = 1 / np.sqrt(np.diag(np.linalg.inv(metric)))
+    numBins = widths / cutoff
+    numBins /= max(1., (np.prod(numBins) / (8. * len(fracs))) ** (1 / 3.))
+    numBins = np.maximum(numBins.astype(np.int64), 1)
+    bins = np.minimum((fracs * numBins).astype(np.int64), numBins - 1)
+    binIds = (bins[:, 0] * numBins[1] + bins[:, 1]) * numBins[2] + bins[:, 2]
+    order = np.argsort(binIds, kind='mergesort')
+    counts = np.bincount(binIds, minlength=np.prod(numBins))
+    starts = np.cumsum(counts) - counts
+    offsets = [[0] if n == 1 else [0, 1] if n == 2 else [-1, 0, 1] for n in numBins]
+    firsts = []
+    seconds = []
+    for ox in offsets[0]:
+        for oy in offsets[1]:
+            for oz in offsets[2]:
+                neighbours = (bins + (ox, oy, oz)) % numBins
+                neighbourIds = (neighbours[:, 0] * numBins[1] + neighbours[:, 1]) * numBins[2] + neighbours[:, 2]
+                pointCounts = counts[neighbourIds]
+                ends = np.cumsum(pointCounts)
+                members = (np.arange(ends[-1]) - np.repeat(ends - pointCounts, pointCounts) +
+                           np.repeat(starts[neighbourIds], pointCounts))
+                first = np.repeat(np.arange(len(fracs)), pointCounts)
+                second = order[members]
+                mask = first < second
+                firsts.append(first[mask])
+                seconds.append(second[mask])
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    dx, dy, dz = ((fracs[second] - fracs[first] + 99.5) % 1 - 0.5).T
+    distances = np.sqrt(g[0] * dx * dx + g[1] * dy * dy + g[2] * dz * dz + g[3] * dy * dz + g[4] * dx * dz +
+                        g[5] * dx * dy)
+    mask = distances < cutoff
+    return first[mask], second[mask], distances[mask]
+
+
+def metricDerivatives(cell):
+    """
+    Computes the derivatives of the coefficients returned by metricCoefficients() with respect to the cell
+    parameters. Angles are given in degrees.
+    :param cell: list of six floats
+    :return: numpy.ndarray of shape (6, 6). Row i holds the derivatives with respect to cell parameter i.
+    """
+    a, b, c = [float(x) for x in cell[:3]]
+    alpha, beta, gamma = np.radians([float(x) for x in cell[3:6]])
+    rad = np.pi / 180.
+    return np.array([[2 * a, 0, 0, 0, 2 * c * np.cos(beta), 2 * b * np.cos(gamma)],
+                     [0, 2 * b, 0, 2 * c * np.cos(alpha), 0, 2 * a * np.cos(gamma)],
+                     [0, 0, 2 * c, 2 * b * np.cos(alpha), 2 * a * np.cos(beta), 0],
+                     [0, 0, 0, -2 * b * c * np.sin(alpha) * rad, 0, 0],
+                     [0, 0, 0, 0, -2 * a * c * np.sin(beta) * rad, 0],
+                     [0, 0, 0, 0, 0, -2 * a * b * np.sin(gamma) * rad]])
+
+
+def constrainCell(params, cell):
     """
-    FNULL = open(os.devnull, 'w')
-    try:
-        call(['shelxl.exe', fileName], stdout=FNULL, stderr=STDOUT)
-    except:
-        call(['shelxl', fileName], stdout=FNULL, stderr=STDOUT)
+    Applies the constraints of a crystal class to a cell.
+    :param params: tuple<constraints>
+    :param cell: list of six floats
+    :return: list of six floats
+    """
+    cell = [float(x) for x in cell]
+    for source, targets in params[1].items():
+        for target in targets:
+            cell[target] = cell[source]
+    return cell
 
 
-def evaluate(fileName):
+def refineLsq(molecule, cell, params, maxIterations=100, tolerance=1e-12):
     """
-    Call SHELXL and subsequently evaluate the result.
-    :param fileName: str
-    :return: float<wR2>, float<meanDfixFit>, float<weightedDfixFit>
+    Refine the cell parameters against the weighted DFIX/DANG residuals with the Levenberg-Marquardt algorithm.
+    The derivatives of the restrained distances with respect to the cell parameters are computed analytically.
+    Only the parameters refined for the given crystal class are varied, constrained parameters follow their source.
+    :param molecule: ShelxlMolecule instance
+    :param cell: list of six floats
+    :param params: tuple<constraints>
+    :param maxIterations: int
+    :param tolerance: float<relative change of the sum of squared residuals below which refinement stops>
+    :return: list of six floats<refined cell>, int<number of iterations>, int<number of residual evaluations>
     """
-    callShelxl(fileName)
-    wR2 = 999
-    with open('work.lst', 'r') as fp:
-        for line in fp.readlines():
-            if 'for all data' in line:
-                line = [word for word in line.split() if line]
-                wR2 = float(line[2][:-1])
-                break
-    reader = ShelxlReader()
-    molecule = reader.read(fileName + '.res')
-    mean, weighted = None, None
-    try:
-        mean, weighted = molecule.checkDfix()
-    except ZeroDivisionError:
-        print('\n\n\nSomething went wrong while re-refining the structure.')
-        print('\n\nError Messages from work.lst file:')
-        with open('work.lst', 'r') as fp:
-            for line in fp.readlines():
-                if '**' in line:
-                    print(line[:-1])
-        print('\nExiting')
-        exit(1)
-    except ValueError:
-        print('\n\n\nSomething went wrong while re-refining the structure.')
-        print('\n\nError Messages from work.lst file:')
-        with open('work.lst', 'r') as fp:
-            for line in fp.readlines():
-                if '**' in line:
-                    print(line[:-1])
+    moments = molecule.getDfixMoments()
+    if not len(moments):
+        raise ZeroDivisionError('No restrained atom pairs found.')
+    refine = list(params[0])
+    conDict = params[1]
+    targets = moments[:, 6]
+    sqrtWeights = np.sqrt(moments[:, 7])
+
+    def residuals(c):
+        with np.errstate(invalid='ignore'):
+            d = np.sqrt(moments[:, :6].dot(metricCoefficients(c)[0]))
+        return sqrtWeights * (d - targets), d
+
+    cell = constrainCell(params, cell)
+    r, d = residuals(cell)
+    evaluations = 1
+    chi2 = r.dot(r)
+    damping = 1e-3
+    iteration = 0
+    for iteration in range(1, maxIterations + 1):
+        jac = moments[:, :6].dot(metricDerivatives(cell).T)
+        jac *= (sqrtWeights / (2 * np.maximum(d, 1e-12)))[:, None]
+        for source, conTargets in conDict.items():
+            jac[:, source] += jac[:, list(conTargets)].sum(axis=1)
+        jac = jac[:, refine]
+        normal = jac.T.dot(jac)
+        gradient = jac.T.dot(r)
+        scale = np.diag(np.maximum(np.diag(normal), 1e-12))
+        while True:
+            try:
+                step = np.linalg.solve(normal + damping * scale, -gradient)
+            except np.linalg.LinAlgError:
+                step = None
+            if step is not None:
+                newCell = cell[:]
+                for p, delta in zip(refine, step):
+                    newCell[p] += delta
+                newCell = constrainCell(params, newCell)
+                newR, newD = residuals(newCell)
+                evaluations += 1
+                newChi2 = newR.dot(newR)
+                if newChi2 <= chi2:
                     break
-        print('\nExiting')
-        exit(1)
-        # print('\n\n\nNo DFIX or DANG restraints found in structure.\n\nExiting')
-        # exit(2)
-    return wR2, mean, weighted
+            damping *= 10
+            if damping > 1e10:
+                return cell, iteration, evaluations
+        damping = max(damping / 10, 1e-12)
+        converged = chi2 - newChi2 <= tolerance * chi2
+        cell, r, d, chi2 = newCell, newR, newD, newChi2
+        if converged:
+            break
+    return cell, iteration, evaluations
 
 
-def quickEvaluate(molecule, cell):
+def solveMetric(molecule, cls):
     """
-    Evaluates the DFIX fit to a given cell
+    Computes the cell that fits the restrained distances best without any search. Squared distances are linear in
+    the components of the metric tensor, so the metric tensor is determined by one weighted linear least-squares
+    solve. Each restraint is scaled by 1/(2*target) to make its squared residual comparable to the distance residual.
     :param molecule: ShelxlMolecule instance
-    :param cell: list of six floats
-    :return: float<meanDfixFit>, float<weightedDfixFit>
+    :param cls: str<name of crystal class>
+    :return: list of six floats
     """
-    molecule.cell = cell
-    try:
-        return molecule.checkDfix()
-    except ValueError:
-        print('\n\n\nNo DFIX or DANG restraints found in structure.\n\nExiting')
-        exit(2)
+    moments = molecule.getDfixMoments()
+    if not len(moments):
+        raise ZeroDivisionError('No restrained atom pairs found.')
+    basis = np.array(METRICCONSTRAINTS[cls], dtype=float).T
+    targets = moments[:, 6]
+    scale = np.sqrt(moments[:, 7]) / (2 * targets)
+    design = moments[:, :6].dot(basis) * scale[:, None]
+    solution = np.linalg.lstsq(design, targets ** 2 * scale, rcond=None)[0]
+    return metricToCell(basis.dot(solution))
+
+
+def metricToCell(coefficients):
+    """
+    Converts metric coefficients as returned by metricCoefficients() back to cell parameters.
+    :param coefficients: list of six floats
+    :return: list of six floats
+    """
+    g11, g22, g33, g23, g13, g12 = [float(x) for x in coefficients]
+    if min(g11, g22, g33) <= 0:
+        raise ValueError('Metric tensor is not positive definite.')
+    a, b, c = g11 ** .5, g22 ** .5, g33 ** .5
+    alpha, beta, gamma = np.degrees(np.arccos(np.clip([g23 / (2 * b * c), g13 / (2 * a * c), g12 / (2 * a * b)],
+                                                      -1, 1)))
+    return [a, b, c, float(alpha), float(beta), float(gamma)]
 
 
 def determineCrystalClass(cell):
@@ -128,7 +1140,7 @@ def generateJobs(params, cell, delta):
     :param delta: float
     :return: list of new cells
     """
-    data = [float(x) for x in cell[2:]]
+    data = [float(x) for x in cell]
     jobs = [data]
     refine, conDict = params
     for p in params[0]:
@@ -148,257 +1160,772 @@ def generateJobs(params, cell, delta):
     return jobs
 
 
-def run(fileName, p1=False, overrideClass=None, fast=False, plot=False):
+class Optimizer(object):
+    """
+    Base class for optimizer backends.
+    A backend minimizes the DFIX fit of a molecule with respect to the cell parameters refined for a crystal class.
+    Candidate cells are scored by 'evaluator', a callable mapping a list of cells to a list of
+    (meanDfixFit, weightedDfixFit) tuples. By default the cells are scored against the restraint moments of the
+    molecule. Backends with USESEVALUATOR set to False work on the restraint moments directly and can not be used
+    with another evaluator.
+    The attributes below are the default settings. Each can be overridden by a keyword argument of the same name.
+    Backends ignore settings that do not apply to them.
+    """
+    NAME = None
+    USESEVALUATOR = True
+    step = .1
+    minStep = .002
+    patience = 10
+    maxSteps = 250
+    objective = 0
+    stepCallback = None
+
+    def __init__(self, molecule, params, cls, evaluator=None, **settings):
+        self.molecule = molecule
+        self.params = params
+        self.cls = cls
+        self.evaluator = evaluator
+        self.evaluations = 0
+        self.terminationReason = None
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise TypeError('Unknown optimizer setting {}.'.format(key))
+            setattr(self, key, value)
+
+    def evaluate(self, cells):
+        """
+        Scores a list of cells.
+        :param cells: list of cells, each a list of six floats
+        :return: list of tuple<float<meanDfixFit>, float<weightedDfixFit>>
+        """
+        self.evaluations += len(cells)
+        if self.evaluator:
+            return self.evaluator(cells)
+        return quickEvaluateJobs(self.molecule, cells)
+
+    def optimize(self, cell, callback=None):
+        """
+        Optimize the cell parameters.
+        :param cell: list of six floats<starting cell>
+        :param callback: callable(cell, fit) called whenever a better cell was found
+        :return: list of six floats<best cell>, float<fit of best cell>
+        """
+        raise NotImplementedError
+
+
+class PatternSearch(Optimizer):
+    """
+    Coordinate pattern search. Each step evaluates the current cell and the cells obtained by incrementing and
+    decrementing each refined parameter by the step size. The step size is halved whenever no improvement is found.
+    'stepCallback' is called after each step as stepCallback(step, oldCell, newCell, fit, bestJob).
+    """
+    NAME = 'pattern'
+
+    def optimize(self, cell, callback=None):
+        cell = [float(x) for x in cell]
+        delta = self.step
+        lastImprovement = 0
+        bestFit = None
+        self.terminationReason = 'maxSteps'
+        for i in range(self.maxSteps):
+            bestFit = 9999
+            best = 0
+            jobs = generateJobs(self.params, cell, delta)
+            for j, (job, fits) in enumerate(zip(jobs, self.evaluate(jobs))):
+                if fits[self.objective] < bestFit:
+                    bestFit = fits[self.objective]
+                    best = j
+                    if callback:
+                        callback(job, bestFit)
+            oldCell = cell
+            cell = [float('{:7.4f}'.format(p)) for p in jobs[best]]
+            if self.stepCallback:
+                self.stepCallback(i, oldCell, cell, bestFit, best)
+            if best == 0:
+                delta = delta / 2
+                if delta < self.minStep:
+                    self.terminationReason = 'converged'
+                    break
+                if i - lastImprovement > self.patience:
+                    self.terminationReason = 'stalled'
+                    break
+            else:
+                lastImprovement = i
+        return cell, bestFit
+
+
+class NelderMead(Optimizer):
+    """
+    Nelder-Mead downhill simplex in the space of the refined cell parameters. The initial simplex extends 'step' along
+    each parameter. The search stops when the simplex is smaller than 'minStep' or the best vertex did not improve
+    for 'patience' iterations.
+    """
+    NAME = 'neldermead'
+    minStep = 1e-4
+    patience = 50
+    maxSteps = 1000
+
+    def optimize(self, cell, callback=None):
+        refine = list(self.params[0])
+        start = constrainCell(self.params, cell)
+
+        def expand(x):
+            c = start[:]
+            for p, value in zip(refine, x):
+                c[p] = float(value)
+            return constrainCell(self.params, c)
+
+        def score(points):
+            return [fits[self.objective] for fits in self.evaluate([expand(x) for x in points])]
+
+        x0 = np.array([start[p] for p in refine])
+        simplex = [x0] + [x0 + self.step * axis for axis in np.eye(len(refine))]
+        fits = score(simplex)
+        bestFit = None
+        lastImprovement = 0
+        self.terminationReason = 'maxSteps'
+        for i in range(self.maxSteps):
+            order = np.argsort(fits)
+            simplex = [simplex[k] for k in order]
+            fits = [fits[k] for k in order]
+            if bestFit is None or fits[0] < bestFit:
+                bestFit = fits[0]
+                lastImprovement = i
+                if callback:
+                    callback(expand(simplex[0]), bestFit)
+            if max(np.abs(x - simplex[0]).max() for x in simplex[1:]) < self.minStep:
+                self.terminationReason = 'converged'
+                break
+            if i - lastImprovement > self.patience:
+                self.terminationReason = 'stalled'
+                break
+            centroid = np.mean(simplex[:-1], axis=0)
+            reflected = 2 * centroid - simplex[-1]
+            reflectedFit, = score([reflected])
+            if fits[0] <= reflectedFit < fits[-2]:
+                simplex[-1], fits[-1] = reflected, reflectedFit
+                continue
+            if reflectedFit < fits[0]:
+                expanded = 3 * centroid - 2 * simplex[-1]
+                expandedFit, = score([expanded])
+                if expandedFit < reflectedFit:
+                    simplex[-1], fits[-1] = expanded, expandedFit
+                else:
+                    simplex[-1], fits[-1] = reflected, reflectedFit
+                continue
+            contracted = (centroid + simplex[-1]) / 2
+            contractedFit, = score([contracted])
+            if contractedFit < fits[-1]:
+                simplex[-1], fits[-1] = contracted, contractedFit
+                continue
+            simplex = [simplex[0]] + [(simplex[0] + x) / 2 for x in simplex[1:]]
+            fits = fits[:1] + score(simplex[1:])
+        best = int(np.argmin(fits))
+        return expand(simplex[best]), fits[best]
+
+
+class LevenbergMarquardt(Optimizer):
+    """
+    Levenberg-Marquardt refinement of the weighted restraint residuals. See refineLsq().
+    """
+    NAME = 'lsq'
+    USESEVALUATOR = False
+    maxSteps = 100
+
+    def optimize(self, cell, callback=None):
+        cell, iterations, evaluations = refineLsq(self.molecule, cell, self.params, maxIterations=self.maxSteps)
+        self.evaluations += evaluations
+        self.terminationReason = 'maxSteps' if iterations >= self.maxSteps else 'converged'
+        fit = self.evaluate([cell])[0][self.objective]
+        if callback:
+            callback(cell, fit)
+        return cell, fit
+
+
+class DirectSolve(Optimizer):
+    """
+    Linear least-squares fit of the metric tensor. See solveMetric().
+    """
+    NAME = 'direct'
+    USESEVALUATOR = False
+
+    def optimize(self, cell, callback=None):
+        cell = solveMetric(self.molecule, self.cls)
+        self.terminationReason = 'converged'
+        fit = self.evaluate([cell])[0][self.objective]
+        if callback:
+            callback(cell, fit)
+        return cell, fit
+
+
+OPTIMIZERS = OrderedDict((backend.NAME, backend) for backend in (PatternSearch, NelderMead, LevenbergMarquardt,
+                                                                 DirectSolve))
+
+
+MULTISTARTSTATE = {}
+
+
+def perturbCells(cell, params, starts, spread=.02, seed=0):
+    """
+    Generates starting cells for multiStart(). The first cell is the given cell. The refined parameters of the
+    others are scaled by random factors between 1 - spread and 1 + spread.
+    :param cell: list of six floats
+    :param params: tuple<constraints>
+    :param starts: int<number of cells>
+    :param spread: float<relative perturbation>
+    :param seed: int<seed of the random perturbations>
+    :return: list of cells
+    """
+    random = np.random.RandomState(seed)
+    cells = [constrainCell(params, cell)]
+    for _ in range(starts - 1):
+        perturbed = [float(x) for x in cell]
+        for p in params[0]:
+            perturbed[p] *= 1 + random.uniform(-spread, spread)
+        cells.append(constrainCell(params, perturbed))
+    return cells
+
+
+def initMultiStart(molecule, profile=None):
+    """
+    Process pool initializer of multiStart(). Keeps the restraint data shared by all starts of a worker process.
+    :param molecule: ShelxlMolecule instance, see ShelxlMolecule.stripped()
+    :param profile: bool<enable the profiler of a worker process>. None leaves the profiler unchanged.
+    :return: None
+    """
+    MULTISTARTSTATE['molecule'] = molecule
+    if profile is not None:
+        PROFILER.enable(profile)
+
+
+def multiStartJob(job):
+    """
+    Process pool wrapper of Optimizer.optimize() used by multiStart().
+    :param job: tuple<str<optimizer>, tuple<constraints>, str<crystal class>, list of six floats<starting cell>>
+    :return: tuple<list of six floats<cell>, float<fit>, int<evaluations>, str<termination reason>, records of the
+     profiler, see Profiler.collect()>
+    """
+    optimizer, params, cls, cell = job
+    backend = OPTIMIZERS[optimizer](MULTISTARTSTATE['molecule'], params, cls)
+    cell, fit = backend.optimize(cell)
+    return [float(x) for x in cell], float(fit), backend.evaluations, backend.terminationReason, PROFILER.collect()
+
+
+def multiStart(molecule, params, cls, cell, starts, optimizer='pattern', processes=None, spread=.02, seed=0):
+    """
+    Runs an optimizer backend from a number of starting cells in a process pool and keeps the best result. The
+    starting cells are generated by perturbCells(). Each worker process receives the restraint moments once when it
+    is started.
+    The returned report holds the fits of all starts, the number of starts that reached the best fit within one
+    percent and the standard deviation of the optimal cells.
+    :param molecule: ShelxlMolecule instance
+    :param params: tuple<constraints>
+    :param cls: str<crystal class>
+    :param cell: list of six floats<starting cell>
+    :param starts: int<number of starts>
+    :param optimizer: str<name of the optimizer backend in OPTIMIZERS>
+    :param processes: int<number of worker processes>. Defaults to the number of CPUs.
+    :param spread: float<relative perturbation of the starting cells>
+    :param seed: int<seed of the random perturbations>
+    :return: list of six floats<best cell>, float<best fit>, dict<report>
+    """
+    shared = molecule.stripped()
+    jobs = [(optimizer, params, cls, start) for start in perturbCells(cell, params, starts, spread=spread, seed=seed)]
+    processes = min(processes if processes else cpu_count(), len(jobs))
+    if processes > 1:
+        pool = Pool(processes, initializer=initMultiStart, initargs=(shared, PROFILER.enabled))
+        try:
+            results = pool.map(multiStartJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        initMultiStart(shared)
+        results = [multiStartJob(job) for job in jobs]
+    for result in results:
+        PROFILER.merge(result[4])
+    cells = np.array([result[0] for result in results])
+    fits = np.array([result[1] for result in results])
+    best = int(np.argmin(fits))
+    report = {'starts': len(results),
+              'bestStart': best,
+              'fits': fits.tolist(),
+              'converged': int((fits <= fits[best] * 1.01 + 1e-9).sum()),
+              'cellSpread': cells.std(axis=0).tolist(),
+              'evaluations': sum(result[2] for result in results)}
+    return cells[best].tolist(), float(fits[best]), report
+
+
+def formatMultiStart(report):
+    """
+    Returns a summary of a multi-start optimization.
+    :param report: dict<report returned by multiStart()>
+    :return: str
+    """
+    fits = report['fits']
+    lines = ['{converged} of {starts} starts reached the best fit {best:8.6f} (start {bestStart}). Fits range from '
+             '{minimum:8.6f} to {maximum:8.6f}.'.format(best=min(fits), minimum=min(fits), maximum=max(fits), **report),
+             'Standard deviation of the optimal cells: ' + ' '.join(['{}={:.4f}'.format(JDICT[j], s) for j, s in
+                                                                     enumerate(report['cellSpread'])])]
+    return '\n'.join(lines)
+
+
+def run(fileName, p1=False, overrideClass=None, fast=False, plot=False, optimizer='pattern', warmStart=False,
+        scratch=None, keep=False, cache=None, starts=1, spread=.02, processes=None, trajectory=None, every=1):
     """
     Run the optimizer in 'fast' or 'default' mode.
     :param fileName: str<Name of the starting parameter shelxl.res file>
     :param p1: bool<Expand structure to P1/P-1>
     :param overrideClass: str<name of crystal class>
     :param fast: bool<use fast optimization scheme>
-    :param plot: bool<plot diagnostics plot.>
-    :return: None
+    :param plot: bool<render the trajectory to a .png file, see renderTrajectory()>
+    :param optimizer: str<name of the optimizer backend in OPTIMIZERS>
+    :param warmStart: bool<start from the cell computed by solveMetric()>
+    :param scratch: str<directory the workspace is created in>
+    :param keep: bool<keep the workspace>
+    :param cache: RefinementCache instance
+    :param starts: int<number of starting cells of each optimizer run, see multiStart()>
+    :param spread: float<relative perturbation of the starting cells>
+    :param processes: int<number of parallel starts>. Defaults to the number of CPUs.
+    :param trajectory: str<name of the .npy file the trajectory is recorded to> or True, see openTrajectory()
+    :param every: int<keep every n-th sample of the trajectory>
+    :return: dict<summary of the run>
+    """
+    resFileName = fileName + '.res'
+    with Workspace(fileName + '.hkl', root=scratch, keep=keep) as workspace:
+        reader = ShelxlReader()
+        molecule = reader.read(resFileName)
+        cell = reader['cell'].split()
+
+        cls, params = determineCrystalClass(cell)
+        if overrideClass:
+            cls = overrideClass
+            params = CLASSPARAMETERS[cls]
+        print('Crystal Class is {}.'.format(cls))
+        if p1:
+            if '-' in reader['latt']:
+                print('Expanding to P1.')
+            else:
+                print('Expanding to P-1.')
+            reader.toP1()
+            molecule = reader.molecule
+            if molecule.overlaps:
+                print(formatOverlaps(molecule.overlaps))
+            cls = 'triclinic'
+            params = CLASSPARAMETERS[cls]
+        originalCell = [float(x) for x in cell[2:]]
+        startDiff = 999
+        try:
+            startDiff, _ = molecule.checkDfix()
+        except ValueError:
+            raise CelloptError('\nNo DFIX or DANG restraints found in structure.\n\nExiting', 2)
+        startDiff0 = startDiff
+        if warmStart:
+            cell = cell[:2] + ['{:7.4f}'.format(p) for p in solveMetric(molecule, cls)]
+
+        iterations = 25
+        recorder = openTrajectory(fileName, trajectory=trajectory, plot=plot, every=every)
+        refined = ShelxlMolecule()
+        wR2 = None
+        report = None
+
+        i = -1
+        barLengths = 20
+        bar = ProgressBar(barLengths, prefix=' ')
+        EVENTS.emit('start', mode='fast' if fast else 'default', crystalClass=cls, cell=originalCell, fit=startDiff0)
+
+        def improved(job, fit):
+            if recorder:
+                recorder(i, job, fit)
+            if bar(i / iterations, fit, job):
+                EVENTS.emit('improved', step=i, cell=[float(p) for p in job], fit=fit)
+
+        print('  ' + (barLengths - 8) // 2 * '-' + 'Progress' + (
+                    barLengths - 8) // 2 * '-' + '  ---Fit--   ---a---   ---b---   ---c---   -alpha-   --beta-   -gamma-')
+        bar((i + 1) / iterations, force=True)
+        for i in range(iterations):
+            if recorder:
+                recorder(i + 1, cell[2:], startDiff)
+            i += 1
+            if starts > 1:
+                job, sbestW, report = multiStart(molecule, params, cls, [float(x) for x in cell[2:]], starts,
+                                                 optimizer=optimizer, processes=processes, spread=spread)
+                improved(job, sbestW)
+            else:
+                backend = OPTIMIZERS[optimizer](molecule, params, cls)
+                job, sbestW = backend.optimize([float(x) for x in cell[2:]], callback=improved)
+            weighted = sbestW
+            cell = cell[:2] + ['{:7.4f}'.format(p) for p in job]
+            if not fast:
+                newCell = ' '.join(cell) + '\n'
+                reader['cell'] = newCell
+                reader.write(fileName=workspace.path('work.ins'))
+                wR2, mean, weighted = evaluate(workspace.path('work'), cache=cache, molecule=refined)
+                molecule = refined
+                bar(i / iterations, weighted, job, force=True)
+                EVENTS.emit('step', step=i, cell=[float(p) for p in job], fit=weighted, wR2=wR2)
+            else:
+                bar(1, weighted, job, force=True)
+                EVENTS.emit('step', step=i, cell=[float(p) for p in job], fit=weighted, wR2=wR2)
+                break
+            startDiff = sbestW
+        print()
+        print('\n\nOriginal Cell:', cell2String(originalCell, offset=15))
+        print()
+        print('   Final Cell:', cell2String(cell[2:], offset=15))
+
+        print('\nOriginal DFIX fit: {:8.6f}'.format(startDiff0))
+        print('   Final DFIX fit: {:8.6f}'.format(sbestW))
+        if report:
+            print()
+            print(formatMultiStart(report))
+        EVENTS.emit('finish', cell=[float(x) for x in cell[2:]], startFit=startDiff0, fit=sbestW, wR2=wR2)
+        closeTrajectory(recorder, plot=plot)
+    return {'structure': fileName,
+            'class': cls,
+            'originalCell': originalCell,
+            'cell': [float(x) for x in cell[2:]],
+            'startFit': startDiff0,
+            'fit': sbestW,
+            'wR2': wR2,
+            'multiStart': report}
+
+
+def run2(fileName, p1=False, overrideClass=None, warmStart=False, optimizer='pattern', processes=None, scratch=None,
+         keep=False, cache=None, plot=False, trajectory=None, every=1):
+    """
+    Run the optimizer in 'accurate' mode.
+    :param fileName: str<Name of the starting parameter shelxl.res file>
+    :param p1: bool<Expand structure to P1/P-1>
+    :param overrideClass: str<name of crystal class>
+    :param warmStart: bool<start from the cell computed by solveMetric()>
+    :param optimizer: str<name of the optimizer backend in OPTIMIZERS>
+    :param processes: int<number of parallel SHELXL processes>. Defaults to the number of CPUs.
+    :param scratch: str<directory the workspace is created in>
+    :param keep: bool<keep the workspace>
+    :param cache: RefinementCache instance
+    :param plot: bool<render the trajectory to a .png file, see renderTrajectory()>
+    :param trajectory: str<name of the .npy file the trajectory is recorded to> or True, see openTrajectory()
+    :param every: int<keep every n-th sample of the trajectory>
+    :return: dict<summary of the run>
     """
-    plotter = Plotter()
+    if not OPTIMIZERS[optimizer].USESEVALUATOR:
+        raise CelloptError('The {} optimizer can not be used in accurate mode.\n\nExiting'.format(optimizer), 6)
     resFileName = fileName + '.res'
-    fileDir = dirname(resFileName)
-    copyfile(join(fileDir, fileName + '.hkl'), './work.hkl')
-    reader = ShelxlReader()
-    molecule = reader.read(resFileName)
-    cell = reader['cell'].split()
-
-    cls, params = determineCrystalClass(cell)
-    if overrideClass:
-        cls = overrideClass
-        params = CLASSPARAMETERS[cls]
-    print('Crystal Class is {}.'.format(cls))
-    if p1:
-        if '-' in reader['latt']:
+    with Workspace(fileName + '.hkl', root=scratch, keep=keep) as workspace:
+        reader = ShelxlReader()
+        molecule = reader.read(resFileName)
+        cell = reader['cell'].split()
+        cls, params = determineCrystalClass(cell)
+        if overrideClass:
+            cls = overrideClass
+            params = CLASSPARAMETERS[cls]
+        print('Crystal Class is {}.'.format(cls))
+        if p1:
             print('Expanding to P1.')
-        else:
-            print('Expanding to P-1.')
-        reader.toP1()
-        cls = 'triclinic'
-        params = CLASSPARAMETERS[cls]
-    originalCell = [float(x) for x in cell[2:]]
-    startDiff = 999
-    try:
-        startDiff, _ = molecule.checkDfix()
-    except ValueError:
-        print('\nNo DFIX or DANG restraints found in structure.\n\nExiting')
-        exit(2)
-    startDiff0 = startDiff
-    lastDiff = 9999
-
-    iterations = 25
-
-    i = -1
-    barLengths = 20
-
-    print('  ' + (barLengths - 8) // 2 * '-' + 'Progress' + (
-                barLengths - 8) // 2 * '-' + '  ---Fit--   ---a---   ---b---   ---c---   -alpha-   --beta-   -gamma-')
-    progress = (i + 1) / iterations
-    progress = int(barLengths * progress)
-    sys.stdout.write(
-        '\r [' + progress * '#' + (barLengths - progress) * '-' + ']')
-    sys.stdout.flush()
-    for i in range(iterations):
-        plotter(a=float(cell[2]), b=float(cell[3]), c=float(cell[4]), alpha=float(cell[5]), beta=float(cell[6]),
-                gamma=float(cell[7]), fit=startDiff*100)
-        i += 1
-        sdelta = .1
-        slastImprovement = 0
-        for ii in range(250):
-            sbestW = lastDiff
-            sbestWj = 0
-            jobs = generateJobs(params, cell, sdelta)
-            for j, job in enumerate(jobs):
-                weighted, mean = quickEvaluate(molecule, job)
-                if weighted < sbestW:
-                    sbestW = weighted
-                    sbestWj = j
-                    plotter(a=float(job[0]), b=float(job[1]), c=float(job[2]), alpha=float(job[3]), beta=float(job[4]),
-                        gamma=float(job[5]), fit=sbestW*100)
-                    progress = (i) / iterations
-                    progress = int(barLengths * progress)
-                    sys.stdout.write(
-                        '\r [' + progress * '#' + (barLengths - progress) * '-' + '] {fit:8.6f} {cell}'.format(
-                            fit=weighted,
-                            cell=' '.join([
-                                '{:9.4f}'.format(
-                                    p)
-                                for
-                                p
-                                in
-                                job])))
-                    sys.stdout.flush()
-            cell = cell[:2] + ['{:7.4f}'.format(p) for p in jobs[sbestWj]]
-            if sbestWj == 0:
-                # print('No improvements found. Decreasing step size.')
-                sdelta = sdelta / 2
-                if sdelta < 0.002:
-                    # print('Converged.')
-                    break
-                if ii - slastImprovement > 10:
-                    # print('No improvements since 10 steps. Terminating.')
-                    break
+            reader.toP1()
+            molecule = reader.molecule
+            if molecule.overlaps:
+                print(formatOverlaps(molecule.overlaps))
+            cls = 'triclinic'
+            params = CLASSPARAMETERS[cls]
+        originalCell = [float(x) for x in cell[2:]]
+        if warmStart:
+            cell = cell[:2] + ['{:7.4f}'.format(p) for p in solveMetric(molecule, cls)]
+
+        evaluator = ShelxlEvaluator(reader, cell[:2], processes=processes, directory=workspace.directory,
+                                    cache=cache)
+        recorder = openTrajectory(fileName, trajectory=trajectory, plot=plot, every=every)
+        bestWR2 = [None]
+        EVENTS.emit('start', mode='accurate', crystalClass=cls, cell=originalCell)
+
+        def printStep(step, oldCell, newCell, fit, best):
+            if best or not step:
+                bestWR2[0] = evaluator.wR2s[best]
+            EVENTS.emit('step', step=step, cell=[float(p) for p in newCell], fit=fit, wR2=bestWR2[0])
+            if recorder:
+                recorder(step, newCell, fit)
+            print()
+            print()
+            print('   Old Cell:  ', cell2String(oldCell, offset=15))
+            print()
+            print('   New Cell:  ', cell2String(newCell, offset=15))
+            print()
+            print('   DFIX Fit:     {:7.5f} / {:7.5f}\n'.format(fit, evaluator.initial[1]))
+            print('   Current wR2:  {}'.format('{:7.5f}\n'.format(evaluator.wR2s[best])
+                                             if best or not step else 'No imvprovements'))
+
+        backend = OPTIMIZERS[optimizer](molecule, params, cls, evaluator=evaluator, step=.5, minStep=.005, patience=5,
+                                        objective=1, stepCallback=printStep)
+        try:
+            newCell, bestW = backend.optimize([float(x) for x in cell[2:]])
+        finally:
+            evaluator.close()
+        if backend.terminationReason == 'converged':
+            print('Converged.')
+        elif backend.terminationReason == 'stalled':
+            print('No improvements since {} steps. Terminating.'.format(backend.patience))
+        cell = cell[:2] + ['{:7.4f}'.format(p) for p in newCell]
+        print('\n\nOriginal Cell:', cell2String(originalCell, offset=15))
+        print('   Final Cell:', cell2String(cell[2:], offset=15))
+
+        print('\nOriginal DFIX fit: {:8.6f}'.format(evaluator.initial[1]))
+        print('   Final DFIX fit: {:8.6f}'.format(bestW))
+        EVENTS.emit('finish', cell=[float(x) for x in cell[2:]], startFit=evaluator.initial[1], fit=bestW,
+                    wR2=bestWR2[0])
+        closeTrajectory(recorder, plot=plot)
+    return {'structure': fileName,
+            'class': cls,
+            'originalCell': originalCell,
+            'cell': [float(x) for x in cell[2:]],
+            'startFit': evaluator.initial[1],
+            'fit': bestW,
+            'wR2': bestWR2[0]}
+
+
+def compareOptimizers(fileNames, optimizers=None, cycles=0, scratch=None, cache=None):
+    """
+    Runs optimizer backends on a number of structures and reports the number of objective evaluations, SHELXL calls,
+    wall time and final DFIX fit of each run.
+    :param fileNames: list of str<Names of the starting parameter shelxl.res files>
+    :param optimizers: list of str<names of optimizer backends in OPTIMIZERS>. All backends are used by default.
+    :param cycles: int<number of SHELXL refinements between optimizer runs as in 'default' mode>
+    :param scratch: str<directory the workspaces are created in>
+    :param cache: RefinementCache instance
+    :return: list of dict
+    """
+    results = []
+    print('{:30} {:12} {:>11} {:>7} {:>9} {:>10} {:>10}'.format('Structure', 'Optimizer', 'Evaluations', 'SHELXL',
+                                                              'Time/s', 'Start fit', 'Final fit'))
+    for fileName in fileNames:
+        hklFileName = fileName + '.hkl'
+        for name in optimizers or OPTIMIZERS:
+            startTime = time.time()
+            reader = ShelxlReader()
+            molecule = reader.read(fileName + '.res')
+            cell = reader['cell'].split()
+            cls, params = determineCrystalClass(cell)
+            startFit, _ = molecule.checkDfix()
+            job = [float(x) for x in cell[2:]]
+            evaluations = 0
+            shelxlCalls = 0
+            fit = None
+            error = None
+            try:
+                with Workspace(hklFileName, root=scratch) as workspace:
+                    refined = ShelxlMolecule()
+                    for cycle in range(cycles + 1):
+                        backend = OPTIMIZERS[name](molecule, params, cls)
+                        job, fit = backend.optimize(job)
+                        evaluations += backend.evaluations
+                        if cycle < cycles:
+                            reader['cell'] = ' '.join(cell[:2] + ['{:7.4f}'.format(p) for p in job]) + '\n'
+                            reader.write(fileName=workspace.path('work.ins'))
+                            evaluate(workspace.path('work'), cache=cache, molecule=refined)
+                            shelxlCalls += 1
+                            molecule = refined
+            except (CelloptError, ValueError, ZeroDivisionError) as e:
+                error = str(e)
+            result = {'structure': fileName,
+                      'optimizer': name,
+                      'class': cls,
+                      'evaluations': evaluations,
+                      'shelxlCalls': shelxlCalls,
+                      'time': time.time() - startTime,
+                      'startFit': startFit,
+                      'fit': fit,
+                      'cell': job,
+                      'error': error}
+            results.append(result)
+            if error:
+                print('{structure:30} {optimizer:12} failed: {error}'.format(**result))
             else:
-                slastImprovement = ii
-        if not fast:
-            newCell = ' '.join(cell) + '\n'
-            reader['cell'] = newCell
-            reader.write(fileName='work.ins')
-            wR2, mean, weighted = evaluate('work')
-            newReader = ShelxlReader()
-            molecule = newReader.read('work.res')
-            progress = i / iterations
-            progress = int(barLengths * progress)
-            sys.stdout.write(
-                '\r [' + progress * '#' + (barLengths - progress) * '-'
-                + '] {fit:8.6f} {cell}'.format(fit=weighted,
-                                               cell=' '.join(['{:9.4f}'.format(p) for p in job])))
-            sys.stdout.flush()
-        else:
-            progress = barLengths
-            sys.stdout.write(
-                '\r [' + progress * '#' + (barLengths - progress) * '-'
-                + '] {fit:8.6f} {cell}'.format(fit=weighted,
-                                               cell=' '.join(['{:9.4f}'.format(p) for p in job])))
-            sys.stdout.flush()
-            break
-        startDiff = sbestW
-    print()
-    print('\n\nOriginal Cell:', cell2String(originalCell, offset=15))
-    print()
-    print('   Final Cell:', cell2String(cell[2:], offset=15))
-
-    print('\nOriginal DFIX fit: {:8.6f}'.format(startDiff0))
-    print('   Final DFIX fit: {:8.6f}'.format(sbestW))
-    if plot:
-        plotter.show()
+                print('{structure:30} {optimizer:12} {evaluations:11d} {shelxlCalls:7d} {time:9.3f} '
+                      '{startFit:10.6f} {fit:10.6f}'.format(**result))
+    return results
 
 
-def run2(fileName, p1=False, overrideClass=None):
+def runStructure(fileName, mode='default', p1=False, overrideClass=None, plot=False, optimizer='pattern',
+                 warmStart=False, processes=None, scratch=None, keep=False, cache=None, starts=1, spread=.02,
+                 trajectory=None, every=1):
     """
-    Run the optimizer in 'accurate' mode.
+    Optimizes the cell of one structure with the given optimization scheme.
     :param fileName: str<Name of the starting parameter shelxl.res file>
+    :param mode: str<one of 'default', 'fast', 'lsq', 'direct' and 'accurate'>
     :param p1: bool<Expand structure to P1/P-1>
     :param overrideClass: str<name of crystal class>
+    :param plot: bool<render the trajectory to a .png file, see renderTrajectory()>
+    :param optimizer: str<name of the optimizer backend in OPTIMIZERS>
+    :param warmStart: bool<start from the cell computed by solveMetric()>
+    :param processes: int<number of parallel SHELXL processes in 'accurate' mode or of parallel starts>
+    :param scratch: str<directory the workspace is created in>
+    :param keep: bool<keep the workspace>
+    :param cache: RefinementCache instance
+    :param starts: int<number of starting cells in modes 'default', 'fast' and 'lsq'>
+    :param spread: float<relative perturbation of the starting cells>
+    :param trajectory: str<name of the .npy file the trajectory is recorded to> or True, see openTrajectory()
+    :param every: int<keep every n-th sample of the trajectory>
+    :return: dict<summary of the run>
+    """
+    EVENTS.context['structure'] = fileName
+    if mode == 'default':
+        return run(fileName, p1=p1, overrideClass=overrideClass, plot=plot, optimizer=optimizer,
+                   warmStart=warmStart, scratch=scratch, keep=keep, cache=cache, starts=starts, spread=spread,
+                   processes=processes, trajectory=trajectory, every=every)
+    elif mode == 'fast':
+        return run(fileName, p1=p1, overrideClass=overrideClass, fast=True, plot=plot, optimizer=optimizer,
+                   warmStart=warmStart, scratch=scratch, keep=keep, cache=cache, starts=starts, spread=spread,
+                   processes=processes, trajectory=trajectory, every=every)
+    elif mode == 'lsq':
+        return run(fileName, p1=p1, overrideClass=overrideClass, fast=True, plot=plot, optimizer='lsq',
+                   warmStart=warmStart, scratch=scratch, keep=keep, cache=cache, starts=starts, spread=spread,
+                   processes=processes, trajectory=trajectory, every=every)
+    elif mode == 'direct':
+        return run(fileName, p1=p1, overrideClass=overrideClass, fast=True, plot=plot, optimizer='direct',
+                   scratch=scratch, keep=keep, cache=cache, trajectory=trajectory, every=every)
+    elif mode == 'accurate':
+        return run2(fileName, p1=p1, overrideClass=overrideClass, warmStart=warmStart, optimizer=optimizer,
+                    processes=processes, scratch=scratch, keep=keep, cache=cache, plot=plot, trajectory=trajectory,
+                    every=every)
+    raise CelloptError('Unknown mode {}.'.format(mode), 1)
+
+
+def expandFileNames(patterns):
+    """
+    Expands a list of structure names and glob patterns to the names of structures without file extension. Names may
+    be given with or without '.res', '.ins' or '.hkl' extension.
+    :param patterns: list of str
+    :return: list of str
+    """
+    fileNames = []
+    for pattern in patterns:
+        matches = sorted(glob(pattern)) if any(char in pattern for char in '*?[') else [pattern]
+        for match in matches:
+            base, extension = os.path.splitext(match)
+            if extension.lower() in ('.res', '.ins', '.hkl'):
+                match = base
+            if match not in fileNames:
+                fileNames.append(match)
+    return fileNames
+
+
+def initBatch(profile, events, startTime):
+    """
+    Process pool initializer of runBatch(). Enables the profiler and opens the event stream of a worker process if
+    they are enabled in the parent process.
+    :param profile: bool
+    :param events: str<name of the event stream file> or None
+    :param startTime: float<time stamp the elapsed times of the events refer to>
     :return: None
     """
-    resFileName = fileName + '.res'
-    fileDir = dirname(resFileName)
-    copyfile(join(fileDir, fileName + '.hkl'), './work.hkl')
-    reader = ShelxlReader()
-    molecule = reader.read(resFileName)
-    cell = reader['cell'].split()
-    cls, params = determineCrystalClass(cell)
-    if overrideClass:
-        cls = overrideClass
-        params = CLASSPARAMETERS[cls]
-    print('Crystal Class is {}.'.format(cls))
-    if p1:
-        print('Expanding to P1.')
-        reader.toP1()
-        cls = 'triclinic'
-        params = CLASSPARAMETERS[cls]
-    originalCell = [float(x) for x in cell[2:]]
-
-    delta = .5
-    lastImprovement = 0
-
-    startDiff = None
-    lastDiff = 9999
-
-    i = -1
-    while True:
-        i += 1
-        data = [float(x) for x in cell[2:]]
-        jobs = [data]
-        conDict = params[1]
-        for p in params[0]:
-            try:
-                cons = conDict[p]
-            except:
-                cons = []
-            j = data[:]
-            j[p] -= delta
-            for con in cons:
-                j[con] = j[p]
-            jobs.append(j)
-
-            j = data[:]
-            j[p] += delta
-            for con in cons:
-                j[con] = j[p]
-            jobs.append(j)
-
-        bestR = 999999
-        bestRj = None
-
-        bestmean = 999999
-        bestmeanj = None
-
-        bestW = lastDiff
-        bestWj = 0
-        bestRW = 9999
-
-        numJobs = len(jobs)
-        barLengths = 60
-        for j, job in enumerate(jobs):
-            progress = (j + 1) / numJobs
-            progress = int(barLengths * progress)
-            sys.stdout.write('\r Step {:3} ['.format(i + 1) + progress * '#' + (barLengths - progress) * '-' + ']')
-            sys.stdout.flush()
-            newCell = cell[:2] + ['{:7.4f}'.format(p) for p in job]  # + cell[5:]
-            newCell = ' '.join(newCell) + '\n'
-            reader['cell'] = newCell
-            reader.write(fileName='work.ins')
-            wR2, mean, weighted = evaluate('work')
-            if wR2 < bestR:
-                bestR = wR2
-                bestRj = j
-            if mean < bestmean:
-                bestmean = mean
-                bestmeanj = j
-            if weighted < bestW:
-                bestW = weighted
-                bestWj = j
-                bestRW = wR2
-
-            if not startDiff:
-                startDiff = weighted
-        print()
-        print()
-        # jString = j2Name(bestWj)
-        # print('  ', jString)
-        print('   Old Cell:  ', cell2String(cell[2:], offset=15))
-        print()
-        # print('   Best wR2:            ', bestRj, cell2String(jobs[bestRj]))
-        # print('   Best mean:           ', bestmeanj, cell2String(jobs[bestmeanj]))
-        print('   New Cell:  ', cell2String(jobs[bestWj], offset=15))
-        print()
-        print('   DFIX Fit:     {:7.5f} / {:7.5f}\n'.format(bestW, startDiff))
-        print('   Current wR2:  {}'.format('{:7.5f}\n'.format(bestRW) if bestRW < 10 else 'No imvprovements'))
-        # input()
-        cell = cell[:2] + ['{:7.4f}'.format(p) for p in jobs[bestWj]]  # + cell[5:]
-        lastDiff = bestW
-        if bestWj == 0:
-            # print('No improvements found. Decreasing step size.')
-            delta = delta / 2
-            if delta < 0.005:
-                print('Converged.')
-                break
-            if i - lastImprovement > 5:
-                print('No improvements since 5 steps. Terminating.')
-                break
-        else:
-            lastImprovement = i
-        break
-    print('\n\nOriginal Cell:', cell2String(originalCell, offset=15))
-    print('   Final Cell:', cell2String(cell[2:], offset=15))
+    PROFILER.enable(profile)
+    if events:
+        EVENTS.open(events, startTime=startTime)
 
-    print('\nOriginal DFIX fit: {:8.6f}'.format(startDiff))
-    print('   Final DFIX fit: {:8.6f}'.format(bestW))
+
+def batchJob(job):
+    """
+    Process pool wrapper of runStructure(). Errors are recorded in the returned summary instead of being raised, and
+    the console output of the run is discarded. The records of the profiler are returned in the key 'profile'.
+    :param job: tuple<str<fileName>, dict<keyword arguments of runStructure()>>
+    :return: dict<summary of the run>
+    """
+    fileName, options = job
+    result = {'structure': fileName,
+              'mode': options.get('mode', 'default'),
+              'class': None,
+              'originalCell': None,
+              'cell': None,
+              'startFit': None,
+              'fit': None,
+              'wR2': None,
+              'multiStart': None,
+              'error': None}
+    clock = time.process_time if hasattr(time, 'process_time') else time.clock
+    startTime = time.time()
+    startClock = clock()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for extension, code in (('.res', 3), ('.hkl', 4)):
+            if not os.path.isfile(fileName + extension):
+                raise CelloptError('File {}{} is missing.'.format(fileName, extension), code)
+        result.update(runStructure(fileName, **options))
+    except Exception as e:
+        result['error'] = ' '.join(str(e).split()) or e.__class__.__name__
+        EVENTS.context['structure'] = fileName
+        EVENTS.emit('error', message=result['error'])
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    result['time'] = time.time() - startTime
+    result['cpuTime'] = clock() - startClock
+    result['profile'] = PROFILER.collect()
+    return result
+
+
+def runBatch(fileNames, processes=None, summary=None, **options):
+    """
+    Optimizes the cells of a number of structures in a process pool. Each structure is optimized in its own workspace
+    and a failing structure does not affect the others.
+    :param fileNames: list of str<Names of the starting parameter shelxl.res files>
+    :param processes: int<number of structures optimized in parallel>. Defaults to the number of CPUs.
+    :param summary: str<name of a .csv or .json file the summary is written to>
+    :param options: keyword arguments of runStructure()
+    :return: list of dict
+    """
+    if options.get('mode') == 'accurate' or options.get('starts', 1) > 1:
+        options['processes'] = 1
+    jobs = [(fileName, options) for fileName in fileNames]
+    processes = min(processes if processes else cpu_count(), len(jobs))
+    print('{:30} {:12} {:>10} {:>10} {:>8} {:>9}'.format('Structure', 'Class', 'Start fit', 'Final fit', 'wR2',
+                                                          'Time/s'))
+    results = {}
+    pool = Pool(processes, initializer=initBatch,
+                initargs=(PROFILER.enabled, EVENTS.fileName, EVENTS.startTime)) if processes > 1 else None
+    try:
+        for result in pool.imap_unordered(batchJob, jobs) if pool else (batchJob(job) for job in jobs):
+            PROFILER.merge(result.pop('profile'))
+            results[result['structure']] = result
+            if result['error']:
+                print('{structure:30} failed: {error}'.format(**result))
+            else:
+                print('{structure:30} {cls:12} {startFit:10.6f} {fit:10.6f} {r:>8} {time:9.2f}'.format(
+                    cls=result['class'], r='{:8.4f}'.format(result['wR2']) if result['wR2'] else '-', **result))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    results = [results[fileName] for fileName in fileNames]
+    failed = len([result for result in results if result['error']])
+    print('\n{} structures optimized, {} failed.'.format(len(results) - failed, failed))
+    if summary:
+        writeSummary(results, summary)
+    return results
+
+
+def writeSummary(results, fileName):
+    """
+    Writes the summaries of a batch run to a JSON file or, for any other extension, a CSV file.
+    :param results: list of dict
+    :param fileName: str
+    :return: None
+    """
+    if fileName.lower().endswith('.json'):
+        with open(fileName, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        return
+    parameters = [JDICT[j] for j in range(6)]
+    header = (['structure', 'mode', 'class'] + ['original_' + p for p in parameters] + parameters +
+              ['startFit', 'fit', 'wR2', 'time', 'cpuTime', 'error'])
+    with open(fileName, 'w') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(header)
+        for result in results:
+            originalCell = result['originalCell'] or [None] * 6
+            cell = result['cell'] or [None] * 6
+            writer.writerow([result['structure'], result['mode'], result['class']] + list(originalCell) + list(cell)
+                            + [result[key] for key in ('startFit', 'fit', 'wR2', 'time', 'cpuTime', 'error')])
 
 
 JDICT = {0: 'a',
@@ -436,152 +1963,314 @@ def cell2String(cell, offset=0):
 
 
 
-class Plotter(object):
+class TrajectoryRecorder(object):
     """
-    Class for accumulating and plotting of data.
+    Records the cells and DFIX fits visited by an optimization run in a .npy file that can be loaded with numpy.load()
+    and rendered with renderTrajectory(). Each sample is one row (step, a, b, c, alpha, beta, gamma, fit).
+    Samples are collected in a fixed size block that is appended to the file when it is full, so the memory used does
+    not grow with the length of the run. The header of the file is rewritten with the new number of rows after each
+    block, so the file is valid while the run is still going on. With every > 1 only every n-th sample is kept.
     """
-    def __init__(self):
+    COLUMNS = ('step', 'a', 'b', 'c', 'alpha', 'beta', 'gamma', 'fit')
+    HEADERLENGTH = 128
 
-        self.values = {}
-
-    def __call__(self, **kwargs):
+    def __init__(self, fileName, every=1, blockSize=1024):
         """
-        Add data to the plotter.
-        :param kwargs: Each key word will become a data series. Subsequent calls with equal keys will
-         append the datum to the series.
-        :return: None
+        :param fileName: str<name of the .npy file. An existing file is overwritten.>
+        :param every: int<keep every n-th sample>
+        :param blockSize: int<number of samples kept in memory before they are written>
         """
-        for key, value in kwargs.items():
-            try:
-                self.values[key].append(value)
-            except KeyError:
-                self.values[key] = [value]
-
-    def normalize(self):
+        self.fileName = fileName
+        self.every = max(1, every)
+        self.block = np.zeros((blockSize, len(self.COLUMNS)))
+        self.size = 0
+        self.rows = 0
+        self.samples = 0
+        self.fp = open(fileName, 'wb')
+        self._writeHeader()
+
+    def __call__(self, step, cell, fit):
         """
-        Subtracts the first value of each series from each datum in the corresponding series.
-        :return:
+        Adds a sample.
+        :param step: int<number of the optimizer run>
+        :param cell: list of six floats
+        :param fit: float
+        :return: None
         """
-        for key, values in self.values.items():
-            m = values[0]
-            self.values[key] = [v-m for v in values]
+        self.samples += 1
+        if (self.samples - 1) % self.every:
+            return
+        row = self.block[self.size]
+        row[0] = step
+        row[1:7] = [float(x) for x in cell]
+        row[7] = fit
+        self.size += 1
+        if self.size == len(self.block):
+            self.flush()
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *args):
+        self.close()
 
-    def plot(self, x, y,  label=''):
+    def flush(self):
         """
-        Adds a data series to the plot.
-        :param x: float
-        :param y: float
-        :param label: str
-        :return: plot
+        Appends the samples in memory to the file and updates the header.
+        :return: None
         """
-        plt.plot(x, y, marker='', label=label)
-        plt.legend(loc='upper right')
-        return plt
-
-    def show(self):
+        if self.size:
+            self.fp.seek(0, 2)
+            self.fp.write(self.block[:self.size].astype('<f8').tobytes())
+            self.rows += self.size
+            self.size = 0
+        self._writeHeader()
+        self.fp.flush()
+
+    def close(self):
         """
-        Create and show a plot of the accumulated data.
+        Writes the remaining samples and closes the file.
         :return: None
         """
-        if not PLOTAVAILABLE:
-            print('Plot function not available. Please install matplotlib.'
-                  'On some operating systems the python-tkinter package'
-                  'is not installed by default. If installing matplotlib'
-                  'does not solve this issue, pleas check if python-tkinter'
-                  'is installed.')
-            return
-        self.normalize()
-        plt = None
-        for key, data in self.values.items():
-            plt = self.plot(range(len(data)), data, label=key)
-        plt.show()
+        if self.fp:
+            self.flush()
+            self.fp.close()
+            self.fp = None
 
+    def _writeHeader(self):
+        header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({}, {}), }}".format(self.rows, len(self.COLUMNS))
+        header = header.ljust(self.HEADERLENGTH - 11) + '\n'
+        self.fp.seek(0)
+        self.fp.write(b'\x93NUMPY\x01\x00' + np.array(len(header), dtype='<u2').tobytes() + header.encode('latin1'))
 
-class Array(object):
-    def __init__(self, values):
-        self.values = values
 
-    def __iter__(self):
-        for v in self.values:
-            yield v
+def renderTrajectory(fileName, imageName=None):
+    """
+    Renders a trajectory recorded by TrajectoryRecorder to an image file without opening a window. The upper panel
+    shows the change of the cell parameters with respect to the first sample, the lower panel the DFIX fit.
+    :param fileName: str<name of the .npy file>
+    :param imageName: str<name of the image file. The format is given by the extension, eg. '.png' or '.svg'.>
+     Defaults to fileName with extension '.png'.
+    :return: str<name of the image file>
+    """
+    if not PLOTAVAILABLE:
+        raise CelloptError('Plot function not available. Please install matplotlib.', 7)
+    if imageName is None:
+        imageName = os.path.splitext(fileName)[0] + '.png'
+    samples = np.load(fileName)
+    if not len(samples):
+        raise CelloptError('Trajectory {} is empty.'.format(fileName), 7)
+    figure = Figure(figsize=(8, 6))
+    FigureCanvas(figure)
+    cellAxes, fitAxes = figure.subplots(2, 1, sharex=True)
+    for column in range(1, 7):
+        cellAxes.plot(samples[:, column] - samples[0, column], label=TrajectoryRecorder.COLUMNS[column])
+    cellAxes.set_ylabel('Change')
+    cellAxes.legend(loc='upper right', ncol=2)
+    fitAxes.plot(samples[:, 7], color='k')
+    for start in np.flatnonzero(np.diff(samples[:, 0])) + 1:
+        cellAxes.axvline(start, color='0.8', linewidth=.5)
+        fitAxes.axvline(start, color='0.8', linewidth=.5)
+    fitAxes.set_ylabel('DFIX fit')
+    fitAxes.set_xlabel('Sample')
+    figure.tight_layout()
+    figure.savefig(imageName)
+    return imageName
+
+
+def openTrajectory(fileName, trajectory=None, plot=False, every=1):
+    """
+    Returns the TrajectoryRecorder of a run.
+    :param fileName: str<Name of the structure>
+    :param trajectory: str<name of the .npy file> or True to use '<fileName>_trajectory.npy'
+    :param plot: bool<a plot is rendered at the end of the run. Records to the default file if no trajectory is given.>
+    :param every: int<keep every n-th sample>
+    :return: TrajectoryRecorder instance or None if neither a trajectory nor a plot is requested
+    """
+    if trajectory is True or (plot and not trajectory):
+        trajectory = fileName + '_trajectory.npy'
+    return TrajectoryRecorder(trajectory, every=every) if trajectory else None
 
-    def __len__(self):
-        return len(self.values)
-
-    def __add__(self, other):
-        if type(other) == type(self):
-            if not len(self) == len(other):
-                raise ValueError('Arrays are not of equal length.')
-            return Array([i + j for i, j in zip(self, other)])
-        elif type(other) == float or type(other) == int:
-            return Array([i + other for i in self.values])
-        else:
-            raise TypeError('Cannot add type Array to type {}.'.format(str(type(other))))
 
-    def __imul__(self, other):
-        if type(other) == int:
-            self.values = [v * other for v in self.values]
-            return self
-        else:
-            raise TypeError('Unsupported operation.')
+def closeTrajectory(recorder, plot=False):
+    """
+    Closes the TrajectoryRecorder of a run and renders the trajectory to a .png file if requested.
+    :param recorder: TrajectoryRecorder instance or None
+    :param plot: bool
+    :return: None
+    """
+    if recorder is None:
+        return
+    recorder.close()
+    print('\nTrajectory written to {}'.format(recorder.fileName))
+    if plot:
+        print('Plot written to {}'.format(renderTrajectory(recorder.fileName)))
+
+
+class Array(np.ndarray):
+    """
+    Array of floats backed by numpy.ndarray. Used for fractional coordinates, ADPs and cell parameters.
+    """
+
+    def __new__(cls, values):
+        return np.asarray(values, dtype=float).view(cls)
 
     def __str__(self):
-        return 'Array({})'.format(str(self.values))
+        return 'Array({})'.format(str(self.tolist()))
 
-    def __getitem__(self, val):
-        try:
-            start, stop, step = val.start, val.stop, val.step
-        except AttributeError:
-            pass
-        else:
-            return self.values[val]
-        finally:
-            return self.values[val]
+    @property
+    def values(self):
+        return self.tolist()
+
+
+class Matrix(np.ndarray):
+    """
+    Matrix of floats backed by numpy.ndarray. Elements are accessed as matrix[row, column].
+    Like the former pure Python implementation the constructor expects a list of columns.
+    """
+
+    def __new__(cls, values):
+        return np.asarray(values, dtype=float).T.view(cls)
+
+    def __str__(self):
+        return '\n'.join([str(row) for row in self.tolist()])
 
     def dot(self, other):
-        return sum([i * j for i, j in zip(self, other)])
+        return Array(np.dot(self.view(np.ndarray), other))
 
 
-class Matrix(object):
-    def __init__(self, values):
-        self.shape = (len(values[0]), len(values))
-        self.values = values
+SYMMDENOMINATOR = 24
+MAXGROUPORDER = 192
+IDENTITYKEY = ((1, 0, 0, 0, 1, 0, 0, 0, 1), (0, 0, 0))
+SYMMETRYTERM = re.compile(r'([+-]?)([^+-]+)')
+PARSEDOPERATORS = {}
+INTERNEDOPERATORS = {}
+OPERATORPRODUCTS = {}
+SYMMETRYGROUPS = {}
 
-    def __getitem__(self, val):
-        if type(val) == tuple:
-            if len(val) == 1:
-                return self.values[val[0]]
-            return self.values[val[1]][val[0]]
 
-    def __str__(self):
-        print(self.values)
-        return '\n'.join([str(row) for row in self.values])
+def parseSymmetryOperator(symms):
+    """
+    Parses the three components of a SYMM or EQIV instruction into an integer affine operator. Translations are
+    returned in multiples of 1/SYMMDENOMINATOR. Fractions like '1/2' and decimals like '0.5' are parsed with
+    fractions.Fraction, so nothing is evaluated.
+    :param symms: list of three strings eg. ['-X', '1/2+Y', '-Z']
+    :return: tuple<rotation as tuple of nine ints in row major order, translation as tuple of three ints>
+    """
+    text = tuple(symm.lower().replace(' ', '').replace('*', '') for symm in symms)
+    try:
+        return PARSEDOPERATORS[text]
+    except KeyError:
+        pass
+    if len(text) != 3:
+        raise ValueError('Symmetry operator {} does not have three components.'.format(','.join(symms)))
+    rotation = [0] * 9
+    translation = [Fraction(0)] * 3
+    try:
+        for row, component in enumerate(text):
+            for sign, term in SYMMETRYTERM.findall(component):
+                if term[-1] in 'xyz':
+                    value = Fraction(term[:-1]) if term[:-1] else Fraction(1)
+                    if value.denominator != 1:
+                        raise ValueError
+                    rotation[3 * row + 'xyz'.index(term[-1])] += -int(value) if sign == '-' else int(value)
+                else:
+                    translation[row] += -Fraction(term) if sign == '-' else Fraction(term)
+    except (ValueError, ZeroDivisionError):
+        raise ValueError('Can not parse symmetry operator {}.'.format(','.join(symms)))
+    operator = (tuple(rotation), tuple(int(round(t * SYMMDENOMINATOR)) for t in translation))
+    PARSEDOPERATORS[text] = operator
+    return operator
 
-    def __imul__(self, other):
-        if type(other) == int:
-            self.values = [[v * other for v in row] for row in self.values]
-            return self
-        else:
-            raise TypeError('Unsupported operation.')
 
-    def transpose(self):
-        rows = []
-        for i in range(self.shape[0]):
-            rows.append([r[i] for r in self.values])
-        return Matrix(rows)
+def composeOperators(key1, key2):
+    """
+    Returns the operator that is equivalent to applying the operator key2 first and key1 second. Both operators are
+    given like SymmetryElement.key. The result is reduced modulo lattice translations. Results are cached.
+    :param key1: tuple<rotation, translation>
+    :param key2: tuple<rotation, translation>
+    :return: tuple<rotation, translation>
+    """
+    try:
+        return OPERATORPRODUCTS[key1, key2]
+    except KeyError:
+        pass
+    (r1, t1), (r2, t2) = key1, key2
+    rotation = tuple(r1[3 * i] * r2[j] + r1[3 * i + 1] * r2[3 + j] + r1[3 * i + 2] * r2[6 + j]
+                     for i in range(3) for j in range(3))
+    translation = tuple((r1[3 * i] * t2[0] + r1[3 * i + 1] * t2[1] + r1[3 * i + 2] * t2[2] + t1[i]) % SYMMDENOMINATOR
+                        for i in range(3))
+    OPERATORPRODUCTS[key1, key2] = rotation, translation
+    return rotation, translation
 
-    def dot(self, other):
-        newA = []
-        for i, col in enumerate(self.transpose().values):
-            s = sum([v * o for v, o in zip(col, other)])
-            newA.append(s)
-        return Array(newA)
+
+def internSymmetryElement(rotation, translation, centric=False):
+    """
+    Returns the shared SymmetryElement instance representing the given operator.
+    :param rotation: tuple of nine ints
+    :param translation: tuple of three ints<in multiples of 1/SYMMDENOMINATOR>
+    :param centric: bool
+    :return: SymmetryElement instance
+    """
+    key = (tuple(rotation), tuple(translation), centric)
+    try:
+        return INTERNEDOPERATORS[key]
+    except KeyError:
+        element = SymmetryElement.fromOperator(rotation, translation, centric=centric)
+        INTERNEDOPERATORS[key] = element
+        return element
+
+
+def expandSymmetry(generators, centerings=(), centric=False):
+    """
+    Generates all operators of a space group by closure of the given generators. Operators are distinguished modulo
+    lattice translations, so SYMM instructions that are listed twice or that are products of other ones do not add
+    operators. The result depends on the set of generators only and is cached.
+    The identity is not part of the result. If centric is True, the operators generated by the center of inversion are
+    appended with their centric attribute set.
+    :param generators: list of SymmetryElement instances<SYMM instructions>
+    :param centerings: list of SymmetryElement instances<lattice centering operators>
+    :param centric: bool
+    :return: list of SymmetryElement instances
+    """
+    cacheKey = (frozenset(symm.key for symm in generators), frozenset(symm.key for symm in centerings), centric)
+    try:
+        return list(SYMMETRYGROUPS[cacheKey])
+    except KeyError:
+        pass
+    generatorKeys = sorted(cacheKey[0] | cacheKey[1])
+    elements = {IDENTITYKEY}
+    frontier = [IDENTITYKEY]
+    while frontier:
+        newElements = []
+        for element in frontier:
+            for generator in generatorKeys:
+                product = composeOperators(element, generator)
+                if product not in elements:
+                    if len(elements) >= MAXGROUPORDER:
+                        raise ValueError('The SYMM and LATT instructions do not generate a space group.')
+                    elements.add(product)
+                    newElements.append(product)
+        frontier = newElements
+    keys = sorted(elements - {IDENTITYKEY})
+    symms = [internSymmetryElement(rotation, translation) for rotation, translation in keys]
+    if centric:
+        inversion = (tuple(-r for r in IDENTITYKEY[0]), IDENTITYKEY[1])
+        for key in [IDENTITYKEY] + keys:
+            product = composeOperators(inversion, key)
+            if product not in elements:
+                symms.append(internSymmetryElement(product[0], product[1], centric=True))
+    SYMMETRYGROUPS[cacheKey] = tuple(symms)
+    return symms
 
 
 class SymmetryElement(object):
     """
     Class representing a symmetry operation.
+    The operation is stored as integer rotation matrix and integer translation in multiples of 1/SYMMDENOMINATOR.
+    self.key identifies the operation modulo lattice translations. self.affine is the equivalent 3x4 affine matrix.
+    self.matrix and self.trans are views on its rotational and translational parts.
+    Instances are immutable and may be shared, see internSymmetryElement().
     """
     symm_ID = 1
 
@@ -589,34 +2278,59 @@ class SymmetryElement(object):
         """
         Constructor.
         """
+        rotation, translation = parseSymmetryOperator(symms)
+        if centric:
+            rotation = tuple(-r for r in rotation)
+            translation = tuple(-t for t in translation)
+        self._setOperator(rotation, translation, centric)
+        self.symms = list(symms)
+
+    @classmethod
+    def fromOperator(cls, rotation, translation, centric=False):
+        """
+        Creates a SymmetryElement from an integer operator.
+        :param rotation: tuple of nine ints
+        :param translation: tuple of three ints<in multiples of 1/SYMMDENOMINATOR>
+        :param centric: bool
+        :return: SymmetryElement instance
+        """
+        element = cls.__new__(cls)
+        element._setOperator(tuple(rotation), tuple(translation), centric)
+        element.symms = element.toShelxl().split(', ')
+        return element
+
+    def _setOperator(self, rotation, translation, centric):
         self.centric = centric
-        self.symms = symms
         self.ID = SymmetryElement.symm_ID
         SymmetryElement.symm_ID += 1
-        lines = []
-        trans = []
-        for symm in self.symms:
-            line, t = self._parse_line(symm)
-            lines.append(line)
-            trans.append(t)
-        self.matrix = Matrix(lines).transpose()
-        self.trans = Array(trans)
-        if centric:
-            self.matrix *= -1
-            self.trans *= -1
+        self.rotation = rotation
+        self.translation = translation
+        self.key = (rotation, tuple(t % SYMMDENOMINATOR for t in translation))
+        self.affine = np.zeros((3, 4))
+        self.affine[:, :3] = np.reshape(rotation, (3, 3))
+        self.affine[:, 3] = np.array(translation) / float(SYMMDENOMINATOR)
+        self.affine.flags.writeable = False
+
+    @property
+    def matrix(self):
+        return self.affine[:, :3].view(Matrix)
+
+    @property
+    def trans(self):
+        return self.affine[:, 3].view(Array)
 
     def __str__(self):
         string = '''|{aa:2} {ab:2} {ac:2}|   |{v:2}|
 |{ba:2} {bb:2} {bc:2}| + |{vv:2}|
-|{ca:2} {cb:2} {cc:2}|   |{vvv:2}|'''.format(aa=self.matrix[0, 0],
-                                             ab=self.matrix[0, 1],
-                                             ac=self.matrix[0, 2],
-                                             ba=self.matrix[1, 0],
-                                             bb=self.matrix[1, 1],
-                                             bc=self.matrix[1, 2],
-                                             ca=self.matrix[2, 0],
-                                             cb=self.matrix[2, 1],
-                                             cc=self.matrix[2, 2],
+|{ca:2} {cb:2} {cc:2}|   |{vvv:2}|'''.format(aa=int(self.matrix[0, 0]),
+                                             ab=int(self.matrix[0, 1]),
+                                             ac=int(self.matrix[0, 2]),
+                                             ba=int(self.matrix[1, 0]),
+                                             bb=int(self.matrix[1, 1]),
+                                             bc=int(self.matrix[1, 2]),
+                                             ca=int(self.matrix[2, 0]),
+                                             cb=int(self.matrix[2, 1]),
+                                             cc=int(self.matrix[2, 2]),
                                              v=self.trans[0],
                                              vv=self.trans[1],
                                              vvv=self.trans[2])
@@ -629,11 +2343,16 @@ class SymmetryElement(object):
         :param other: SymmetryElement instance
         :return: True/False
         """
-        m = (self.matrix == other.matrix).all()
-        t1 = Array([v % 1 for v in self.trans])
-        t2 = Array([v % 1 for v in other.trans])
-        t = (t1 == t2).all()
-        return m and t
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __sub__(self, other):
         """
@@ -646,19 +2365,22 @@ class SymmetryElement(object):
             return 999.
         return self.trans - other.trans
 
+    def apply(self, fracs):
+        """
+        Applies the symmetry operation to one or more fractional coordinates.
+        :param fracs: array like of shape (3,) or (n, 3)
+        :return: numpy.ndarray of the same shape
+        """
+        return np.dot(fracs, self.affine[:, :3].T) + self.affine[:, 3]
+
     def applyLattSymm(self, lattSymm):
         """
-        Copies SymmetryElement instance and returns the copy after applying the translational part of 'lattSymm'.
+        Returns the SymmetryElement that results from adding the translational part of 'lattSymm'.
         :param lattSymm: SymmetryElement.
         :return: SymmetryElement.
         """
-        # newSymm = deepcopy(self)
-        newSymm = SymmetryElement(self.toShelxl().split(','))
-        newSymm.trans = Array([(self.trans[0] + lattSymm.trans[0]) / 1,
-                         (self.trans[1] + lattSymm.trans[1]) / 1,
-                         (self.trans[2] + lattSymm.trans[2]) / 1])
-        newSymm.centric = self.centric
-        return newSymm
+        translation = tuple(t1 + t2 for t1, t2 in zip(self.translation, lattSymm.translation))
+        return internSymmetryElement(self.rotation, translation, centric=self.centric)
 
     def toShelxl(self):
         """
@@ -668,58 +2390,25 @@ class SymmetryElement(object):
         axes = ['X', 'Y', 'Z']
         lines = []
         for i in range(3):
-            op = self.matrix[i,]
-            text = str(self.trans[i]) if self.trans[i] else ''
+            trans = Fraction(self.translation[i], SYMMDENOMINATOR)
+            text = str(trans) if trans else ''
             for j in range(3):
-                s = '' if not self.matrix[i, j] else axes[j]
-                if self.matrix[i, j] < 0:
+                value = self.rotation[3 * i + j]
+                s = '' if not value else (axes[j] if abs(value) == 1 else '{}*{}'.format(abs(value), axes[j]))
+                if value < 0:
                     s = '-' + s
-                elif s:
+                elif s and text:
                     s = '+' + s
                 text += s
-            lines.append(text)
+            lines.append(text if text else '0')
         return ', '.join(lines)
 
-    def _parse_line(self, symm):
-        symm = symm.lower().replace(' ', '')
-        chars = ['x', 'y', 'z']
-        line = []
-        for char in chars:
-            element, symm = self._partition(symm, char)
-            line.append(element)
-        if symm:
-            trans = self._float(symm)
-        else:
-            trans = 0
-        return line, trans
-
-    def _float(self, string):
-        try:
-            return float(string)
-        except ValueError:
-            if '/' in string:
-                string = string.replace('/', './') + '.'
-                return eval('{}'.format(string))
-
-    def _partition(self, symm, char):
-        parts = symm.partition(char)
-        if parts[1]:
-            if parts[0]:
-                sign = parts[0][-1]
-            else:
-                sign = '+'
-            if sign is '-':
-                return -1, ''.join((parts[0][:-1], parts[2]))
-            else:
-                return 1, ''.join((parts[0], parts[2])).replace('+', '')
-        else:
-            return 0, symm
-
 
 class ShelxlLine(object):
     """
     Class representing a line in a Shelxl.res file.
     """
+    __slots__ = ('line', 'key')
 
     def __init__(self, line, key=None):
         self.line = line
@@ -729,15 +2418,32 @@ class ShelxlLine(object):
     def __str__(self):
         return 'LINE: ' + self.line
 
-    def write(self):
+    def write(self, context=None):
+        """
+        Returns a string representation of a shelxl line as expected by SHELXL.
+        :param context: RenderContext instance of the file being written
+        :return: str
+        """
+        return self.line + '\n'
+
+
+class RenderContext(object):
+    """
+    State of a single ShelxlReader.write() call. Records that depend on the records written before them, like atoms
+    that need PART and AFIX instructions, keep that state here, so several files can be written at the same time.
+    """
+
+    def __init__(self, rewrite=False):
         """
-        Returns a string representation of a shelxl line as expected by SHELXL.
-        :return: str
+        :param rewrite: bool<emit PART and AFIX instructions in front of atoms whose PART or AFIX differs from the
+         previous atom>
         """
-        return self.line + '\n'
+        self.rewrite = rewrite
+        self.afix = 0
+        self.part = 0
+
     
 class ShelxlRestraint(ShelxlLine):
-    RESICLASSOVERRIDE = 'symm'
     def __init__(self, line, key=None):
         super(ShelxlRestraint, self).__init__(line, key=key)
         l = [word for word in line.split() if word]
@@ -768,7 +2474,7 @@ class ShelxlRestraint(ShelxlLine):
         # print(self)
         # exit()
 
-    def write(self):
+    def write(self, context=None):
         return '{cmd} {target} {err} {pairs}\n'.format(cmd=self.cmd+('_{}'.format(self.suffix) if self.suffix else ''),
                                                      target='{:6.4f}'.format(self.target),
                                                      err='{:6.4f}'.format(self.err) if self.err else '',
@@ -790,73 +2496,282 @@ class ShelxlRestraint(ShelxlLine):
     
 
 
+class AtomTable(object):
+    """
+    Structure-of-arrays storage of atoms. Coordinates, occupancies, ADPs, SFAC numbers, AFIX and PART numbers and
+    residues of all atoms are kept in contiguous arrays indexed by atom number. ShelxlAtom instances are views of a
+    single row.
+    Residue classes are stored as indices into self.resiClassNames, the name of class 0 is ''. Anisotropic ADPs use all
+    six columns of self.adps, isotropic ones only the first. self.adpCounts holds the number of columns in use.
+    """
+    ARRAYS = ('fracs', 'occs', 'adps', 'adpCounts', 'sfacs', 'afixes', 'parts', 'resiNums', 'resiClasses')
+
+    def __init__(self, capacity=16):
+        self.size = 0
+        self.labels = []
+        self.resiClassNames = ['']
+        self._resiClassIndices = {'': 0}
+        self.fracs = np.zeros((capacity, 3))
+        self.occs = np.zeros(capacity)
+        self.adps = np.zeros((capacity, 6))
+        self.adpCounts = np.zeros(capacity, dtype=np.int8)
+        self.sfacs = np.zeros(capacity, dtype=np.int16)
+        self.afixes = np.zeros(capacity, dtype=np.int32)
+        self.parts = np.zeros(capacity, dtype=np.int16)
+        self.resiNums = np.zeros(capacity, dtype=np.int32)
+        self.resiClasses = np.zeros(capacity, dtype=np.int16)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, label, sfac, frac, occ, adp, resi=(0, ''), afix=0, part=0):
+        """
+        Appends an atom.
+        :param label: str<atom name as given in the atom record>
+        :param sfac: int
+        :param frac: list of three floats
+        :param occ: float<occupancy including the free variable code, eg. 11.0>
+        :param adp: list of one or six floats
+        :param resi: tuple<int<residue number>, str<residue class>>
+        :param afix: int
+        :param part: int
+        :return: int<index of the new atom>
+        """
+        index = self.size
+        if index == len(self.occs):
+            self._grow()
+        self.size += 1
+        self.labels.append(label)
+        self.fracs[index] = frac
+        self.occs[index] = occ
+        self.setAdp(index, adp)
+        self.sfacs[index] = sfac
+        self.afixes[index] = afix
+        self.parts[index] = part
+        self.resiNums[index] = resi[0]
+        self.setResiClass(index, resi[1])
+        return index
+
+    def addFrom(self, table, index):
+        """
+        Appends a copy of an atom of another table.
+        :param table: AtomTable instance
+        :param index: int<index of the atom in table>
+        :return: int<index of the new atom>
+        """
+        return self.add(table.labels[index], table.sfacs[index], table.fracs[index], table.occs[index],
+                        table.adps[index, :table.adpCounts[index]],
+                        resi=(table.resiNums[index], table.resiClassNames[table.resiClasses[index]]),
+                        afix=table.afixes[index], part=table.parts[index])
+
+    def take(self, table, indices):
+        """
+        Appends copies of a number of atoms of another table in one step.
+        :param table: AtomTable instance
+        :param indices: array like of int<indices of the atoms in table>
+        :return: int<index of the first new atom>
+        """
+        indices = np.asarray(indices, dtype=int)
+        start = self.size
+        while start + len(indices) > len(self.occs):
+            self._grow()
+        rows = slice(start, start + len(indices))
+        for name in self.ARRAYS:
+            getattr(self, name)[rows] = getattr(table, name)[indices]
+        classMap = np.array([self.resiClassIndex(cls) for cls in table.resiClassNames])
+        self.resiClasses[rows] = classMap[table.resiClasses[indices]]
+        self.labels.extend([table.labels[index] for index in indices])
+        self.size += len(indices)
+        return start
+
+    def setAdp(self, index, adp):
+        count = len(adp)
+        self.adps[index, :count] = adp
+        self.adps[index, count:] = 0
+        self.adpCounts[index] = count
+
+    def setResiClass(self, index, cls):
+        self.resiClasses[index] = self.resiClassIndex(cls)
+
+    def resiClassIndex(self, cls):
+        """
+        Returns the index of a residue class name in self.resiClassNames. Unknown names are added.
+        :param cls: str or None
+        :return: int
+        """
+        cls = cls if cls else ''
+        try:
+            return self._resiClassIndices[cls]
+        except KeyError:
+            self._resiClassIndices[cls] = len(self.resiClassNames)
+            self.resiClassNames.append(cls)
+            return self._resiClassIndices[cls]
+
+    def _grow(self):
+        """
+        Doubles the capacity of all arrays.
+        :return: None
+        """
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            grown = np.zeros((max(2 * len(array), 1),) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+
 class ShelxlAtom(ShelxlLine):
     """
     Class Representing an Atom in a Shelxl.res file.
+    The atom is a view of one row of an AtomTable. Assigning to its attributes modifies the table.
     """
-    lastAfix = 0
-    lastPart = 0
-    rewrite = False
+    __slots__ = ('table', 'index')
 
-    def __init__(self, line, virtual=False, key=None, resi=(0, ''), afix=0, part=0):
-        self.afix = afix
-        self.part = part
-        self.rawData = line
+    def __init__(self, table, index, key=None):
+        """
+        :param table: AtomTable instance
+        :param index: int<index of the atom in the table>
+        :param key: str
+        """
+        self.table = table
+        self.index = index
         self.key = key
-        data = [word for word in line.split() if word]
-        data = [float(word) if i else word for i, word in enumerate(data)]
-        self.data = data
-        self.resiClass = resi[1]
-        self.resiNum = resi[0]
+
+    @classmethod
+    def fromRecord(cls, line, table=None, key=None, resi=(0, ''), afix=0, part=0):
+        """
+        Parses an atom record and adds the atom to the given table.
+        :param line: str<complete atom record>
+        :param table: AtomTable instance. A new table is created by default.
+        :param key: str
+        :param resi: tuple<int<residue number>, str<residue class>>
+        :param afix: int
+        :param part: int
+        :return: ShelxlAtom instance
+        """
+        words = line.split()
+        data = [float(word) for word in words[1:]]
+        table = table if table is not None else AtomTable(capacity=1)
+        index = table.add(words[0], int(data[0]), data[1:4], data[4], data[5:], resi=resi, afix=afix, part=part)
+        return cls(table, index, key=key)
+
+    def copy(self):
+        """
+        Returns a copy of the atom stored in a table of its own.
+        :return: ShelxlAtom instance
+        """
+        table = AtomTable(capacity=1)
+        return ShelxlAtom(table, table.addFrom(self.table, self.index), key=self.key)
+
+    @property
+    def label(self):
+        return self.table.labels[self.index]
+
+    @property
+    def name(self):
         if self.resiClass:
-            ShelxlRestraint.RESICLASSOVERRIDE = None
-        if resi[1]:
-            self.name = str(data[0]) + '_{}'.format(resi[0])
-            # print(self.name)
-        else:
-            self.name = data[0]
-        self.sfac = int(data[1])
-        self.frac = Array(data[2:5])
-        self.occ = (data[5] // 1, data[5] % 1)
-        self.adp = Array(data[6:])
-        if virtual:
-            return
-        if self.name[0].upper() == 'Q':
-            self.qPeak = True
-            ShelxlReader.CURRENTMOLECULE.addQPeak(self)
-        else:
-            self.qPeak = False
-            ShelxlReader.CURRENTMOLECULE.addAtom(self)
+            return '{}_{}'.format(self.label, self.resiNum)
+        return self.label
+
+    @property
+    def qPeak(self):
+        return self.label[0].upper() == 'Q'
+
+    @property
+    def sfac(self):
+        return int(self.table.sfacs[self.index])
+
+    @property
+    def frac(self):
+        return self.table.fracs[self.index].view(Array)
+
+    @frac.setter
+    def frac(self, value):
+        self.table.fracs[self.index] = value
+
+    @property
+    def occ(self):
+        occ = float(self.table.occs[self.index])
+        return occ // 1, occ % 1
+
+    @occ.setter
+    def occ(self, value):
+        self.table.occs[self.index] = sum(value)
+
+    @property
+    def adp(self):
+        return self.table.adps[self.index, :self.table.adpCounts[self.index]].view(Array)
+
+    @adp.setter
+    def adp(self, value):
+        self.table.setAdp(self.index, value)
+
+    @property
+    def afix(self):
+        return int(self.table.afixes[self.index])
+
+    @afix.setter
+    def afix(self, value):
+        self.table.afixes[self.index] = value
+
+    @property
+    def part(self):
+        return int(self.table.parts[self.index])
+
+    @part.setter
+    def part(self, value):
+        self.table.parts[self.index] = value
+
+    @property
+    def resiNum(self):
+        return int(self.table.resiNums[self.index])
+
+    @resiNum.setter
+    def resiNum(self, value):
+        self.table.resiNums[self.index] = value
+
+    @property
+    def resiClass(self):
+        return self.table.resiClassNames[self.table.resiClasses[self.index]]
+
+    @resiClass.setter
+    def resiClass(self, value):
+        self.table.setResiClass(self.index, value)
 
     def __str__(self):
         return 'ATOM: {} {} {} {} {}'.format(self.name, self.sfac, self.frac, self.occ, self.adp)
 
-    def write(self):
+    def write(self, context=None):
         """
         Returns a string representation of a shelxl atom as expected by SHELXL.
+        :param context: RenderContext instance of the file being written
         :return: str
         """
-        if not self.part == ShelxlAtom.lastPart:
-            part = 'PART {}\n'.format(self.part)
-            ShelxlAtom.lastpart = self.part
+        if context is None:
+            context = RenderContext()
+        table, index = self.table, self.index
+        if not table.parts[index] == context.part:
+            part = 'PART {}\n'.format(table.parts[index])
+            context.part = table.parts[index]
         else:
             part = ''
-        if not self.afix == ShelxlAtom.lastAfix:
-            afix = 'AFIX {}\n'.format(self.afix)
-            ShelxlAtom.lastAfix = self.afix
+        if not table.afixes[index] == context.afix:
+            afix = 'AFIX {}\n'.format(table.afixes[index])
+            context.afix = table.afixes[index]
         else:
             afix = ''
-        string = '{name:8} {sfac} {frac} {occ:6.3f} {adp}\n'.format(name=self.name.split('_')[0],
-                                                                    sfac=self.sfac,
-                                                                    frac=' '.join(
-                                                                        ['{:6.4f}'.format(c) for c in self.frac]),
-                                                                    occ=sum(self.occ),
-                                                                    adp=' '.join(['{:6.4f}'.format(c) for c in self.adp]))
+        string = '{name:8} {sfac} {frac} {occ:6.3f} {adp}\n'.format(name=table.labels[index],
+                                                                    sfac=table.sfacs[index],
+                                                                    frac=' '.join(['{:6.4f}'.format(c) for c in
+                                                                                   table.fracs[index].tolist()]),
+                                                                    occ=table.occs[index],
+                                                                    adp=' '.join(['{:6.4f}'.format(c) for c in
+                                                                                  table.adps[index].tolist()
+                                                                                  [:table.adpCounts[index]]]))
         if len(string) > 75:
             string = string.split()
             string = string[:7] + ['=\n   '] + string[7:] + ['\n']
             string = ' '.join(string)
-        if ShelxlAtom.rewrite:
+        if context.rewrite:
             return part+afix+ string
         else:
             return string
@@ -869,6 +2784,10 @@ class ShelxlMolecule(object):
     be necessary to create the whole chemical molecule, or mutiple chemical molecules can be represented by one
     class instance in cases with multiple molecules per asymmetric unit.
     """
+    # Instructions that define the atoms and restraints. Files differing only in other instructions can be patched.
+    SPECIALDISTANCE = 0.1
+    OVERLAPDISTANCE = 0.5
+    SIGNATURECOMMANDS = ('DFIX', 'DANG', 'EQIV', 'RESI', 'SYMM', 'LATT', 'SFAC')
 
     def __init__(self):
         self.sfacs = []
@@ -876,10 +2795,12 @@ class ShelxlMolecule(object):
         self.atoms = []
         self.atomDict = OrderedDict()
         self.qPeaks = []
+        self.atomTable = AtomTable()
+        self.qPeakTable = AtomTable()
         self.cell = []
         self.cerr = []
         self.lattOps = []
-        self.symms = []
+        self.symmCards = []
         self.centric = False
         self.eqivs = {}
         self.dfixs = []
@@ -889,6 +2810,15 @@ class ShelxlMolecule(object):
         self.eqivSymmMap = {}
         self.resiClass2Nums = {}
         self.resis = []
+        self.dfixPlan = None
+        self.dfixMoments = None
+        self.virtualTable = AtomTable()
+        self.virtualRows = {}
+        self.virtualSources = []
+        self.virtualOperators = []
+        self.overlaps = []
+        self.signature = None
+        self.resiClassOverride = 'symm'
 
     def __iter__(self):
         for atom in self.atoms:
@@ -902,150 +2832,131 @@ class ShelxlMolecule(object):
         :param atom2: str
         :return: float
         """
-        x, y, z = atom1.frac
-        try:
-            xx, yy, zz = atom2.frac + 99.5
-        except TypeError:
-            xx, yy, zz = Array(atom2.frac) + 99.5
-        dx = (xx - x) % 1 - 0.5
-        dy = (yy - y) % 1 - 0.5
-        dz = (zz - z) % 1 - 0.5
-        a, b, c, alpha, beta, gamma = self.cell
-        alpha = alpha / 180. * pi
-        beta = beta / 180. * pi
-        gamma = gamma / 180. * pi
-        dd = a ** 2 * dx ** 2 + b ** 2 * dy ** 2 + c ** 2 * dz ** 2 + 2 * b * c * cos(
-            alpha) * dy * dz + 2 * a * c * cos(beta) * dx * dz + 2 * a * b * cos(gamma) * dx * dy
-        return dd ** .5
+        PROFILER.count('distance')
+        dx, dy, dz = (np.asarray(atom2.frac, dtype=float) - np.asarray(atom1.frac, dtype=float) + 99.5) % 1 - 0.5
+        dd = metricCoefficients(self.cell)[0].dot((dx * dx, dy * dy, dz * dz, dy * dz, dx * dz, dx * dy))
+        return float(dd) ** .5
 
     def asP1(self, full=False):
         """
         Generates and returns a new ShelxlMolecule instance where symmetry operations were applied to generate
         symmetry equivalent atoms. The returned instance represents the equivalent structural model in P1/P-1.
-        :return: ShelxlMolecule
+        All operators are applied to all atoms in one step. Close contacts are found with findCloseContacts(). Copies
+        closer than SPECIALDISTANCE to another copy of the same atom are atoms on special positions and are discarded.
+        Atoms of different origin that are closer than OVERLAPDISTANCE and not in different PARTs are listed in
+        overlaps of the returned instance as tuples of both atom names and their distance.
+        The copies generated by operator i are moved to
+        residue (i + 1) * offset + resiNum, where offset exceeds the largest residue number, so residues never
+        collide. Structures without residue classes are split into residues of class 'symm', starting with residue 1
+        for the asymmetric unit.
+        :param full: bool<also apply operators containing the center of inversion>
+        :return: ShelxlMolecule, list of ShelxlLine<RESI instructions and atoms in the order they are written>
         """
-        # full=True
-        try:
-            resiOffset = int(max(self.resis, key=lambda resi: int(resi[1]))[1])
-        except:
-            resiOffset = 1
-        # if resiOffset > 2:
-        #     raise ValueError('Expanding structures to P1/P-1 is not supported for structures '
-        #                      'containing multiple residues.')
         if not full:
             symms = [symm for symm in self.symms if not symm.centric]
         else:
             symms = self.symms[:]
-        # p1Atoms = {str(i + 2+resiOffset): [] for i in range(len(symms)*resiOffset)}
-        p1Mol = deepcopy(self)
-        p1Mol.symms = []
+        numAtoms = len(self.atoms)
+        table = self.atomTable
+        fracs = table.fracs[:numAtoms]
+        resiNums = table.resiNums[:numAtoms]
+        resiOffset = int(resiNums.max()) + 1 if numAtoms else 1
+        # The atoms are copied row by row below, so they are kept out of the deep copy.
+        p1Table = AtomTable(capacity=max(numAtoms * (len(symms) + 1), 1))
+        p1Mol = deepcopy(self, {id(self.atoms): [], id(self.atomDict): OrderedDict(), id(self.atomTable): p1Table,
+                                id(self.dfixPlan): None, id(self.dfixMoments): None})
+        p1Mol.symmCards = []
         p1Mol.centric = False
         p1Mol.lattOps = []
-        specials = []
-        # equivSymmMap = {}
-        for atom in self.atoms[:]:
-            # p1Mol.addAtom(atom)
-            # print(atom.name)
-            for i, symm in enumerate(symms):
-                # break
-                resiKey = str((i+1)*(resiOffset)+(int(atom.resiNum if atom.resiNum else 0)))
-                # print(resiKey, i)
-                newFrac = symm.matrix.dot(atom.frac)
-                newFrac = newFrac + symm.trans
-                vAtom = ShelxlAtom(atom.rawData, virtual=True)
-                vAtom.resiClass = atom.resiClass
-                vAtom.resiNum = resiKey
-                vAtom.afix = atom.afix
-                vAtom.part = atom.part
-                vAtom.frac = newFrac
-                # vAtom.name += 'X{}'.format(i)
-                vAtom.occ = (10, 1)
-                atom.occ = (10, 1)
-                distance = self.distance(atom, vAtom)
-                specialName = atom.name.split('_')[0] + '_' + resiKey
-                if distance < 0.1:
-                    # print('Atom {} on special position. (SYMM {})'.format(atom.name, i))
-
-                    specials.append(specialName)
-                    continue
-                else:
-                    # p1Atoms[resiKey].append(vAtom)
-                    p1Mol.addAtom(vAtom)
-                    p1Mol.atomDict[specialName] = vAtom
-
-                # for key, eqiv in self.eqivs.items():
-                #     if symm == eqiv:
-                #         d = eqiv - symm
-                #         newEqiv = SymmetryElement(['{}+X'.format(d[0]), '{}+Y'.format(d[1]), '{}+Z'.format(d[2])])
-                #         if not key in equivSymmMap:
-                #             equivSymmMap[key] = (resiKey, newEqiv)
+        p1Table.take(table, np.arange(numAtoms))
+        p1Mol.atoms = [ShelxlAtom(p1Table, index, key=atom.key) for index, atom in enumerate(self.atoms)]
+        first = numAtoms
+        # Positions of the atoms followed by the positions of their copies, atom by atom.
+        if symms and numAtoms:
+            affines = np.array([symm.affine for symm in symms])
+            newFracs = np.einsum('sij,nj->nsi', affines[:, :, :3], fracs) + affines[np.newaxis, :, :, 3]
+            positions = np.concatenate((fracs, newFracs.reshape(-1, 3)))
+        else:
+            newFracs = np.zeros((numAtoms, 0, 3))
+            positions = fracs
+        sources = np.concatenate((np.arange(numAtoms), np.repeat(np.arange(numAtoms), len(symms))))
+        contacts1, contacts2, distances = findCloseContacts(positions, self.cell,
+                                                            max(self.SPECIALDISTANCE, self.OVERLAPDISTANCE))
+        special = (sources[contacts1] == sources[contacts2]) & (distances < self.SPECIALDISTANCE)
+        discarded = np.zeros(len(positions), dtype=bool)
+        discarded[contacts2[special]] = True
+        atomIndices, symmIndices = np.nonzero(~discarded[numAtoms:].reshape(numAtoms, len(symms)))
+        p1Rows = np.full(len(positions), -1, dtype=int)
+        p1Rows[:numAtoms] = np.arange(numAtoms)
+        p1Rows[numAtoms + atomIndices * len(symms) + symmIndices] = np.arange(len(atomIndices)) + numAtoms
+        if len(atomIndices):
+            newFracs = newFracs[atomIndices, symmIndices]
+            p1Table.take(table, atomIndices)
+            rows = slice(first, first + len(atomIndices))
+            p1Table.fracs[rows] = newFracs
+            p1Table.occs[rows] = 11.
+            p1Table.resiNums[rows] = (symmIndices + 1) * resiOffset + resiNums[atomIndices]
+            p1Mol.atoms += [ShelxlAtom(p1Table, index, key='atom') for index in range(first, len(p1Table))]
+        numP1Atoms = len(p1Mol.atoms)
+        if self.resiClassOverride:
+            p1Table.resiNums[:numP1Atoms] += 1
+            p1Table.resiClasses[:numP1Atoms] = p1Table.resiClassIndex(self.resiClassOverride)
+
+        p1Mol.resis = []
+        p1Mol.resiClass2Nums = {}
+        residues = np.unique(np.stack((p1Table.resiNums[:numP1Atoms], p1Table.resiClasses[:numP1Atoms]), axis=1),
+                             axis=0)
+        for num, cls in residues:
+            if cls:
+                p1Mol.addResidue(int(num), p1Table.resiClassNames[cls])
+        names = [atom.name for atom in p1Mol.atoms[:first]]
+        names += ['{}_{}'.format(atom.label, atom.resiNum) for atom in p1Mol.atoms[first:]]
+        p1Mol.atomDict = OrderedDict(zip(names, p1Mol.atoms))
+
+        rows1 = p1Rows[contacts1]
+        rows2 = p1Rows[contacts2]
+        parts1 = p1Table.parts[rows1]
+        parts2 = p1Table.parts[rows2]
+        overlapping = ((sources[contacts1] != sources[contacts2]) & (rows1 >= 0) & (rows2 >= 0) &
+                       (distances < self.OVERLAPDISTANCE) & ((parts1 == 0) | (parts2 == 0) | (parts1 == parts2)))
+        p1Mol.overlaps = [(names[row1], names[row2], float(distance)) for row1, row2, distance in
+                          zip(rows1[overlapping], rows2[overlapping], distances[overlapping])]
 
         # Expand DFIX restraints.
         for dfix in p1Mol.dfixs:
             dfix.pairs = [pair for pair in dfix.pairs if not any(['_$' in a for a in  pair])]
-            if ShelxlRestraint.RESICLASSOVERRIDE:
-                dfix.setSuffix(ShelxlRestraint.RESICLASSOVERRIDE)
-        # for atom in self.atoms:
-        #     for i, symm in enumerate(symms):
-        #         resiKey = str(i + 2+resiOffset)
-        #
-        #         for k, dfix in enumerate(p1Mol.dfixs):
-        #             pairs = set(dfix[2])
-        #             newpairs = set()
-        #             for pair in pairs:
-        #                 ii = 0
-        #                 if '_$' in pair[0]:
-        #                     ii = 0
-        #                 elif '_$' in pair[1]:
-        #                     ii = 1
-        #                 if ii:
-        #                     continue
-        #                 if atom.name in pair:
-        #                     newPair = (pair[0] + '_' + resiKey, pair[1] + '_' + resiKey)
-        #                     if newPair[0] in specials or newPair[1] in specials:
-        #                         continue
-        #                     else:
-        #                         newpairs.add(newPair)
-        #             p1Mol.dfixs[k] = (dfix[0], dfix[1], list(pairs.union(newpairs)))
-        # self.eqivSymmMap = equivSymmMap
+            if self.resiClassOverride:
+                dfix.setSuffix(self.resiClassOverride)
+        p1Mol.dfixs = [dfix for dfix in p1Mol.dfixs if dfix.pairs]
+        p1Mol._clearVirtualAtoms()
         p1Mol._finalizeDfix()
-        p1AtomList = []
-
-        atomDict = {}
-        for atom in p1Mol.atoms:
-            try:
-                atomDict[int(atom.resiNum) if atom.resiNum else 0].append(atom)
-            except KeyError:
-                atomDict[int(atom.resiNum) if atom.resiNum else 0] = [atom]
-        for key in sorted(atomDict.keys()):
-            # print( key)
-            atoms = atomDict[key]
-            cls = ShelxlRestraint.RESICLASSOVERRIDE if ShelxlRestraint.RESICLASSOVERRIDE else atoms[0].resiClass
-            if cls == 'symm':
-                key +=1
-            p1AtomList.append(ShelxlLine('RESI {} {}'.format(cls, key)))
-            for atom in atoms:
-                p1AtomList.append(atom)
-
-
-
-        # for atom in p1AtomList:
-        #     try:
-        #         print(atom.name)
-        #     except:
-        #         print(atom)
-        #
-        # exit()
 
+        p1AtomList = []
+        order = np.argsort(p1Table.resiNums[:numP1Atoms], kind='mergesort')
+        lastNum = None
+        for index in order:
+            atom = p1Mol.atoms[index]
+            if atom.resiNum != lastNum:
+                lastNum = atom.resiNum
+                p1AtomList.append(ShelxlLine('RESI {} {}'.format(atom.resiClass, lastNum)))
+            p1AtomList.append(atom)
         return p1Mol, p1AtomList
 
     def addAtom(self, atom):
         """
-        Add an atom.
+        Add an atom. The atom is moved to the end of self.atomTable if it is not already stored there, so the index of
+        an atom in self.atoms is its row in self.atomTable.
+        Residue classes are not replaced by 'symm' during P1 expansion once an atom belonging to a residue class was
+        added.
         :param atom: ShelxlAtom
         :return: None
         """
+        if atom.table is not self.atomTable or atom.index != len(self.atoms):
+            atom.index = self.atomTable.addFrom(atom.table, atom.index)
+            atom.table = self.atomTable
         self.atoms.append(atom)
+        if atom.resiClass:
+            self.resiClassOverride = None
 
     def addResidue(self, num, cls):
         try:
@@ -1057,9 +2968,12 @@ class ShelxlMolecule(object):
     def addQPeak(self, qPeak):
         """
         Add a Q-Peak
-        :param qPeak: ShelxlLine
+        :param qPeak: ShelxlAtom
         :return: None
         """
+        if qPeak.table is not self.qPeakTable or qPeak.index != len(self.qPeaks):
+            qPeak.index = self.qPeakTable.addFrom(qPeak.table, qPeak.index)
+            qPeak.table = self.qPeakTable
         self.qPeaks.append(qPeak)
 
     def setCell(self, cell):
@@ -1115,39 +3029,34 @@ class ShelxlMolecule(object):
         self.customSfacData[symbol] = data
         self.sfacs.append(symbol)
 
+    @property
+    def symms(self):
+        """
+        All symmetry operations of the space group except the identity, see expandSymmetry(). The result does not
+        depend on the order of the SYMM and LATT instructions.
+        :return: list of SymmetryElement instances
+        """
+        return expandSymmetry(self.symmCards, self.lattOps, self.centric)
+
     def addSymm(self, symmData):
         """
-        Add the content of a Shelxl SYMM command to generate the appropriate SymmetryElement instance.
+        Add the content of a Shelxl SYMM command.
         :param symmData: list of strings. eg.['1/2+X', '1/2+Y', '1/2+Z']
         :return: None
         """
-        newSymm = SymmetryElement(symmData)
-        self.symms.append(newSymm)
-        for symm in self.lattOps:
-            lattSymm = newSymm.applyLattSymm(symm)
-            self.symms.append(lattSymm)
-        if self.centric:
-            self.symms.append(SymmetryElement(symmData, centric=True))
-            for symm in self.lattOps:
-                lattSymm = newSymm.applyLattSymm(symm)
-                lattSymm.centric = True
-                self.symms.append(lattSymm)
+        self.symmCards.append(internSymmetryElement(*parseSymmetryOperator(symmData)))
 
     def setCentric(self, value):
         """
-        Defines the instance as representing a centrosymmetric structure. Generates the appropriate SymmetryElement
-        instances automatically if called before adding further SYMM commands via self.addSymm().
+        Defines the instance as representing a centrosymmetric structure.
         :param value: bool
         :return: None
         """
         self.centric = value
-        self.symms.append(SymmetryElement(['-X', '-Y', '-Z']))
-        self.symms[-1].centric = True
 
     def setLattOps(self, lattOps):
         """
-        Adds lattice operations. If called before adding SYMM commands, the appropriate lattice operations are used
-        automatically to generate further SymmetryElements.
+        Sets the lattice centering operations.
         :param lattOps: list of SymmetryElement instances.
         :return: None
         """
@@ -1168,8 +3077,7 @@ class ShelxlMolecule(object):
         :param data: list of strings equivalent to self.addSymm(symmData).
         :return: None
         """
-        symm = SymmetryElement(data)
-        self.eqivs[name] = symm
+        self.eqivs[name] = internSymmetryElement(*parseSymmetryOperator(data))
 
     def getAtom(self, atomName):
         """
@@ -1177,6 +3085,7 @@ class ShelxlMolecule(object):
         :param atomName: string
         :return: ShelxlAtom instance
         """
+        PROFILER.count('getAtom')
         if '_$' in atomName:
             return self.getVirtualAtom(atomName)
         try:
@@ -1196,17 +3105,124 @@ class ShelxlMolecule(object):
 
     def getVirtualAtom(self, atomName):
         """
-        Generates and returns a virtual atom -- an atom that is referenced with an EQIV instruction.
+        Returns a virtual atom -- an atom that is referenced with an EQIV instruction.
         :param atomName: str eg. 'O1_$1'
         :return: ShelxlAtom instance
         """
         base, equiv = atomName.split('_$')
-        symm = self.eqivs['$' + equiv]
-        atom = self.getAtom(base)
-        newFrac = (symm.matrix.dot(atom.frac) + symm.trans)
-        vAtom = ShelxlAtom(atom.rawData, virtual=True)
-        vAtom.frac = newFrac
-        return vAtom
+        index = self.getAtom(base).index
+        row = self._virtualRow(index, self.eqivs['$' + equiv])
+        self._updateVirtualAtoms(len(self.virtualTable))
+        return ShelxlAtom(self.virtualTable, row, key=self.atoms[index].key)
+
+    def getCoordinates(self):
+        """
+        Returns the fractional coordinates of all atoms followed by the coordinates of all virtual atoms.
+        :return: numpy.ndarray of shape (len(self.atoms) + len(self.virtualSources), 3)
+        """
+        self._updateVirtualAtoms(len(self.virtualTable))
+        return np.concatenate((self.atomTable.fracs[:len(self.atoms)], self.virtualTable.fracs[:len(self.virtualTable)]))
+
+    def _virtualRow(self, index, symm):
+        """
+        Returns the row of the atom generated by applying a symmetry operation to an atom in self.virtualTable.
+        Each atom and operator pair gets one row. The coordinates are computed by self._updateVirtualAtoms() and
+        are only computed again when reload() patches the coordinates of the atoms.
+        :param index: int<index of the atom in self.atoms>
+        :param symm: SymmetryElement instance
+        :return: int
+        """
+        key = (index, symm.rotation, symm.translation)
+        try:
+            return self.virtualRows[key]
+        except KeyError:
+            self.virtualRows[key] = len(self.virtualSources)
+            self.virtualSources.append(index)
+            self.virtualOperators.append(symm)
+            return self.virtualRows[key]
+
+    def _updateVirtualAtoms(self, first=0):
+        """
+        Computes the coordinates of the virtual atoms. Atoms generated by the same operator are transformed in one
+        step.
+        :param first: int<first row to compute>
+        :return: None
+        """
+        table = self.virtualTable
+        if len(table) < len(self.virtualSources):
+            table.take(self.atomTable, self.virtualSources[len(table):])
+        groups = OrderedDict()
+        for row in range(first, len(self.virtualSources)):
+            symm = self.virtualOperators[row]
+            group = groups.setdefault((symm.rotation, symm.translation), (symm, [], []))
+            group[1].append(row)
+            group[2].append(self.virtualSources[row])
+        for symm, rows, indices in groups.values():
+            table.fracs[rows] = symm.apply(self.atomTable.fracs[indices])
+
+    def _clearVirtualAtoms(self):
+        """
+        Discards all virtual atoms.
+        :return: None
+        """
+        self.virtualTable = AtomTable()
+        self.virtualRows = {}
+        self.virtualSources = []
+        self.virtualOperators = []
+
+    def reload(self, fileName):
+        """
+        Updates the molecule to the structure stored in the given shelxl.res file.
+        If the file contains the same atoms and restraints as the file the molecule was read from, only coordinates,
+        occupancies, ADPs and the cell are patched into the existing atoms and the compiled restraints are kept.
+        Otherwise the file is parsed completely.
+        :param fileName: str
+        :return: bool<True if the molecule was patched in place>
+        """
+        if self.signature is not None and self._patch(fileName):
+            return True
+        self.__dict__ = ShelxlReader().read(fileName).__dict__
+        return False
+
+    def _patch(self, fileName):
+        """
+        Reads only the CELL and atom records of a shelxl.res file and copies their values into the existing atoms.
+        :param fileName: str
+        :return: bool<False if the file does not match the molecule. The molecule is left unchanged in that case.>
+        """
+        signature = []
+        records = []
+        cell = None
+        with Reader(fileName) as reader:
+            for command, body, _ in readRecords(reader):
+                if command in self.SIGNATURECOMMANDS:
+                    signature.append(' '.join(body.split()).upper())
+                elif command == 'CELL':
+                    cell = body.split()[2:]
+                elif command and command not in RECORDPARSERS:
+                    words = body.split()
+                    if words[0][0].upper() != 'Q':
+                        records.append(words)
+        if signature != self.signature or len(records) != len(self.atoms) or cell is None:
+            return False
+        table = self.atomTable
+        try:
+            values = [[float(word) for word in words[2:]] for words in records]
+        except ValueError:
+            return False
+        for words, data in zip(records, values):
+            if len(data) < 4:
+                return False
+        if [words[0] for words in records] != table.labels[:len(self.atoms)]:
+            return False
+        for index, data in enumerate(values):
+            table.fracs[index] = data[:3]
+            table.occs[index] = data[3]
+            table.setAdp(index, data[4:])
+        self.setCell(cell)
+        self._updateVirtualAtoms()
+        self.dfixMoments = None
+        return True
 
     def finalize(self):
         """
@@ -1216,6 +3232,7 @@ class ShelxlMolecule(object):
         self.atomDict = OrderedDict()
         for atom in self.atoms:
             self.atomDict[atom.name] = atom
+        self._clearVirtualAtoms()
         self._finalizeDfix()
         # self.checkDfix()
 
@@ -1225,112 +3242,218 @@ class ShelxlMolecule(object):
         weighted difference.
         :return: (float<mean>, float<weightedMean>)
         """
-        if not any(self.dfixTable.values()):
-            raise ValueError('No DFIX restraints found.')
-        vSum = 0
-        wSum = 0
-        sum = 0
-        i = 0
-        for atom1, dfixs in self.dfixTable.items():
-            for atom2, data in dfixs.items():
-                target, err = data
-                # print(target, err                      )
-                # print(atom1, atom2)
-                # exit()
-                a1s = self.getAtom(atom1)
-                a2s = self.getAtom(atom2)
-                if type(a1s) is list and type(a2s) is list:
-                    for a1, a2 in zip(a1s, a2s):
-                        d = self.distance(a1, a2)
-                        diff = abs(d - target) ** 2
-                        vSum += diff * err
-                        wSum += err
-                        sum += diff
-                        i += 1
-                elif type(a1s) is list or type(a2s) is list:
-                    raise ValueError('Cellopt does not support restraints between different residues.')
-                else:
-                    d = self.distance(self.getAtom(atom1), self.getAtom(atom2))
-                    diff = abs(d - target) ** 2
-                    vSum += diff * err
-                    wSum += err
-                    sum += diff
-                    i += 1
-        # print((sum / i) ** .5, (vSum / wSum) ** .5)
-        # exit()
-        return (sum / i) ** .5, (vSum / wSum) ** .5
+        means, weighteds = self.checkDfixCells([self.cell])
+        return float(means[0]), float(weighteds[0])
 
-    def _finalizeDfix(self):
-        dfixTable = {atom.name.upper(): {} for atom in self.atoms}
+    def checkDfixCells(self, cells):
+        """
+        Compute the mean and the weighted difference between restrained target values and actual distances for a
+        number of cells at once.
+        :param cells: list of cells, each a list of six floats
+        :return: (numpy.ndarray<means>, numpy.ndarray<weightedMeans>)
+        """
+        moments = self.getDfixMoments()
+        if not len(moments):
+            raise ZeroDivisionError('No restrained atom pairs found.')
+        dd = moments[:, :6].dot(metricCoefficients(cells).T)
+        targets = moments[:, 6:7]
+        weights = moments[:, 7:8]
+        with np.errstate(invalid='ignore'):
+            diff = (np.sqrt(dd) - targets) ** 2
+        return np.sqrt(diff.mean(axis=0)), np.sqrt((diff * weights).sum(axis=0) / weights.sum())
+
+    def stripped(self):
+        """
+        Returns a ShelxlMolecule that only holds the cell and the restraint moments of this instance. It supports
+        checkDfixCells() and all optimizer backends and is cheap to send to other processes.
+        :return: ShelxlMolecule instance
+        """
+        molecule = ShelxlMolecule()
+        molecule.cell = [float(x) for x in self.cell]
+        molecule.dfixMoments = self.getDfixMoments()
+        return molecule
+
+    def getDfixMoments(self):
+        """
+        Returns the cell invariant part of all restrained distances. Each row holds the products
+        dx**2, dy**2, dz**2, dy*dz, dx*dz, dx*dy of the fractional coordinate differences of one restrained atom pair,
+        followed by the target distance and the weight of the restraint.
+        The matrix is computed on first use and cached until the restraint table is rebuilt.
+        :return: numpy.ndarray of shape (n, 8)
+        """
+        if self.dfixMoments is not None:
+            return self.dfixMoments
+        with PROFILER.phase('restraints'):
+            return self._computeDfixMoments()
+
+    def _computeDfixMoments(self):
+        """
+        Computes the matrix returned by getDfixMoments() and stores it in self.dfixMoments.
+        :return: numpy.ndarray of shape (n, 8)
+        """
+        plan = self.getDfixPlan()
+        fracs = self.getCoordinates()
+        moments = np.zeros((len(plan), 8))
+        if len(plan):
+            dx, dy, dz = plan.fractionalDifferences(fracs).T
+            moments[:, 0] = dx * dx
+            moments[:, 1] = dy * dy
+            moments[:, 2] = dz * dz
+            moments[:, 3] = dy * dz
+            moments[:, 4] = dx * dz
+            moments[:, 5] = dx * dy
+            moments[:, 6] = plan.targets
+            moments[:, 7] = plan.weights
+        self.dfixMoments = moments
+        return moments
+
+    def getDfixPlan(self):
+        """
+        Returns the compiled restraint plan. The plan is compiled on first use and cached until the restraints are
+        finalized again.
+        :return: RestraintPlan instance
+        """
+        if self.dfixPlan is None:
+            self.dfixPlan = self.compileRestraints()
+        return self.dfixPlan
+
+    def compileRestraints(self):
+        """
+        Resolves the atom names of all DFIX and DANG restraints once. Residue class names are expanded to one atom
+        pair per residue, EQIV references are mapped to the corresponding operator and pairs restrained more than
+        once are only kept the first time they occur.
+        :return: RestraintPlan instance
+        """
+        plan = RestraintPlan()
+        found = False
         for dfix in self.dfixs:
             target, err, pairs = dfix
             cls = dfix.suffix
             if not err:
                 err = self.dfixErr
             for atom1, atom2 in pairs:
-                atom1 = atom1.upper()+('_'+cls if cls else '')
-                atom2 = atom2.upper() + ('_'+cls if cls else '')
-                try:
-                    tableRow1 = dfixTable[atom1]
-                except KeyError:
-                    tableRow1 = {}
-                    dfixTable[atom1] = tableRow1
-                try:
-                    tableField1 = tableRow1[atom2]
-                except KeyError:
-                    tableRow1[atom2] = (target, err)
+                found = True
+                atom1 = atom1.upper() + ('_' + cls if cls else '')
+                atom2 = atom2.upper() + ('_' + cls if cls else '')
+                a1s = self._resolveRestraintAtom(atom1)
+                a2s = self._resolveRestraintAtom(atom2)
+                if type(a1s) is OrderedDict and type(a2s) is OrderedDict:
+                    for num, index1 in a1s.items():
+                        try:
+                            index2 = a2s[num]
+                        except KeyError:
+                            continue
+                        plan.add(index1, index2, target, err)
+                elif type(a1s) is OrderedDict or type(a2s) is OrderedDict:
+                    raise ValueError('Cellopt does not support restraints between different residues.')
+                else:
+                    plan.add(a1s, a2s, target, err)
+        if not found:
+            raise ValueError('No DFIX restraints found.')
+        plan.finalize()
+        return plan
 
+    def _resolveRestraintAtom(self, atomName):
+        """
+        Resolves an atom name used in a restraint to a row of self.getCoordinates(). Distances are computed with the
+        shortest lattice translation, so atoms referenced with an EQIV instruction are generated with the operator
+        reduced modulo lattice translations. EQIV instructions that only differ by a lattice translation thus share
+        their virtual atoms.
+        :param atomName: str eg. 'C1', 'O1_$1' or 'C4_cls'
+        :return: int or OrderedDict mapping residue numbers to ints
+        """
+        if '_$' in atomName:
+            base, equiv = atomName.split('_$')
+            index = self._resolveRestraintAtom(base)
+            symm = self.eqivs['$' + equiv]
+            if symm.key == IDENTITYKEY:
+                return index
+            return len(self.atoms) + self._virtualRow(index, internSymmetryElement(*symm.key))
+        try:
+            return self.atomDict[atomName].index
+        except KeyError:
+            if '_' in atomName:
+                base, cls = atomName.split('_')
+                resolved = OrderedDict()
+                for num in self.resiClass2Nums[cls]:
+                    name = '{}_{}'.format(base, num)
+                    if name in self.atomDict:
+                        resolved[num] = self.atomDict[name].index
+                return resolved
+            raise KeyError('No atom named {}.'.format(atomName))
 
-                try:
-                    tableRow2 = dfixTable[atom2]
-                except KeyError:
-                    tableRow2 = {}
-                    dfixTable[atom2] = tableRow2
-                try:
-                    tableField2 = tableRow2[atom1]
-                except KeyError:
-                    tableRow2[atom1] = (target, err)
+    def _finalizeDfix(self):
+        """
+        Discards the compiled restraints. They are compiled again from self.dfixs on next use.
+        :return: None
+        """
+        self.dfixPlan = None
+        self.dfixMoments = None
 
-        for target, err, pairs in self.dangs:
-            if not err:
-                err = self.dangErr
-            for atom1, atom2 in pairs:
-                atom1 = atom1.upper()
-                try:
-                    tableRow1 = dfixTable[atom1]
-                except KeyError:
-                    tableRow1 = {}
-                    dfixTable[atom1] = tableRow1
-                try:
-                    tableField1 = tableRow1[atom2]
-                except KeyError:
-                    tableRow1[atom2] = (target, err)
 
-                atom2 = atom2.upper()
-                try:
-                    tableRow2 = dfixTable[atom2]
-                except KeyError:
-                    tableRow2 = {}
-                    dfixTable[atom2] = tableRow2
-                try:
-                    tableField2 = tableRow2[atom1]
-                except KeyError:
-                    tableRow2[atom1] = (target, err)
-        self.dfixTable = dfixTable
+class RestraintPlan(object):
+    """
+    Flat and deduplicated representation of all restrained atom pairs of a ShelxlMolecule.
+    Atoms are referenced by their row in ShelxlMolecule.getCoordinates(), so atoms generated by an EQIV instruction
+    are looked up like all other atoms.
+    """
+
+    def __init__(self):
+        self.index1 = []
+        self.index2 = []
+        self.targets = []
+        self.weights = []
+        self._keys = set()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def add(self, index1, index2, target, weight):
+        """
+        Adds a restrained atom pair. Pairs that were added before are ignored.
+        :param index1: int
+        :param index2: int
+        :param target: float
+        :param weight: float
+        :return: None
+        """
+        key = (index1, index2) if index1 < index2 else (index2, index1)
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        self.index1.append(index1)
+        self.index2.append(index2)
+        self.targets.append(target)
+        self.weights.append(weight)
+
+    def finalize(self):
+        """
+        Converts the collected pairs to arrays.
+        :return: None
+        """
+        self.index1 = np.array(self.index1, dtype=int)
+        self.index2 = np.array(self.index2, dtype=int)
+        self.targets = np.array(self.targets, dtype=float)
+        self.weights = np.array(self.weights, dtype=float)
+        self._keys = None
+
+    def fractionalDifferences(self, fracs):
+        """
+        Computes the shortest fractional difference vector of each restrained pair. Lattice translations are ignored.
+        :param fracs: numpy.ndarray of shape (number of atoms and virtual atoms, 3)
+        :return: numpy.ndarray of shape (len(self), 3)
+        """
+        return (fracs[self.index2] - fracs[self.index1] + 99.5) % 1 - 0.5
 
 
 class ShelxlReader(object):
     """
     Interface to read and interact with shelxl.res files.
     """
-    CURRENTMOLECULE = None
-    CURRENTINSTANCE = None
 
     def __init__(self):
-        self.currentResi = ('', 0)
-        self.currentAfix = 0
-        self.currentPart = 0
         self.lines = []
+        self.rewrite = False
         self.atoms = []
         self._shelxlDict = {}
 
@@ -1340,32 +3463,27 @@ class ShelxlReader(object):
         :param fileName: str
         :return: ShelxlMolecule instance
         """
-        ShelxlReader.CURRENTMOLECULE = ShelxlMolecule()
-        ShelxlReader.CURRENTINSTANCE = self
-        parser = LineParser()
-        with Reader(fileName) as reader:
-            for line in reader.readlines():
-                if line[0] is '+':
-                    reader.insert(line[1:-1])
-                    line = '+    ' + line[1:]
+        context = ParseContext(self, ShelxlMolecule())
+        signature = []
+        with PROFILER.phase('parse'), Reader(fileName) as reader:
+            for command, body, raw in readRecords(reader):
+                if command in ShelxlMolecule.SIGNATURECOMMANDS:
+                    signature.append(' '.join(body.split()).upper())
                 try:
-                    parser, line = parser(line)
+                    line = parseRecord(command, body, raw, context)
                 except KeyError:
-                    print('An unexpected error occured while reading line\n   {}'.format(line.strip()))
-                    exit(5)
-                if line:
-                    self.lines.append(line)
+                    raise CelloptError('An unexpected error occured while reading line\n   {}'.format(body.strip()), 5)
+                self.lines.append(line)
         # for line in self.lines:
         #     print(line)
 
-        # for atom1 in self.CURRENTMOLECULE.atoms:
-        # for atom2 in self.CURRENTMOLECULE.atoms:
-        #     print(self.CURRENTMOLECULE.distance( atom1, atom2))
+        # for atom1 in molecule.atoms:
+        # for atom2 in molecule.atoms:
+        #     print(molecule.distance( atom1, atom2))
         # print(atom1.name)
-        molecule = ShelxlReader.CURRENTMOLECULE
+        molecule = context.molecule
+        molecule.signature = signature
         molecule.finalize()
-        ShelxlReader.CURRENTMOLECULE = None
-        ShelxlReader.CURRENTINSTANCE = None
         self.molecule = molecule
         # for atom in self.molecule:
         #     print(atom.name, atom.resiNum)
@@ -1379,13 +3497,14 @@ class ShelxlReader(object):
         :param fileName: str
         :return: None
         """
-        with open(fileName, 'w') as fp:
+        with PROFILER.phase('write'), open(fileName, 'w') as fp:
+            context = RenderContext(rewrite=self.rewrite)
             for line in self.lines:
                 key = line.key
                 try:
                     data = self[key]
                 except KeyError:
-                    fp.write(line.write())
+                    fp.write(line.write(context))
                 else:
                     fp.write(data + '\n')
 
@@ -1397,7 +3516,7 @@ class ShelxlReader(object):
         :return: None
         """
         self.molecule, newAtoms = self.molecule.asP1(full=full)
-        ShelxlAtom.rewrite = True
+        self.rewrite = True
         for i, line in enumerate(self.lines):
             if line.key is 'latt':
                 if '-' in line.line or full:
@@ -1431,21 +3550,6 @@ class ShelxlReader(object):
         # self.write('p1.ins')
         # exit()
 
-    def setCurrentResi(self, cls, num):
-        """
-        Sets the current RESIDUE.
-        :param cls: str
-        :param num: int
-        :return: None
-        """
-        self.currentResi = (cls, num)
-
-    def setCurrentAfix(self, afix):
-        self.currentAfix = afix
-
-    def setCurrentPart(self, part):
-        self.currentPart = part
-
     def __getitem__(self, item):
         """
         Returns a structural attribute of the given name.
@@ -1464,142 +3568,123 @@ class ShelxlReader(object):
         self._shelxlDict[key] = value
 
 
-class BaseParser(object):
+class ParseContext(object):
     """
-    Base class for parsers.
+    State of a single ShelxlReader.read() call. Parsers receive the context of the read they belong to instead of
+    sharing global state, so several files can be parsed at the same time.
     """
-    RETURNTYPE = None
-    KEY = None
 
-    def __init__(self, line):
-        self.body = line
+    def __init__(self, reader, molecule):
+        """
+        :param reader: ShelxlReader instance
+        :param molecule: ShelxlMolecule instance the records are added to
+        """
+        self.reader = reader
+        self.molecule = molecule
+        self.currentResi = (0, '')
+        self.currentAfix = 0
+        self.currentPart = 0
 
-    def __call__(self, line):
-        self.finished()
-        return LineParser(), line
+    def setCurrentResi(self, cls, num):
+        """
+        Sets the current RESIDUE. The residue is stored as (num, cls) as expected by ShelxlAtom.
+        :param cls: str
+        :param num: int
+        :return: None
+        """
+        self.currentResi = (num, cls)
 
-    def get(self, previousParser):
-        if not self.body.endswith('='):
-            self.finished()
-            return previousParser, self.RETURNTYPE(self.body, key=self.KEY)
-        else:
-            self.body = self.body[:-1]
-            return self, None
+    def setCurrentAfix(self, afix):
+        self.currentAfix = afix
 
-    def finished(self):
-        pass
+    def setCurrentPart(self, part):
+        self.currentPart = part
 
 
-class LineParser(BaseParser):
+def readRecords(reader):
+    """
+    Splits the lines of a shelxl.res file into logical records. A line ending with '=' is joined with the following
+    indented line in a single pass, so parsers always receive complete records. Files referenced by '+' lines are
+    inserted into the reader as soon as the reference is read.
+    :param reader: Reader instance
+    :return: Yield tuple<str<command or None>, str<joined record>, str<record as written in the file>>
+    """
+    record = None
+    for line in reader.readlines():
+        line = line.rstrip('\r\n')
+        if record is not None:
+            if line[:1] == ' ' and record[-1].rstrip().endswith('='):
+                record.append(line)
+                continue
+            yield _record(record)
+            record = None
+        if line[:1] == '+':
+            reader.insert(line[1:].strip())
+            yield '+', '', '+    ' + line[1:]
+            continue
+        record = [line]
+    if record is not None:
+        yield _record(record)
+
+
+def _record(lines):
     """
-    Default parser for lines in shelxl.res files.
-    The parser will identify if a more specialized parser is required, and creates one if necessary.
+    Creates the tuple yielded by readRecords() from the physical lines of one record.
+    :param lines: list of str
+    :return: tuple<str<command or None>, str<joined record>, str<record as written in the file>>
     """
+    if len(lines) == 1:
+        body = raw = lines[0]
+    else:
+        body = ''.join([line.rstrip()[:-1] for line in lines[:-1]] + lines[-1:])
+        raw = '\n'.join(lines)
+    if not body or body[0] == ' ':
+        return None, body, raw
+    return body[:4].upper().rstrip(), body, raw
 
-    def __init__(self):
-        self.COMMANDS = {'REM': self.doNothing,
-                         'BEDE': self.doNothing,
-                         'MOLE': self.doNothing,
-                         'TITL': self.doNothing,
-                         'CELL': CellParser,
-                         'ZERR': CerrParser,
-                         'SYMM': SymmParser,
-                         'SFAC': SfacParser,
-                         'UNIT': self.doNothing,
-                         'TEMP': self.doNothing,
-                         'L.S.': self.doNothing,
-                         'BOND': self.doNothing,
-                         'ACTA': self.doNothing,
-                         'LIST': self.doNothing,
-                         'PLAN': self.doNothing,
-                         'WGHT': self.doNothing,
-                         'FVAR': self.doNothing,
-                         'SIMU': self.doNothing,
-                         'RIGU': self.doNothing,
-                         'SADI': self.doNothing,
-                         'SAME': self.doNothing,
-                         'DANG': DangParser,
-                         'AFIX': AfixParser,
-                         'PART': PartParser,
-                         'HKLF': HklfParser,
-                         'ABIN': self.doNothing,
-                         'ANIS': self.doNothing,
-                         'ANSC': self.doNothing,
-                         'ANSR': self.doNothing,
-                         'BASF': self.doNothing,
-                         'BIND': self.doNothing,
-                         'BLOC': self.doNothing,
-                         'BUMP': self.doNothing,
-                         'CGLS': self.doNothing,
-                         'CHIV': self.doNothing,
-                         'CONF': self.doNothing,
-                         'CONN': self.doNothing,
-                         'DAMP': self.doNothing,
-                         'DEFS': self.doNothing,
-                         'DELU': self.doNothing,
-                         'DFIX': DfixParser,
-                         'DISP': self.doNothing,
-                         'EADP': self.doNothing,
-                         'EQIV': EqivParser,
-                         'EXTI': self.doNothing,
-                         'EXYZ': self.doNothing,
-                         'FEND': self.doNothing,
-                         'FLAT': self.doNothing,
-                         'FMAP': self.doNothing,
-                         'FRAG': self.doNothing,
-                         'FREE': self.doNothing,
-                         'GRID': self.doNothing,
-                         'HFIX': self.doNothing,
-                         'HTAB': self.doNothing,
-                         'ISOR': self.doNothing,
-                         'LATT': LattParser,
-                         'LAUE': self.doNothing,
-                         'MERG': self.doNothing,
-                         'MORE': self.doNothing,
-                         'MPLA': self.doNothing,
-                         'NCSY': self.doNothing,
-                         'NEUT': self.doNothing,
-                         'OMIT': self.doNothing,
-                         'PRIG': self.doNothing,
-                         'RESI': ResiParser,
-                         'RTAB': self.doNothing,
-                         'SHEL': self.doNothing,
-                         'SIZE': self.doNothing,
-                         'SPEC': self.doNothing,
-                         'STIR': self.doNothing,
-                         'SUMP': self.doNothing,
-                         'SWAT': self.doNothing,
-                         'TWIN': self.doNothing,
-                         'TWST': self.doNothing,
-                         'WIGL': self.doNothing,
-                         'WPDB': self.doNothing,
-                         'XNPD': self.doNothing,
-                         'Q': self.doNothing,
-                         'END': self.doNothing,
-                         'LONE': self.doNothing,
-                         '+': self.doNothing,
-                         }
 
-    def __call__(self, line):
-        line = line.rstrip('\n')
-        if not line:
-            return self.doNothing(line)
-        command = line[:4].upper()
-        if command[0] is ' ':
-            action = self.doNothing
-        else:
-            try:
-                action = self.COMMANDS[command.rstrip()]
-                if isinstance(action, type):
-                    parser = action(line)
-                    return parser.get(self)
-            except KeyError:
-                atomParser = AtomParser(line)
-                return atomParser.get(self)
-        return action(line)
+def parseRecord(command, body, raw, context):
+    """
+    Dispatches a record to the parser registered for its command in RECORDPARSERS. Records with unknown commands are
+    atoms.
+    :param command: str or None
+    :param body: str<joined record>
+    :param raw: str<record as written in the file>
+    :param context: ParseContext instance of the current read
+    :return: ShelxlLine instance or instance of a subclass
+    """
+    if command is None:
+        return ShelxlLine(raw)
+    parser = RECORDPARSERS.get(command, AtomParser)
+    if parser is None:
+        return ShelxlLine(raw)
+    return parser(body, raw, context).parse()
+
 
-    def doNothing(self, line):
-        return self, ShelxlLine(line)
+class BaseParser(object):
+    """
+    Base class for parsers of shelxl.res records.
+    """
+    RETURNTYPE = ShelxlLine
+    KEY = None
+
+    def __init__(self, body, raw, context):
+        self.body = body
+        self.raw = raw
+        self.words = body.split()
+        self.context = context
+        self.molecule = context.molecule
+
+    def parse(self):
+        """
+        Evaluates the record and returns the object representing it in ShelxlReader.lines.
+        :return: ShelxlLine instance
+        """
+        self.finished()
+        return self.RETURNTYPE(self.raw, key=self.KEY)
+
+    def finished(self):
+        pass
 
 
 class AtomParser(BaseParser):
@@ -1609,64 +3694,53 @@ class AtomParser(BaseParser):
     RETURNTYPE = ShelxlAtom
     KEY = 'atom'
 
-    def get(self, previousParser):
-        if not self.body.endswith('='):
-            self.finished()
-            return previousParser, self.RETURNTYPE(self.body, key=self.KEY,
-                                                   resi=ShelxlReader.CURRENTINSTANCE.currentResi,
-                                                   afix=ShelxlReader.CURRENTINSTANCE.currentAfix,
-                                                   part=ShelxlReader.CURRENTINSTANCE.currentPart)
+    def parse(self):
+        qPeak = self.words[0][0].upper() == 'Q'
+        atom = ShelxlAtom.fromRecord(self.body, key=self.KEY,
+                                     table=self.molecule.qPeakTable if qPeak else self.molecule.atomTable,
+                                     resi=self.context.currentResi,
+                                     afix=self.context.currentAfix,
+                                     part=self.context.currentPart)
+        if qPeak:
+            self.molecule.addQPeak(atom)
         else:
-            self.body = self.body[:-1]
-            return self, None
-
-    def __call__(self, line):
-        return LineParser(), ShelxlAtom(self.body + line, resi=ShelxlReader.CURRENTINSTANCE.currentResi, key=self.KEY,
-                                                   afix=ShelxlReader.CURRENTINSTANCE.currentAfix,
-                                                   part=ShelxlReader.CURRENTINSTANCE.currentPart)
+            self.molecule.addAtom(atom)
+        return atom
 
 
 class CellParser(BaseParser):
     """
     Parser for CELL records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
     KEY = 'cell'
 
     def finished(self):
-        data = Array([float(word) for word in self.body.split()[1:] if word])
-        ShelxlReader.CURRENTMOLECULE.setCell(data[1:])
-        ShelxlReader.CURRENTMOLECULE.setWavelength(data[0])
-        ShelxlReader.CURRENTINSTANCE['cell'] = self.body
+        data = Array([float(word) for word in self.words[1:]])
+        self.molecule.setCell(data[1:])
+        self.molecule.setWavelength(data[0])
+        self.context.reader['cell'] = self.body
 
 
 class CerrParser(BaseParser):
     """
     Parser for CERR records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
     KEY = 'cerr'
 
     def finished(self):
-        data = Array([float(word) for word in self.body.split()[1:] if word])
-        ShelxlReader.CURRENTMOLECULE.setCerr(data[1:])
-        ShelxlReader.CURRENTMOLECULE.setZ(data[0])
+        data = Array([float(word) for word in self.words[1:]])
+        self.molecule.setCerr(data[1:])
+        self.molecule.setZ(data[0])
 
 
 class SfacParser(BaseParser):
     """
     Parser for SFAC records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
-
-    def __call__(self, line):
-
-        self.body = self.body + '=\n' + line
-        return LineParser(), ShelxlLine(self.body)
 
     def finished(self):
         custom = False
-        words = [word for word in self.body.split()[1:] if word]
+        words = self.words[1:]
         for word in words:
             try:
                 word = float(word)
@@ -1677,29 +3751,25 @@ class SfacParser(BaseParser):
                 break
         if not custom:
             for sfac in words:
-                ShelxlReader.CURRENTMOLECULE.addSfac(sfac)
+                self.molecule.addSfac(sfac)
         else:
-            ShelxlReader.CURRENTMOLECULE.addCustomSfac(words)
+            self.molecule.addCustomSfac(words)
 
 
 class AfixParser(BaseParser):
-    RETURNTYPE = ShelxlLine
     KEY = 'afix'
 
     def finished(self):
-        body = [word for word in self.body.split() if word]
-        afix = body[1]
-        ShelxlReader.CURRENTINSTANCE.setCurrentAfix(afix)
+        afix = int(self.words[1])
+        self.context.setCurrentAfix(afix)
 
 
 class PartParser(BaseParser):
-    RETURNTYPE = ShelxlLine
     KEY = 'part'
 
     def finished(self):
-        body = [word for word in self.body.split() if word]
-        part = body[1]
-        ShelxlReader.CURRENTINSTANCE.setCurrentPart(part)
+        part = int(self.words[1])
+        self.context.setCurrentPart(part)
 
 
 class LattParser(BaseParser):
@@ -1707,38 +3777,36 @@ class LattParser(BaseParser):
     Parser for LATT records in shelxl.res files.
     """
     LATTDICT = {1: [],
-                2: [SymmetryElement(('.5', '.5', '.5'))],
-                3: [],
-                4: [SymmetryElement(('.5', '.5', '0')),
-                    SymmetryElement(('.5', '0', '.5')),
-                    SymmetryElement(('0', '.5', '.5'))],
-                5: [SymmetryElement(('0', '.5', '.5'))],
-                6: [SymmetryElement(('.5', '0', '.5'))],
-                7: [SymmetryElement(('.5', '.5', '0'))],
+                2: [SymmetryElement(('X+1/2', 'Y+1/2', 'Z+1/2'))],
+                3: [SymmetryElement(('X+2/3', 'Y+1/3', 'Z+1/3')),
+                    SymmetryElement(('X+1/3', 'Y+2/3', 'Z+2/3'))],
+                4: [SymmetryElement(('X+1/2', 'Y+1/2', 'Z')),
+                    SymmetryElement(('X+1/2', 'Y', 'Z+1/2')),
+                    SymmetryElement(('X', 'Y+1/2', 'Z+1/2'))],
+                5: [SymmetryElement(('X', 'Y+1/2', 'Z+1/2'))],
+                6: [SymmetryElement(('X+1/2', 'Y', 'Z+1/2'))],
+                7: [SymmetryElement(('X+1/2', 'Y+1/2', 'Z'))],
                 }
-    RETURNTYPE = ShelxlLine
     KEY = 'latt'
 
     def finished(self):
-        data = [word for word in self.body.split() if word]
-        latt = int(data[-1])
+        latt = int(self.words[-1])
         if latt > 0:
-            ShelxlReader.CURRENTMOLECULE.setCentric(True)
+            self.molecule.setCentric(True)
         lattOps = LattParser.LATTDICT[abs(latt)]
-        ShelxlReader.CURRENTMOLECULE.setLattOps(lattOps)
-        ShelxlReader.CURRENTINSTANCE['latt'] = self.body
+        self.molecule.setLattOps(lattOps)
+        self.context.reader['latt'] = self.body
 
 
 class SymmParser(BaseParser):
     """
     Parser for SYMM records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
     KEY = 'symm'
 
     def finished(self):
         symmData = self.body[4:].split(',')
-        ShelxlReader.CURRENTMOLECULE.addSymm(symmData)
+        self.molecule.addSymm(symmData)
 
 
 class DfixParser(BaseParser):
@@ -1748,63 +3816,40 @@ class DfixParser(BaseParser):
     RETURNTYPE = ShelxlRestraint
     KEY = 'dfix'
 
-    def finished(self):
-        # data = [word for word in self.body.split() if word]
-        # command = data.pop(0)
-        # try:
-        #     _, resi = command.split('_')
-        # except ValueError:
-        #     resi = None
-        # value, data = float(data[0]), data[1:]
-        # try:
-        #     err = float(data[0])
-        # except ValueError:
-        #     err = None
-        # else:
-        #     data = data[1:]
-        # pairs = []
-        # for i in range(len(data) // 2):
-        #     i, j = 2 * i, 2 * i + 1
-        #     name1, name2 = data[i], data[j]
-        #     if resi:
-        #         name1 = name1 + '_{}'.format(resi)
-        #         name2 = name2 + '_{}'.format(resi)
-        #     pairs.append((name1, name2))
-            restraint = ShelxlRestraint(self.body)
-            ShelxlReader.CURRENTMOLECULE.addDfix(restraint)
+    def parse(self):
+        restraint = ShelxlRestraint(self.body, key=self.KEY)
+        self.molecule.addDfix(restraint)
+        return restraint
 
 
 class DangParser(BaseParser):
     """
     Parser for DANG records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
     KEY = 'dfix'
 
     def finished(self):
         restraint = ShelxlRestraint(self.body)
-        ShelxlReader.CURRENTMOLECULE.addDang(restraint)
+        self.molecule.addDang(restraint)
 
 
 class EqivParser(BaseParser):
     """
     Parser for EQIV records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
 
     def finished(self):
-        data = [word for word in self.body.split() if word][1:]
+        data = self.words[1:]
         name = data.pop(0)
         data = ' '.join(data)
         data = data.split(',')
-        ShelxlReader.CURRENTMOLECULE.addEqiv(name, data)
+        self.molecule.addEqiv(name, data)
 
 
 class HklfParser(BaseParser):
     """
     Parser for HKLF records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
     KEY = 'hklf'
 
 
@@ -1812,18 +3857,103 @@ class ResiParser(BaseParser):
     """
     Parser for RESI records in shelxl.res files.
     """
-    RETURNTYPE = ShelxlLine
     KEY = 'resi'
 
     def finished(self):
-        data = [word for word in self.body[4:].split() if word]
+        data = self.words[1:]
         try:
             cls, num = data[0], data[1]
         except IndexError:
             cls = None
             num = data[0]
-        ShelxlReader.CURRENTINSTANCE.setCurrentResi(cls, num)
-        ShelxlReader.CURRENTMOLECULE.addResidue(cls, num)
+        num = int(num)
+        self.context.setCurrentResi(cls, num)
+        self.molecule.addResidue(num, cls)
+
+
+# Parsers of the commands of shelxl.res files. Records of commands mapped to None are kept verbatim. Records starting
+# with any other word are atoms.
+RECORDPARSERS = {'REM': None,
+                 'BEDE': None,
+                 'MOLE': None,
+                 'TITL': None,
+                 'CELL': CellParser,
+                 'ZERR': CerrParser,
+                 'SYMM': SymmParser,
+                 'SFAC': SfacParser,
+                 'UNIT': None,
+                 'TEMP': None,
+                 'L.S.': None,
+                 'BOND': None,
+                 'ACTA': None,
+                 'LIST': None,
+                 'PLAN': None,
+                 'WGHT': None,
+                 'FVAR': None,
+                 'SIMU': None,
+                 'RIGU': None,
+                 'SADI': None,
+                 'SAME': None,
+                 'DANG': DangParser,
+                 'AFIX': AfixParser,
+                 'PART': PartParser,
+                 'HKLF': HklfParser,
+                 'ABIN': None,
+                 'ANIS': None,
+                 'ANSC': None,
+                 'ANSR': None,
+                 'BASF': None,
+                 'BIND': None,
+                 'BLOC': None,
+                 'BUMP': None,
+                 'CGLS': None,
+                 'CHIV': None,
+                 'CONF': None,
+                 'CONN': None,
+                 'DAMP': None,
+                 'DEFS': None,
+                 'DELU': None,
+                 'DFIX': DfixParser,
+                 'DISP': None,
+                 'EADP': None,
+                 'EQIV': EqivParser,
+                 'EXTI': None,
+                 'EXYZ': None,
+                 'FEND': None,
+                 'FLAT': None,
+                 'FMAP': None,
+                 'FRAG': None,
+                 'FREE': None,
+                 'GRID': None,
+                 'HFIX': None,
+                 'HTAB': None,
+                 'ISOR': None,
+                 'LATT': LattParser,
+                 'LAUE': None,
+                 'MERG': None,
+                 'MORE': None,
+                 'MPLA': None,
+                 'NCSY': None,
+                 'NEUT': None,
+                 'OMIT': None,
+                 'PRIG': None,
+                 'RESI': ResiParser,
+                 'RTAB': None,
+                 'SHEL': None,
+                 'SIZE': None,
+                 'SPEC': None,
+                 'STIR': None,
+                 'SUMP': None,
+                 'SWAT': None,
+                 'TWIN': None,
+                 'TWST': None,
+                 'WIGL': None,
+                 'WPDB': None,
+                 'XNPD': None,
+                 'Q': None,
+                 'END': None,
+                 'LONE': None,
+                 '+': None}
 
 
 class Reader(object):
@@ -1875,7 +4005,7 @@ class Reader(object):
             if not n:
                 n = self.fp.readline()
             if not n:
-                raise StopIteration
+                return
             yield n
 
     def __exit__(self, *args):
@@ -1919,7 +4049,8 @@ class Reader(object):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Refine cell parameters against distance restraints.')
-    parser.add_argument('fileName', type=str, help='Name of a shelxl result file.')
+    parser.add_argument('fileName', type=str, nargs='+',
+                        help='Name of a shelxl result file. Mode {compare} accepts more than one file.')
     parser.add_argument('-c', '--class', type=str, default=None,
                         help='Crystal class constraints for refinement.\nWARNING: The crystal class is ONLY used to'
                              'constrain the cell parameter refinement, and is NOT used to modify the structure'
@@ -1940,32 +4071,133 @@ if __name__ == '__main__':
                              "parameters against DFIX restraints. The {default} scheme runs a SHELXL optimization step "
                              "after each time the simplex optimization converged and restarts the simplex (requires "
                              "SHELXL). The {accurate} scheme runs SHELXL as part of the simplex's evaluation step "
-                             "(very slow, requires SHELXL)",
-                        choices=['default', 'fast', 'accurate'])
+                             "(very slow, requires SHELXL). The {lsq} scheme refines the cell parameters against DFIX "
+                             "restraints by Levenberg-Marquardt least-squares with analytic derivatives. The {direct} "
+                             "scheme computes the cell from a single linear least-squares fit of the metric tensor. The "
+                             "{compare} scheme runs the optimizer backends on all given files and reports their cost. "
+                             "Mode {plot} renders the trajectory files given as file names to images, see "
+                             "--trajectory.",
+                        choices=['default', 'fast', 'accurate', 'lsq', 'direct', 'compare', 'plot'])
+    parser.add_argument('--optimizer', '-o', type=str, default=None,
+                        help='Optimizer backend used by the {default}, {fast} and {accurate} schemes. Defaults to '
+                             '{pattern}. Mode {compare} uses all backends unless one is given.',
+                        choices=list(OPTIMIZERS.keys()))
+    parser.add_argument('--processes', '-j', type=int, default=None,
+                        help='Number of SHELXL processes run in parallel in mode {accurate}, number of starts run in '
+                             'parallel with --starts, or number of structures optimized in parallel with --batch. '
+                             'Defaults to the number of CPUs.')
+    parser.add_argument('--starts', '-s', type=int, default=1,
+                        help='Number of starting cells of the optimizer in the {default}, {fast} and {lsq} schemes. '
+                             'All but the first starting cell are perturbed randomly. The best result is kept.')
+    parser.add_argument('--spread', type=float, default=.02,
+                        help='Maximum relative perturbation of the starting cells with --starts.')
+    parser.add_argument('--scratch', type=str, default=None,
+                        help='Directory in which the private workspace of a run is created. Defaults to /dev/shm '
+                             'if available.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the workspace with the intermediate SHELXL files after the run.')
+    parser.add_argument('--cache', type=str, nargs='?', default=None, const='',
+                        help='Reuse SHELXL results of identical refinements from a persistent cache. An optional '
+                             'argument sets the cache directory (default: ~/.cellopt/cache).')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='Maximum size of the SHELXL result cache in MB.')
+    parser.add_argument('--batch', '-b', action='store_true',
+                        help='Optimize all given structures with the selected scheme in a process pool. File names '
+                             'may be glob patterns. The number of parallel structures is set by --processes.')
+    parser.add_argument('--summary', type=str, default=None,
+                        help='Write the summary of a batch run to the given .csv or .json file.')
+    parser.add_argument('--cycles', type=int, default=0,
+                        help='Number of SHELXL refinements between optimizer runs in mode {compare}.')
+    parser.add_argument('--warm-start', '-w', action='store_true',
+                        help='Start the optimization from the cell computed by the {direct} scheme.')
+    parser.add_argument('--shelxl', type=str, default=None,
+                        help='Command used instead of SHELXL, eg. "python shelxlemu.py". Overrides the environment '
+                             'variable CELLOPT_SHELXL.')
+    parser.add_argument('--profile', type=str, nargs='?', default=None, const='cellopt_profile.json',
+                        help='Record wall and CPU time per phase (parse, restraints, quickEvaluate, write, shelxl, lst, '
+                             'reread) and count calls of hot functions. The report is printed and written to the '
+                             'given JSON file (default: cellopt_profile.json) at exit.')
+    parser.add_argument('--events', type=str, default=None,
+                        help='Append the progress of the optimization as JSON lines to the given file. Each line is '
+                             'one event (start, improved, evaluation, step, finish or error) with time stamp, step, '
+                             'cell, DFIX fit and wR2.')
+    parser.add_argument('--trajectory', '-t', type=str, nargs='?', default=None, const=True,
+                        help='Record the cells and DFIX fits visited by the optimizer to a .npy file. An optional '
+                             'argument sets the file name (default: <structure>_trajectory.npy).')
+    parser.add_argument('--every', type=int, default=1,
+                        help='Keep only every n-th sample of the trajectory.')
     parser.add_argument('--plot', '-p', action='store_true',
-                        help='Create diagnostic plot.')
+                        help='Create diagnostic plot. The trajectory is rendered to <trajectory>.png at the end of the '
+                             'run.')
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'svg'],
+                        help='Image format of mode {plot}.')
     args = parser.parse_args()
     expand = args.expand
     crystalClass = args.__dict__['class']
-    fileName = args.fileName
-
-    if not os.path.isfile(fileName+'.res'):
-        print('File {}.res is missing.'.format(fileName))
-        exit(3)
-    if not os.path.isfile(fileName+'.hkl'):
-        print('File {}.hkl is missing.'.format(fileName))
-        exit(4)
+    fileNames = args.fileName
     mode = args.mode
+    if args.batch:
+        if mode in ('compare', 'plot'):
+            parser.error('Mode {} can not be used with --batch.'.format(mode))
+        if args.trajectory not in (None, True):
+            parser.error('The trajectory file name can not be given with --batch.')
+        fileNames = expandFileNames(fileNames)
+        if not fileNames:
+            parser.error('No structures found.')
+    elif len(fileNames) > 1 and mode not in ('compare', 'plot'):
+        parser.error('Only modes compare and plot and --batch accept more than one file.')
+
+    if not args.batch and not mode == 'plot':
+        for fileName in fileNames:
+            if not os.path.isfile(fileName+'.res'):
+                print('File {}.res is missing.'.format(fileName))
+                exit(3)
+            if not os.path.isfile(fileName+'.hkl'):
+                print('File {}.hkl is missing.'.format(fileName))
+                exit(4)
+    fileName = fileNames[0]
     plot = args.plot
-    if mode is 'default':
-        run(fileName, p1=expand, overrideClass=crystalClass, plot=plot)
-    elif 'fast' in mode:
-        run(fileName, p1=expand, overrideClass=crystalClass, fast=True, plot=plot)
-    elif 'accurate' in mode:
-        run2(fileName, p1=expand)
+    warmStart = args.warm_start
+    optimizer = args.optimizer if args.optimizer else 'pattern'
+    scratch = args.scratch
+    keep = args.keep
+    if args.shelxl:
+        os.environ['CELLOPT_SHELXL'] = args.shelxl
+    if args.profile:
+        PROFILER.enable()
+    if args.events:
+        EVENTS.open(args.events)
+    cache = None
+    if args.cache is not None:
+        cache = RefinementCache(args.cache if args.cache else None, maxSize=args.cache_size * 1024 ** 2)
+    try:
+        if args.batch:
+            runBatch(fileNames, processes=args.processes, summary=args.summary, mode=mode, p1=expand,
+                     overrideClass=crystalClass, optimizer=optimizer, warmStart=warmStart, scratch=scratch, keep=keep,
+                     cache=cache, starts=args.starts, spread=args.spread, trajectory=args.trajectory,
+                     every=args.every, plot=plot)
+        elif mode == 'plot':
+            for fileName in fileNames:
+                imageName = os.path.splitext(fileName)[0] + '.' + args.format
+                print('Plot written to {}'.format(renderTrajectory(fileName, imageName)))
+        elif mode == 'compare':
+            compareOptimizers(fileNames, optimizers=[args.optimizer] if args.optimizer else None, cycles=args.cycles,
+                              scratch=scratch, cache=cache)
+        else:
+            runStructure(fileName, mode=mode, p1=expand, overrideClass=crystalClass, plot=plot, optimizer=optimizer,
+                         warmStart=warmStart, processes=args.processes, scratch=scratch, keep=keep, cache=cache,
+                         starts=args.starts, spread=args.spread, trajectory=args.trajectory, every=args.every)
+    except CelloptError as e:
+        print(e)
+        EVENTS.emit('error', message=' '.join(str(e).split()))
+        exit(e.exitCode)
+    finally:
+        EVENTS.close()
+        if args.profile:
+            print('\n' + str(PROFILER))
+            PROFILER.write(args.profile)
 
     import urllib.request
-    import json
     import subprocess
     try:
         localVersion = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode().strip()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Stand-in for SHELXL to profile and test cellopt.py without a licensed binary.
+
+The emulator reads <name>.ins, waits for a configurable latency and writes <name>.lst and <name>.res like a SHELXL
+refinement would. The coordinates in the .res file are perturbed slightly. The reported wR2 grows with the deviation
+of the DFIX/DANG restraints from their targets, so the optimizers of cellopt.py see a plausible objective function.
+All random decisions are seeded by the content of the .ins file, so identical refinements give identical results.
+
+cellopt.py calls SHELXL with the name of the refinement as the only argument, so the options can also be given by
+environment variables:
+    SHELXLEMU_LATENCY   seconds per refinement (default 0)
+    SHELXLEMU_JITTER    random extra seconds per refinement (default 0)
+    SHELXLEMU_FAILURE   probability of a refinement reporting a '**' error (default 0)
+    SHELXLEMU_CRASH     probability of a refinement exiting without output (default 0)
+    SHELXLEMU_SHIFT     maximum coordinate shift in Angstrom (default 0.002)
+    SHELXLEMU_SEED      seed combined with the .ins file content (default 0)
+    SHELXLEMU_LOG       file to which one JSON line per refinement is appended (default none)
+
+Usage:
+    CELLOPT_SHELXL="python /path/to/shelxlemu.py" python cellopt.py structure -m default
+    python cellopt.py structure -m accurate --shelxl "python /path/to/shelxlemu.py"
+    python shelxlemu.py work --latency 0.5 --failure 0.1
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import json
+from hashlib import sha1
+import numpy as np
+
+from cellopt import ShelxlReader
+
+
+OPTIONS = (('latency', float, 0.),
+           ('jitter', float, 0.),
+           ('failure', float, 0.),
+           ('crash', float, 0.),
+           ('shift', float, .002),
+           ('seed', int, 0),
+           ('log', str, None))
+BASEWR2 = .08
+DFIXWR2 = .5
+
+
+def contentSeed(fileName, seed=0):
+    """
+    Returns a random seed derived from the content of a file and a user seed.
+    :param fileName: str
+    :param seed: int
+    :return: int
+    """
+    with open(fileName, 'rb') as fp:
+        digest = sha1(fp.read() + str(seed).encode()).hexdigest()
+    return int(digest[:8], 16)
+
+
+def formatListing(name, wR2, goof, maxShift, errors=()):
+    """
+    Returns the lines of a SHELXL listing holding the figures of merit parsed by cellopt.ListingParser.
+    :param name: str<name of the refinement>
+    :param wR2: float
+    :param goof: float
+    :param maxShift: float<maximum shift/esd>
+    :param errors: list of str<error messages>
+    :return: list of str
+    """
+    lines = [' +  Copyright(C) SHELXL emulator for cellopt.py',
+             ' +  {}  started at {}'.format(name, time.strftime('%H:%M:%S on %d-%b-%Y')),
+             '']
+    if errors:
+        return lines + [' ** {} **'.format(error) for error in errors]
+    r1 = wR2 * .4
+    return lines + [' wR2 = {:7.4f} before cycle   4 for    999 data and     99 /     99 parameters'.format(wR2),
+                    ' GooF = S = {:8.3f};     Restrained GooF = {:8.3f} for     99 restraints'.format(goof, goof),
+                    ' Mean shift/esd = {:7.3f}  Maximum = {:9.3f} for  x C1'.format(maxShift / 2, maxShift),
+                    '',
+                    ' R1 = {:7.4f} for    900 Fo > 4sig(Fo)  and {:7.4f} for all    999 data'.format(r1, r1 * 1.1),
+                    ' wR2 = {:7.4f},  GooF = S = {:8.3f},  Restrained GooF = {:8.3f}  for all data'.format(wR2, goof,
+                                                                                                       goof),
+                    '',
+                    ' +  {}  finished at {}'.format(name, time.strftime('%H:%M:%S on %d-%b-%Y'))]
+
+
+def refine(name, latency=0., jitter=0., failure=0., crash=0., shift=.002, seed=0, log=None):
+    """
+    Emulates a SHELXL refinement of <name>.ins.
+    :param name: str<name of the refinement without extension>
+    :param latency: float<seconds per refinement>
+    :param jitter: float<maximum random extra seconds per refinement>
+    :param failure: float<probability of a refinement reporting an error>
+    :param crash: float<probability of a refinement exiting without output>
+    :param shift: float<maximum coordinate shift in Angstrom>
+    :param seed: int<seed combined with the .ins file content>
+    :param log: str<name of a file to which a JSON line describing the refinement is appended>
+    :return: int<exit code>
+    """
+    startTime = time.time()
+    random = np.random.RandomState(contentSeed(name + '.ins', seed))
+    delay = latency + jitter * random.uniform()
+    outcome = 'crash' if random.uniform() < crash else 'failure' if random.uniform() < failure else 'ok'
+    wR2 = None
+    if outcome == 'crash':
+        time.sleep(delay * random.uniform())
+    else:
+        reader = ShelxlReader()
+        molecule = reader.read(name + '.ins')
+        if outcome == 'failure':
+            lines = formatListing(name, 0, 0, 0, errors=['Emulated refinement failure'])
+        else:
+            try:
+                weighted = molecule.checkDfix()[1]
+            except (ZeroDivisionError, ValueError):
+                weighted = 0.
+            wR2 = BASEWR2 + DFIXWR2 * weighted + .001 * random.uniform()
+            size = len(molecule.atoms)
+            fracs = molecule.atomTable.fracs[:size]
+            fracs += random.uniform(-shift, shift, (size, 3)) / np.array(molecule.cell[:3], dtype=float)
+            reader.write(name + '.res')
+            lines = formatListing(name, wR2, 1. + 10 * weighted, shift / .001)
+        time.sleep(max(0., delay - (time.time() - startTime)))
+        with open(name + '.lst', 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        print('\n'.join(lines))
+    if log:
+        with open(log, 'a') as fp:
+            fp.write(json.dumps({'name': os.path.abspath(name), 'outcome': outcome, 'wR2': wR2,
+                                 'start': startTime, 'seconds': time.time() - startTime}) + '\n')
+    return 0 if outcome == 'ok' else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulate a SHELXL refinement for offline profiling of cellopt.py.')
+    parser.add_argument('name', type=str,
+                        help='Name of the refinement. <name>.ins is read, <name>.res and <name>.lst are written.')
+    for option, kind, default in OPTIONS:
+        variable = 'SHELXLEMU_{}'.format(option.upper())
+        parser.add_argument('--{}'.format(option), type=kind, default=kind(os.environ[variable]) if variable in
+                            os.environ else default, help='Overrides ${}.'.format(variable))
+    args = parser.parse_args()
+    name = args.name[:-4] if args.name.lower().endswith('.ins') else args.name
+    sys.exit(refine(name, **dict((option, getattr(args, option)) for option, _, _ in OPTIONS)))